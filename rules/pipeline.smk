@@ -357,7 +357,9 @@ rule UMI_extract:
     output:
         extracted = temp('sequences/UMI/{tag, [^\/_]*}_UMIextract.bam'),
         index = temp('sequences/UMI/{tag, [^\/_]*}_UMIextract.bam.bai'),
-        log = 'sequences/UMI/{tag, [^\/_]*}_UMI-extract.csv'
+        log = 'sequences/UMI/{tag, [^\/_]*}_UMI-extract.csv.gz',
+        counts = 'sequences/UMI/{tag, [^\/_]*}_UMI-extract-counts.csv'
+    threads: config.get('threads_UMI_extract', 1)
     params:
         barcode_contexts = lambda wildcards: [config['runs'][wildcards.tag]['barcodeInfo'][barcodeType]['context'].upper() for barcodeType in config['runs'][wildcards.tag]['barcodeInfo']] if config['do_demux'][wildcards.tag] else None,
         reference = lambda wildcards: config['runs'][wildcards.tag]['reference'],
@@ -365,11 +367,11 @@ rule UMI_extract:
     script:
         'utils/UMI_extract.py'
 
-# collapse UMI extract log files into a single small file that summarizes UMI recognition in aggregate instead of on a read-by-read basis
+# collapse UMI extract counts files into a single small file that summarizes UMI recognition in aggregate instead of on a read-by-read basis
 
 rule UMI_extract_summary:
     input:
-        expand('sequences/UMI/{tag}_UMI-extract.csv', tag = list(set( [config['consensusCopyDict'][str(t)] for t in config['runs'] if config['do_UMI_analysis'][t]] )))
+        expand('sequences/UMI/{tag}_UMI-extract-counts.csv', tag = list(set( [config['consensusCopyDict'][str(t)] for t in config['runs'] if config['do_UMI_analysis'][t]] )))
     output:
         'sequences/UMI/UMI-extract-summary.csv'
     run:
@@ -383,11 +385,10 @@ rule UMI_extract_summary:
         UMIcols = [f'umi_{UMInum}_failure' for UMInum in range(1,maxUMIs+1)]
         outDF = pd.DataFrame(columns=['tag','success','failure']+UMIcols)
         for f in input:
-            df = pd.read_csv(f, dtype={'umi':str})
-            dfCols = df.columns[2:]
+            dfSum = pd.read_csv(f)
+            dfCols = dfSum.columns
             tag = f.split('/')[-1].split('_')[0]
-            df['tag'] = tag
-            dfSum = df.groupby(['tag'])[dfCols].sum().reset_index()
+            dfSum.insert(0, 'tag', tag)
             if len(outDF.columns) != len(dfSum.columns): # add columns to match the maximum number of UMIs in a tag to allow for df concatenation
                 for col in UMIcols:
                     if col not in dfCols:
@@ -404,10 +405,9 @@ rule UMI_group:
         log = temp('sequences/UMI/{tag, [^\/_]*}_UMIgroup-log.tsv')
     params:
         UMI_mismatches = lambda wildcards: config['UMI_mismatches']
-    shell:
-        """
-        umi_tools group -I {input.bam} --group-out={output.log} --output-bam --per-gene --gene-tag=GN --edit-distance-threshold {params.UMI_mismatches} -S {output.bam}
-        """
+    threads: config.get('threads_UMI_group', 1)
+    script:
+        'utils/UMI_group.py'
 
 rule plot_UMI_group:
     input:
@@ -448,6 +448,31 @@ if config['UMI_consensus_minimum'] == config['UMI_consensus_maximum'] == 1:
                         fp_out.write(fp_in.read())
             os.system(f'gzip {output.seqs[:-3]}')
 
+# split UMI groups and generate consensus sequences in a single job, streaming each UMI group to consensus generation as soon as it is complete
+elif config.get('UMI_consensus_fused', False):
+
+    rule UMI_fused_consensus:
+        input:
+            grouped = 'sequences/UMI/{tag}_UMIgroup.bam',
+            log = 'sequences/UMI/{tag}_UMIgroup-log.tsv',
+            alnRef = lambda wildcards: config['runs'][wildcards.tag]['reference_aln']
+        output:
+            outDir = temp(directory('sequences/UMI/{tag, [^\/_]*}-fused')),
+            seqs = 'sequences/UMI/{tag, [^\/_]*}_UMIconsensuses.fasta.gz'
+        params:
+            batches = lambda wildcards: config['UMI_medaka_batches'],
+            minimum = lambda wildcards: config['UMI_consensus_minimum'],
+            maximum = lambda wildcards: config['UMI_consensus_maximum'],
+            depth = lambda wildcards: config['UMI_consensus_minimum'],
+            model = lambda wildcards: config['medaka_model'],
+            flags = lambda wildcards: config['medaka_flags'],
+            queue_size = lambda wildcards, threads: config.get('UMI_consensus_fused_queue', 100) * threads
+        threads: workflow.cores
+        resources:
+            threads = lambda wildcards, threads: threads
+        script:
+            'utils/UMI_fused_consensus.py'
+
 else:
 
     rule UMI_consensus:
@@ -598,15 +623,21 @@ rule generate_barcode_ref:
     script:
         'utils/generate_barcode_ref.py'
 
+def demultiplex_input(wildcards):
+    # demultiplex directly from the unsorted minimap2 SAM output, in place of the sorted BAM file, if the sorted BAM file is not needed by any other rule
+    if config['do_demux_stream'][wildcards.tag]:
+        return {'aln':f'alignments/{wildcards.tag}.sam'}
+    else:
+        return {'aln':f'alignments/{wildcards.tag}.bam', 'bai':f'alignments/{wildcards.tag}.bam.bai', 'flag':f'demux/.{wildcards.tag}_generate_barcode_ref.done'}
+
 checkpoint demultiplex:
     input:
-        aln = 'alignments/{tag}.bam',
-        bai = 'alignments/{tag}.bam.bai',
-        flag = 'demux/.{tag}_generate_barcode_ref.done'
+        unpack(demultiplex_input)
     output:
         flag = touch('demux/.{tag, [^\/_]*}_demultiplex.done'),
         # checkpoint outputs have the following structure: demux/{tag}_{barcodeGroup}.bam'
         stats = 'demux/{tag, [^\/_]*}_demux-stats.csv'
+    threads: config['threads_demux']
     params:
         barcodeInfo = lambda wildcards: config['runs'][wildcards.tag]['barcodeInfo'],
         barcodeGroups = lambda wildcards: config['runs'][wildcards.tag].get('barcodeGroups', False)
@@ -636,7 +667,8 @@ rule index_demuxed:
 
 # Mutation analysis will only output AA analysis when a third reference sequence is provided, yielding a dynamic number of output files. Can't use functions in output, so creating a separate
 #   rule for which correct input files are only given when AA analysis is not being performed, and giving this rule priority. It's not pretty but it works.
-ruleorder: mutation_analysis_NTonly > mutation_analysis
+#   The same approach is used to give priority to moving the outputs of batched mutation analysis into place, if batched mutation analysis is being used
+ruleorder: mutation_analysis_batch_output_NTonly > mutation_analysis_batch_output > mutation_analysis_NTonly > mutation_analysis
 
 def ma_NTonly_input(wildcards):
     if config['do_AA_mutation_analysis'][tag]:
@@ -652,6 +684,7 @@ rule mutation_analysis_NTonly:
         unpack(ma_NTonly_input)
     output:
         expand('mutation_data/{{tag, [^\/_]*}}/{{barcodes, [^\/_]*}}/{{tag}}_{{barcodes}}_{datatype}', datatype = ['alignments.txt', 'genotypes.csv', 'seq-IDs.csv', 'failures.csv', 'NT-muts-frequencies.csv', 'NT-muts-distribution.csv'])
+    threads: config.get('threads_mutation_analysis', 1)
     script:
         'utils/mutation_analysis.py'
 
@@ -661,9 +694,74 @@ rule mutation_analysis:
         bai = lambda wildcards: expand('demux/{tag}_{{barcodes}}.bam.bai', tag=wildcards.tag) if config['do_demux'][wildcards.tag] else f'alignments/{wildcards.tag}.bam.bai'
     output:
         expand('mutation_data/{{tag, [^\/_]*}}/{{barcodes, [^\/_]*}}/{{tag}}_{{barcodes}}_{datatype}', datatype = ['alignments.txt', 'genotypes.csv', 'seq-IDs.csv', 'failures.csv', 'NT-muts-frequencies.csv', 'NT-muts-distribution.csv', 'AA-muts-frequencies.csv', 'AA-muts-distribution.csv'])
+    threads: config.get('threads_mutation_analysis', 1)
     script:
         'utils/mutation_analysis.py'
 
+# If mutation_analysis_batch is set to True in the config file, all demultiplexed barcode groups for a tag are analyzed by a single job,
+#   which writes outputs to a staging directory. Outputs for each barcode group are then copied into place by a local rule, and the staging
+#   directory is removed once outputs for all barcode groups are in place. The batch flag is temporary, so if any output is later removed,
+#   the batch is rerun to regenerate the staging directory
+def ma_batch_input(wildcards):
+    if config.get('mutation_analysis_batch', False) and config['do_demux'][wildcards.tag]:
+        checkpoint_demux_output = checkpoints.demultiplex.get(tag=wildcards.tag).output[0]
+        checkpoint_demux_prefix = checkpoint_demux_output.split('demultiplex')[0]
+        checkpoint_demux_files = checkpoint_demux_prefix.replace('.','') + '{BCs}.bam'
+        barcodes = glob_wildcards(checkpoint_demux_files).BCs
+        return {'bams':expand('demux/{tag}_{barcodes}.bam', tag=wildcards.tag, barcodes=barcodes), 'bais':expand('demux/{tag}_{barcodes}.bam.bai', tag=wildcards.tag, barcodes=barcodes)}
+    else:
+        return {'bams':'dummyfilethatshouldneverexist', 'bais':'dummyfilethatshouldneverexist'}
+
+rule mutation_analysis_batch:
+    input:
+        unpack(ma_batch_input)
+    output:
+        flag = temp(touch('mutation_data/{tag, [^\/_]*}/.{tag}_mutation_analysis_batch.done'))
+    params:
+        stagingDir = lambda wildcards: f'mutation_data/{wildcards.tag}/batch_staging'
+    threads: config.get('threads_mutation_analysis', 1)
+    script:
+        'utils/mutation_analysis.py'
+
+def ma_batch_output_input(wildcards, AA):
+    if config.get('mutation_analysis_batch', False) and config['do_demux'][wildcards.tag] and (config['do_AA_mutation_analysis'][wildcards.tag] == AA):
+        return f'mutation_data/{wildcards.tag}/.{wildcards.tag}_mutation_analysis_batch.done'
+    else:
+        return 'dummyfilethatshouldneverexist'
+
+def move_batch_outputs(wildcards, output):
+    import os
+    import shutil
+    stagingDir = os.path.join('mutation_data', wildcards.tag, 'batch_staging')
+    for outFile in output:
+        stagedFile = os.path.join(stagingDir, wildcards.barcodes, os.path.basename(outFile))
+        shutil.copyfile(stagedFile, outFile + '.tmp') # copy under a temporary name so outputs only appear once complete
+        os.replace(outFile + '.tmp', outFile)
+    # remove the staging directory once the outputs of every barcode group staged for this tag are in place
+    for barcodes in os.listdir(stagingDir):
+        for stagedName in os.listdir(os.path.join(stagingDir, barcodes)):
+            if not os.path.exists(os.path.join('mutation_data', wildcards.tag, barcodes, stagedName)):
+                return
+    shutil.rmtree(stagingDir, ignore_errors=True)
+
+localrules: mutation_analysis_batch_output_NTonly, mutation_analysis_batch_output
+
+rule mutation_analysis_batch_output_NTonly:
+    input:
+        lambda wildcards: ma_batch_output_input(wildcards, False)
+    output:
+        expand('mutation_data/{{tag, [^\/_]*}}/{{barcodes, [^\/_]*}}/{{tag}}_{{barcodes}}_{datatype}', datatype = ['alignments.txt', 'genotypes.csv', 'seq-IDs.csv', 'failures.csv', 'NT-muts-frequencies.csv', 'NT-muts-distribution.csv'])
+    run:
+        move_batch_outputs(wildcards, output)
+
+rule mutation_analysis_batch_output:
+    input:
+        lambda wildcards: ma_batch_output_input(wildcards, True)
+    output:
+        expand('mutation_data/{{tag, [^\/_]*}}/{{barcodes, [^\/_]*}}/{{tag}}_{{barcodes}}_{datatype}', datatype = ['alignments.txt', 'genotypes.csv', 'seq-IDs.csv', 'failures.csv', 'NT-muts-frequencies.csv', 'NT-muts-distribution.csv', 'AA-muts-frequencies.csv', 'AA-muts-distribution.csv'])
+    run:
+        move_batch_outputs(wildcards, output)
+
 def mut_stats_input(wildcards):
     datatypes = ['alignments.txt', 'genotypes.csv', 'seq-IDs.csv', 'failures.csv', 'NT-muts-frequencies.csv', 'NT-muts-distribution.csv']
     if config['do_AA_mutation_analysis'][wildcards.tag]: datatypes.extend(['AA-muts-frequencies.csv', 'AA-muts-distribution.csv'])
@@ -866,11 +964,11 @@ rule plot_pipeline_throughput:
         UMI_preconsensus_alignment = lambda wildcards: expand('sequences/UMI/{tag}_noConsensus.bam', tag=config['consensusCopyDict'][wildcards.tag])[0] if config['do_UMI_analysis'][wildcards.tag]==True else f'sequences/{wildcards.tag}.fastq.gz',
         UMI_preconsensus_index = lambda wildcards: expand('sequences/UMI/{tag}_noConsensus.bam.bai', tag=config['consensusCopyDict'][wildcards.tag])[0] if config['do_UMI_analysis'][wildcards.tag]==True else f'sequences/{wildcards.tag}.fastq.gz',
         UMI_preconsensus_log = lambda wildcards: expand('sequences/UMI/{tag}_noConsensus.log', tag=config['consensusCopyDict'][wildcards.tag])[0] if config['do_UMI_analysis'][wildcards.tag]==True else f'sequences/{wildcards.tag}.fastq.gz',
-        UMI_extract = lambda wildcards: expand('sequences/UMI/{tag}_UMI-extract.csv', tag=config['consensusCopyDict'][wildcards.tag])[0] if config['do_UMI_analysis'][wildcards.tag]==True else f'sequences/{wildcards.tag}.fastq.gz',
+        UMI_extract = lambda wildcards: expand('sequences/UMI/{tag}_UMI-extract-counts.csv', tag=config['consensusCopyDict'][wildcards.tag])[0] if config['do_UMI_analysis'][wildcards.tag]==True else f'sequences/{wildcards.tag}.fastq.gz',
         UMI_group = lambda wildcards: expand('sequences/UMI/{tag}_UMIgroup-distribution.csv', tag=config['consensusCopyDict'][wildcards.tag])[0] if config['do_UMI_analysis'][wildcards.tag]==True else f'sequences/{wildcards.tag}.fastq.gz',
         UMI_consensus = lambda wildcards: expand('sequences/UMI/{tag}_UMIconsensuses.fasta.gz', tag=config['consensusCopyDict'][wildcards.tag])[0] if config['do_UMI_analysis'][wildcards.tag]==True else f'sequences/{wildcards.tag}.fastq.gz',
-        alignment = lambda wildcards: f'alignments/{wildcards.tag}.bam',
-        alignment_index = lambda wildcards: f'alignments/{wildcards.tag}.bam.bai',
+        alignment = lambda wildcards: f'alignments/{wildcards.tag}.bam' if not config['do_demux_stream'][wildcards.tag] else f'alignments/{wildcards.tag}.log',
+        alignment_index = lambda wildcards: f'alignments/{wildcards.tag}.bam.bai' if not config['do_demux_stream'][wildcards.tag] else f'alignments/{wildcards.tag}.log',
         alignment_log = lambda wildcards: f'alignments/{wildcards.tag}.log',
         demux = lambda wildcards: f'demux/{wildcards.tag}_demux-stats.csv' if config['do_demux'][wildcards.tag] else f'sequences/{wildcards.tag}.fastq.gz'
     output:
@@ -0,0 +1,39 @@
+"""functions for splitting a BAM file into chunks of reads that can be processed independently,
+    e.g. by separate processes. Chunks are defined by the BGZF virtual offset of the first read
+    in the chunk and the number of reads in the chunk, so that each process can seek directly
+    to its chunk without reading through the rest of the file"""
+
+import itertools
+import pysam
+
+def chunk_BAM(BAMin, chunkSize):
+    """splits a BAM file into chunks of at most chunkSize reads
+
+    args:
+        BAMin       - path to BAM file
+        chunkSize   - maximum number of reads per chunk
+
+    returns:
+        list of (offset, count) tuples, where offset is the virtual offset of the first read of the chunk
+            and count is the number of reads in the chunk, in the order that chunks appear in the file
+    """
+    chunks = []
+    with pysam.AlignmentFile(BAMin, 'rb', check_sq=False) as bamFile:
+        while True:
+            offset = bamFile.tell()
+            count = sum(1 for _ in itertools.islice(bamFile, chunkSize))
+            if count == 0:
+                break
+            chunks.append((offset, count))
+    return chunks
+
+def iterate_BAM_chunk(bamFile, offset, count):
+    """yields the reads of a single chunk produced by chunk_BAM()
+
+    args:
+        bamFile     - open pysam.AlignmentFile of the BAM file that was chunked
+        offset      - virtual offset of the first read of the chunk
+        count       - number of reads in the chunk
+    """
+    bamFile.seek(offset)
+    yield from itertools.islice(bamFile, count)
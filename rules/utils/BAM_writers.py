@@ -0,0 +1,143 @@
+"""buffered writing of reads to a large number of BAM files with a bounded number of open file handles.
+    Reads are buffered for each output file and written in blocks. Open files are kept in a least recently
+    used pool, and once the pool is full the least recently used file is closed. If more reads are later
+    written to a closed file, they are written to a new part file, and all parts of each file are concatenated
+    in order once writing is complete. Output files that receive few reads can instead be written to a
+    single spill BAM file, with the name of the output file that each read belongs to stored as a BAM tag"""
+
+import os
+import shutil
+from collections import OrderedDict
+import pysam
+
+class BAMWriterPool:
+
+    def __init__(self, template, outputDir, prefix='', maxOpenFiles=256, bufferSize=1000, maxBufferedBytes=100000000, spillPath=None, spillTag='YG'):
+        """
+        arguments:
+
+        template            - open pysam.AlignmentFile to use as the header template for all output files
+        outputDir           - directory that output files are written to, as {outputDir}/{prefix}{name}.bam
+        prefix              - prefix for all output file names
+        maxOpenFiles        - maximum number of output files that are open at any one time
+        bufferSize          - number of reads buffered for an output file before they are written
+        maxBufferedBytes    - approximate maximum memory used by reads buffered across all output files, in bytes, as
+                                estimated by read_size(). If exceeded, the largest buffers are written until half this
+                                amount remains buffered
+        spillPath           - path of the spill BAM file that output files are written to if provided to close()
+        spillTag            - BAM tag used to record the output file name of each read in the spill BAM file
+        """
+        self.template = template
+        self.outputDir = outputDir
+        self.prefix = prefix
+        self.maxOpenFiles = max(maxOpenFiles, 1)
+        self.bufferSize = bufferSize
+        self.maxBufferedBytes = maxBufferedBytes
+        self.spillPath = spillPath
+        self.spillTag = spillTag
+        self.buffers = {}               # output file name: list of buffered reads
+        self.bufferedBytes = {}         # output file name: estimated size of buffered reads
+        self.totalBufferedBytes = 0
+        self.counts = {}                # output file name: number of reads written, in the order that output files were first written to
+        self.parts = {}                 # output file name: list of part files, in the order that they were written
+        self.openFiles = OrderedDict()  # output file name: open pysam.AlignmentFile of the last part, ordered from least to most recently used
+
+    def path(self, name):
+        return os.path.join(self.outputDir, f'{self.prefix}{name}.bam')
+
+    @staticmethod
+    def read_size(BAMentry):
+        """estimates the memory used by a buffered read, in bytes: one byte each for every base and quality score,
+        plus a fixed overhead for the read name, CIGAR string, tags, and pysam object"""
+        return 2 * BAMentry.query_length + 500
+
+    def write(self, name, BAMentry):
+        """buffers a read to be written to the output file `name`"""
+        buffer = self.buffers.setdefault(name, [])
+        buffer.append(BAMentry)
+        self.counts[name] = self.counts.get(name, 0) + 1
+        size = self.read_size(BAMentry)
+        self.bufferedBytes[name] = self.bufferedBytes.get(name, 0) + size
+        self.totalBufferedBytes += size
+        if len(buffer) >= self.bufferSize:
+            self.flush(name)
+        elif self.totalBufferedBytes > self.maxBufferedBytes:
+            for largest in sorted(self.bufferedBytes, key=self.bufferedBytes.get, reverse=True):
+                self.flush(largest)
+                if self.totalBufferedBytes <= self.maxBufferedBytes // 2:
+                    break
+
+    def get_file(self, name):
+        """returns an open file for the output file `name`, opening a new part file if it is not already open"""
+        if name in self.openFiles:
+            self.openFiles.move_to_end(name)
+            return self.openFiles[name]
+        if len(self.openFiles) >= self.maxOpenFiles:
+            _, leastRecent = self.openFiles.popitem(last=False)
+            leastRecent.close()
+        parts = self.parts.setdefault(name, [])
+        partPath = f'{self.path(name)}.part{len(parts)}'
+        parts.append(partPath)
+        self.openFiles[name] = pysam.AlignmentFile(partPath, 'wb', template=self.template)
+        return self.openFiles[name]
+
+    def flush(self, name):
+        """writes all buffered reads for the output file `name`"""
+        buffer = self.buffers.pop(name, [])
+        if not buffer:
+            return
+        outFile = self.get_file(name)
+        for BAMentry in buffer:
+            outFile.write(BAMentry)
+        self.totalBufferedBytes -= self.bufferedBytes.pop(name)
+
+    def add_part(self, name, BAMpath):
+        """appends all reads in an existing BAM file to the output file `name`, after any reads already written to it.
+        The BAM file is moved or concatenated into the output file by close()"""
+        self.flush(name)
+        if name in self.openFiles:
+            self.openFiles.pop(name).close()
+        self.parts.setdefault(name, []).append(BAMpath)
+
+    def close(self, spill=None):
+        """writes all remaining reads, then concatenates the parts of each output file
+
+        args:
+            spill   - collection of output file names that are written to the spill BAM file, if fewer than bufferSize
+                        reads were written to them, including any reads already written to their own file to limit
+                        memory use. Reads are written to the spill BAM file in the order that output files were first written to
+
+        returns:
+            list of output file names that were written to their own file and list of output file names that were
+                written to the spill BAM file
+        """
+        spilled = [name for name, count in self.counts.items() if count < self.bufferSize and name in (spill or ())]
+        if spilled:
+            with pysam.AlignmentFile(self.spillPath, 'wb', template=self.template) as spillFile:
+                for name in spilled:
+                    if name in self.openFiles:
+                        self.openFiles.pop(name).close()
+                    for part in self.parts.pop(name, []):
+                        with pysam.AlignmentFile(part, 'rb', check_sq=False) as partFile:
+                            for BAMentry in partFile.fetch(until_eof=True):
+                                BAMentry.set_tag(self.spillTag, name)
+                                spillFile.write(BAMentry)
+                        os.remove(part)
+                    for BAMentry in self.buffers.pop(name, []):
+                        BAMentry.set_tag(self.spillTag, name)
+                        spillFile.write(BAMentry)
+                    self.totalBufferedBytes -= self.bufferedBytes.pop(name, 0)
+        for name in list(self.buffers):
+            self.flush(name)
+        for outFile in self.openFiles.values():
+            outFile.close()
+        self.openFiles.clear()
+
+        for name, parts in self.parts.items():
+            if len(parts) == 1:
+                shutil.move(parts[0], self.path(name))
+            else:
+                pysam.cat('-o', self.path(name), *parts)
+                for part in parts:
+                    os.remove(part)
+        return list(self.parts), spilled
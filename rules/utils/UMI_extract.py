@@ -2,16 +2,22 @@
 UMI_extract.py
 identifies UMI barcodes in each sequence of a .bam file based on sequence context provided
 in config file, appends this sequence to the sequence name, and writes these to a new .bam file,
-including a GN tag that is used by the UMI_group rule to group reads"""
+including a GN tag that is used by the UMI_group rule to group reads. The result of UMI identification for each
+read is streamed to a gzipped .csv log file, and counts of successes and failures are written to a separate small .csv file.
+If multiple threads are provided, the BAM file is split into chunks of reads that are processed in parallel"""
 
+import csv
 import gzip
-import re
+import multiprocessing as mp
+import os
+import shutil
+import tempfile
 import pandas as pd
 import numpy as np
 import pysam
-from Bio.Seq import reverse_complement
 from Bio import SeqIO
-from demux import BarcodeParser
+from reference_projection import ReferenceProjection
+from BAM_chunks import chunk_BAM, iterate_BAM_chunk
 
 def main():
 
@@ -22,13 +28,25 @@ def main():
 
     BAMout = snakemake.output.extracted
     logOut = snakemake.output.log
+    countsOut = snakemake.output.counts
 
-    xUMIs = UMI_Extractor(config['runs'], tag, BAMin, BAMout, logOut)
-    xUMIs.extract_UMIs()
+    xUMIs = UMI_Extractor(config['runs'], tag, BAMin, BAMout, logOut, countsOut)
+    xUMIs.extract_UMIs(snakemake.threads)
+
+def init_worker(UMIextractor):
+    """initializer for processes in a multiprocessing pool. Processes are forked, so the UMI_Extractor
+    object is shared with the parent process rather than being copied for each chunk"""
+    global workerUMIextractor
+    workerUMIextractor = UMIextractor
+
+def extract_chunk(chunk):
+    """multiprocessing worker function, extracts UMIs from a chunk of reads from the BAM file input into its own shard BAM and log files.
+    `chunk` is a tuple of the shard BAM file, the shard log file, the BGZF virtual offset of the first read, and the number of reads in the chunk"""
+    return workerUMIextractor.extract_UMIs_chunk(*chunk)
 
 class UMI_Extractor:
 
-    def __init__(self, runsConfig, tag, BAMin, BAMout, logOut):
+    def __init__(self, runsConfig, tag, BAMin, BAMout, logOut, countsOut, logBufferSize=100000):
         """
         arguments:
 
@@ -37,11 +55,16 @@ class UMI_Extractor:
         BAMin           - BAM input file
         BAMout          - BAM file containing each sequence for which all UMIs could be identified
                             with each UMI concatenated together and added to the end of the read ID
+        logOut          - gzipped .csv file of the UMI identification result for each sequence
+        countsOut       - .csv file of the total number of successes and failures of UMI identification
+        logBufferSize   - number of log rows to keep in memory before they are written to the log file
         """
         self.tag = tag
         self.BAMin = BAMin
         self.BAMout = BAMout
         self.logOut = logOut
+        self.countsOut = countsOut
+        self.logBufferSize = logBufferSize
         self.refSeqfasta = runsConfig[tag]['reference']
         self.reference = list(SeqIO.parse(self.refSeqfasta, 'fasta'))[0]
         self.referenceSequence = str(self.reference.seq).upper()
@@ -50,97 +73,115 @@ class UMI_Extractor:
             contextIndex = self.referenceSequence.find(context)
             assert contextIndex != -1, f'UMI context not found in reference sequence. Modify context or reference sequence to ensure an exact match is present.\n\nRun tag: `{self.tag}`\nsequence context: `{context}`\nreference sequence: `{self.reference.id}`\nreference sequence fasta file: `{self.refSeqfasta}`'
             assert self.referenceSequence[contextIndex+1:].find(context) == -1, f'UMI context found in reference sequence more than once. Modify context or reference sequence to ensure only one exact match is present.\n\nRun tag: `{self.tag}`\nsequence context: `{context}`\nreference sequence: `{self.reference.id}`\nreference sequence fasta file: `{self.refSeqfasta}`'
-            
-
-    def find_N_start_end(self, sequence, context, i):
-        """given a sequence with barcode locations marked as Ns, and a barcode sequence context (e.g. ATCGNNNNCCGA),
-        this function will return the beginning and end of the Ns within the appropriate context if it exists only once.
-        If the context does not exist or if the context appears more than once, then will assign the failure mode
-        to `self.failureReason`, including the index of the context `i`, and will return 'fail', 'fail'"""
-
-        location = sequence.find(context)
-        if location == -1:
-            self.logFailure[i] += 1
-            return 'fail', 'fail'
-        N_start = location + context.find('N')
-        N_end = location + len(context) - context[::-1].find('N')
-
-        if sequence[N_end:].find(context) == -1:
-            return N_start, N_end
-        else:
-            self.logFailure[i] += 1
-            return 'fail', 'fail'
-
-
-    def align_reference(self, BAMentry):
-        """given a pysam.AlignmentFile BAM entry,
-        builds the reference alignment string with indels accounted for"""
-        index = BAMentry.reference_start
-        refAln = ''
-        for cTuple in BAMentry.cigartuples:
-            if cTuple[0] == 0: #match
-                refAln += self.reference.seq.upper()[index:index+cTuple[1]]
-                index += cTuple[1]
-            elif cTuple[0] == 1: #insertion
-                refAln += '-'*cTuple[1]
-            elif cTuple[0] == 2: #deletion
-                index += cTuple[1]
-        return refAln
-
-
-    def id_UMIs(self, refAln, BAMentry):
+        self.referenceProjection = ReferenceProjection(self.referenceSequence, dict(enumerate(self.UMI_contexts)), flagAdjacentIndels=False)
+
+
+    def id_UMIs(self, BAMentry):
         """Inputs:
-            refAln:         aligned reference string from align_reference()
             BAMentry:       pysam.AlignmentFile entry
         
-        Returns the combined UMIs if all can be identified, or the reason for failure
-        if they cannot"""
+        Returns the combined UMIs if all can be identified, or None if they cannot,
+        and records each UMI context that could not be identified in `self.logFailure`"""
 
         UMItag = ''
+        UMIlocations = self.referenceProjection.project(BAMentry)
+        querySequence = BAMentry.query_alignment_sequence
 
-        for i, context in enumerate(self.UMI_contexts):
+        for i in range(len(self.UMI_contexts)):
 
-            start,stop = self.find_N_start_end(refAln, context, i)
+            location = UMIlocations[i]
 
-            try:
-                UMItag += BAMentry.query_alignment_sequence[ start:stop ]
-            except (TypeError or SyntaxError) as Err:
+            if type(location) == tuple:
+                if UMItag is not None:
+                    UMItag += querySequence[ location[0]:location[1] ]
+            else:
+                self.logFailure[i] += 1
                 UMItag = None
 
         return UMItag
 
-    def extract_UMIs(self):
-        """ loops through BAM file and uses alignments to identify sequences aligned to UMI contexts,
-        and appends these sequences to the query name for use by UMI_tools group,
-        and if a UMI is identified then the alignment will be written to self.BAMout
-        """
+    def log_columns(self):
+        return ['read_id', 'umi', 'success', 'failure'] + [f'umi_{i+1}_failure' for i,a in enumerate(self.UMI_contexts)]
 
-        BAMin = pysam.AlignmentFile(self.BAMin, 'rb')
-        BAMout = pysam.AlignmentFile(self.BAMout, 'wb', template=BAMin)
-
-        self.logList = []
-        columns = ['read_id', 'umi', 'success', 'failure'] + [f'umi_{i+1}_failure' for i,a in enumerate(self.UMI_contexts)]
-
-        count = 0
-        for BAMentry in BAMin.fetch(self.reference.id):
-            refAln = self.align_reference(BAMentry)
+    def extract_BAM_entries(self, BAMentries, BAMout, logFile):
+        """ loops through BAM entries and uses alignments to identify sequences aligned to UMI contexts,
+        and appends these sequences to the query name for use by UMI_group.py,
+        and if a UMI is identified then the alignment will be written to the open BAMout file.
+        Log rows are written to the open logFile in blocks, and the sums of the success and failure
+        columns of the log are returned as an array
+        """
+        logWriter = csv.writer(logFile, lineterminator='\n')
+        logCounts = np.zeros(len(self.log_columns())-2, dtype=int)
+        logList = []
+        for BAMentry in BAMentries:
             self.logFailure = np.zeros(len(self.UMI_contexts))
-            UMIs = self.id_UMIs(refAln, BAMentry)
+            UMIs = self.id_UMIs(BAMentry)
 
             if UMIs:
-                self.logList.append([BAMentry.qname, UMIs, 1, 0] + list(map(int, self.logFailure)))
+                logList.append([BAMentry.qname, UMIs, 1, 0] + list(map(int, self.logFailure)))
                 BAMentry.qname = BAMentry.qname + '_' + UMIs
                 BAMentry.set_tag('GN', '0', 'H')
                 BAMout.write(BAMentry)
             else:
-                self.logList.append([BAMentry.qname, '', 0, 1] + list(map(int, self.logFailure)))
-        
-        BAMin.close()
-        BAMout.close()
+                logList.append([BAMentry.qname, '', 0, 1] + list(map(int, self.logFailure)))
+
+            if len(logList) >= self.logBufferSize:
+                logCounts += np.array([row[2:] for row in logList]).sum(axis=0)
+                logWriter.writerows(logList)
+                logList = []
+
+        if logList:
+            logCounts += np.array([row[2:] for row in logList]).sum(axis=0)
+            logWriter.writerows(logList)
+        return logCounts
+
+    def extract_UMIs_chunk(self, BAMout, logOut, offset, count):
+        """extracts UMIs from a chunk of reads produced by chunk_BAM(), writing to a shard BAM file and a shard gzipped log
+        file without a header. Only reads aligned to the reference sequence are used, matching the reads returned by fetch()"""
+        with pysam.AlignmentFile(self.BAMin, 'rb') as BAMin, pysam.AlignmentFile(BAMout, 'wb', template=BAMin) as BAMoutFile, gzip.open(logOut, 'wt') as logFile:
+            referenceID = BAMin.get_tid(self.reference.id)
+            BAMentries = (BAMentry for BAMentry in iterate_BAM_chunk(BAMin, offset, count) if BAMentry.reference_id == referenceID)
+            return self.extract_BAM_entries(BAMentries, BAMoutFile, logFile)
+
+    def extract_UMIs(self, threads=1):
+        """extracts UMIs from all reads in self.BAMin that are aligned to the reference, writing reads with all UMIs identified to
+        self.BAMout, the result for each read to self.logOut, and the total counts to self.countsOut. If threads > 1, the BAM file is
+        split into one contiguous chunk of reads per process, and the shard BAM and log files of each process are then concatenated
+        in the order of the chunks, so that outputs contain the same reads in the same order as those produced using a single thread"""
+
+        # the log is written as concatenated gzip members, which form a valid gzip file, so that logs can be appended without recompression
+        with gzip.open(self.logOut, 'wt') as logFile:
+            csv.writer(logFile, lineterminator='\n').writerow(self.log_columns())
+
+        if threads > 1:
+            with pysam.AlignmentFile(self.BAMin, 'rb') as BAMin:
+                chunkSize = -(-(BAMin.mapped + BAMin.unmapped) // threads)
+            with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(self.BAMout))) as tempDir:
+                chunks = [(os.path.join(tempDir, f'{i}.bam'), os.path.join(tempDir, f'{i}.csv.gz'), offset, count) for i, (offset, count) in enumerate(chunk_BAM(self.BAMin, max(chunkSize, 1)))]
+                with mp.get_context('fork').Pool(threads, initializer=init_worker, initargs=(self,)) as pool:
+                    chunkCounts = pool.map(extract_chunk, chunks)
+                logCounts = np.sum(chunkCounts, axis=0) if chunkCounts else np.zeros(len(self.log_columns())-2, dtype=int)
+
+                with open(self.logOut, 'ab') as logFile:
+                    for _, shardLog, _, _ in chunks:
+                        with open(shardLog, 'rb') as shardLogFile:
+                            shutil.copyfileobj(shardLogFile, logFile)
+                shards = [shardBAM for shardBAM, _, _, _ in chunks]
+                if len(shards) == 1:
+                    shutil.move(shards[0], self.BAMout)
+                elif len(shards) > 1:
+                    pysam.cat('-o', self.BAMout, *shards)
+                else:
+                    with pysam.AlignmentFile(self.BAMin, 'rb') as BAMin:
+                        pysam.AlignmentFile(self.BAMout, 'wb', template=BAMin).close()
+        else:
+            with pysam.AlignmentFile(self.BAMin, 'rb') as BAMin, pysam.AlignmentFile(self.BAMout, 'wb', template=BAMin) as BAMout, gzip.open(self.logOut, 'at') as logFile:
+                logCounts = self.extract_BAM_entries(BAMin.fetch(self.reference.id), BAMout, logFile)
+
         pysam.index(self.BAMout)
 
-        logDF = pd.DataFrame(self.logList, columns=columns)
-        logDF.to_csv(self.logOut, index=False)
+        countsDF = pd.DataFrame([logCounts], columns=self.log_columns()[2:])
+        countsDF.to_csv(self.countsOut, index=False)
 
 
 if __name__ == '__main__':
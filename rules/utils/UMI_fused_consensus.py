@@ -0,0 +1,91 @@
+"""part of nanopype-MACE pipeline, written by Gordon Rix
+UMI_fused_consensus.py
+generates UMI consensus sequences within a single job, without writing intermediate batch fasta files.
+UMI groups are streamed from the UMI group BAM file by UMI_splitBAMs.py as soon as all of their reads have been encountered,
+and are queued for pre-medaka POA consensus generation by a pool of processes. Each POA consensus sequence and its subread
+alignments are written to disk for its batch of UMI groups, based on modulo of UMI ID, as soon as it is generated, so that
+subreads are not held in memory for the whole run. Each batch is then polished by medaka as in the UMI_consensus rule, and
+all batches are written to a single gzipped fasta file"""
+
+import gzip
+import os
+import pickle
+import shutil
+import medaka.medaka
+# the maple_smolecule module installed into medaka by the maple_medaka rule is cloned from the upstream repository, and may
+# not yet include the functions used here, so the copy in this directory is imported instead
+from maple_smolecule import Read, Subread, poa_results, prepare_args, read_reference, write_bam, medaka_consensus
+from UMI_splitBAMs import UMIBAMs
+
+def main():
+
+    ### Asign variables from config file and input
+    tag = snakemake.wildcards.tag
+    BAMin = snakemake.input.grouped
+    logIn = snakemake.input.log
+    alnRef = snakemake.input.alnRef
+    outDir = snakemake.output.outDir
+    seqsOut = snakemake.output.seqs
+    threads = snakemake.threads
+
+    # the fasta argument is required by the maple_smolecule parser, but reads are instead provided by the UMI group BAM file
+    args = medaka.medaka.medaka_parser().parse_args(['maple_smolecule', '--threads', str(threads), '--model', snakemake.params.model,
+                                                     '--depth', str(snakemake.params.depth)] + snakemake.params.flags.split() + [outDir, alnRef, BAMin])
+    args = prepare_args(args)
+
+    BAMs = UMIBAMs(tag, BAMin, logIn, outDir, snakemake.params.minimum, snakemake.params.maximum, snakemake.params.batches)
+    fused_consensus(BAMs, args, seqsOut, snakemake.params.queue_size)
+
+def fused_consensus(BAMs, args, seqsOut, queueSize):
+    """
+    generates consensus sequences for all UMI groups produced by a UMIBAMs object
+
+    args:
+        BAMs        - UMIBAMs object. Its tempDir is used as the output directory for medaka
+        args        - maple_smolecule arguments produced by prepare_args()
+        seqsOut     - gzipped fasta file to write all consensus sequences to
+        queueSize   - maximum number of UMI groups queued for POA consensus generation at once
+    """
+    reference = read_reference(args.reference)
+    UMIgroups = ((f'UMI-{ID}', [Subread(f'UMI-{ID}_{readName}', sequence.decode()) for readName, sequence in reads]) for ID, reads in BAMs.iterate_UMI_groups())
+    reads = Read.multi_from_groups(UMIgroups, reference, depth_filter=args.depth, length_filter=args.length)
+
+    # write the POA consensus and alignments of each UMI group to the medaka input files of its batch as they are generated. POA consensus
+    # sequences of each batch are polished separately by medaka, to avoid the memory-related error in medaka stitch. Only the name and length
+    # of each POA consensus sequence are kept in memory, to build the bam header of each batch
+    batches = {}    # batch index: [POA consensus fasta file, pickled alignments file, bam header reference sequences]
+    for rname, consensus, aligns in poa_results(reads, args.threads, method=args.method, queue_size=queueSize):
+        x = int(rname.split('-')[1]) % BAMs.batches
+        if x not in batches:
+            batchDir = os.path.join(BAMs.tempDir, f'batch{x}')
+            os.makedirs(batchDir, exist_ok=True)
+            batches[x] = [open(os.path.join(batchDir, 'poa.fasta'), 'w'), open(os.path.join(batchDir, 'alignments.pickle'), 'wb'), []]
+        spoaOut, alignmentsOut, SQ = batches[x]
+        spoaOut.write(f'>{rname}\n{consensus}\n')
+        pickle.dump(aligns, alignmentsOut)
+        SQ.append({'LN': len(consensus), 'SN': rname})
+    for spoaOut, alignmentsOut, _ in batches.values():
+        spoaOut.close()
+        alignmentsOut.close()
+
+    with gzip.open(seqsOut, 'wt') as fastaOut:
+        for x in sorted(batches):
+            batchDir = os.path.join(BAMs.tempDir, f'batch{x}')
+            bamFile = os.path.join(batchDir, 'subreads_to_spoa.bam')
+            write_bam(bamFile, load_alignments(os.path.join(batchDir, 'alignments.pickle')), {'HD': {'VN': 1.0}, 'SQ': batches[x][2]})
+            consensusFile = medaka_consensus(args, batchDir, bamFile, os.path.join(batchDir, 'poa.fasta'))
+            with open(consensusFile, 'r') as consensusIn:
+                shutil.copyfileobj(consensusIn, fastaOut)
+            shutil.rmtree(batchDir)
+
+def load_alignments(alignmentsFile):
+    """yields the alignments of each UMI group from a file of alignments pickled by fused_consensus(), one UMI group at a time"""
+    with open(alignmentsFile, 'rb') as alignmentsIn:
+        while True:
+            try:
+                yield pickle.load(alignmentsIn)
+            except EOFError:
+                return
+
+if __name__ == '__main__':
+    main()
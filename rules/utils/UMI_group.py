@@ -0,0 +1,325 @@
+"""part of nanopype-MACE pipeline, written by Gordon Rix
+UMI_group.py
+groups reads according to the UMI appended to each read name by UMI_extract.py, using the directional adjacency
+method of UMI-tools (Smith et al. 2017): a UMI is grouped with another UMI if the UMIs are within a maximum Hamming
+distance of each other and the UMI has at most about half as many reads as the other UMI. Writes a BAM file in which each read
+is tagged with the ID (UG) and UMI (BX) of its UMI group, and a tab separated log file of the group of each read,
+matching the outputs of `umi_tools group --per-gene --output-bam --group-out`.
+
+UMIs are stored as 2 bit packed integers. Pairs of UMIs within the maximum distance of each other are found using the
+same pigeonhole principle as barcode_index.py, and UMIs are then grouped separately within each set of UMIs connected by
+adjacency, so that both steps can be split among multiple processes"""
+
+import csv
+import multiprocessing as mp
+from array import array
+import numpy as np
+import pysam
+from barcode_index import barcodes_to_array, segment_bounds
+
+def main():
+
+    ### Asign variables from config file and input
+    BAMin = str(snakemake.input.bam)
+    BAMout = snakemake.output.bam
+    logOut = snakemake.output.log
+    maxDistance = snakemake.params.UMI_mismatches
+
+    grouper = UMIGrouper(BAMin, BAMout, logOut, maxDistance)
+    grouper.group(snakemake.threads)
+
+def init_worker(UMIclusterer):
+    """initializer for processes in a multiprocessing pool. Processes are forked, so the UMIClusterer
+    object is shared with the parent process rather than being copied for each chunk"""
+    global workerUMIclusterer
+    workerUMIclusterer = UMIclusterer
+
+def close_pairs_chunk(chunk):
+    """multiprocessing worker function, finds pairs of UMIs within the maximum distance for a chunk of candidate pairs"""
+    return workerUMIclusterer.close_pairs(*chunk)
+
+def directional_groups_chunk(chunk):
+    """multiprocessing worker function, groups the UMIs of a chunk of connected sets of UMIs"""
+    return workerUMIclusterer.directional_groups(*chunk)
+
+# ASCII code to 2 bit nucleotide code, with 255 for any character other than A, C, G, or T
+NT_TO_CODE = np.full(256, 255, dtype=np.uint8)
+NT_TO_CODE[np.frombuffer(b'ACGT', dtype=np.uint8)] = np.arange(4, dtype=np.uint8)
+
+# number of non-zero 2 bit fields in each possible byte, for counting mismatches between two packed UMIs
+MISMATCH_COUNT = np.array([sum(((byte >> shift) & 3) != 0 for shift in (0, 2, 4, 6)) for byte in range(256)], dtype=np.uint8)
+
+def pack_UMIs(UMIs):
+    """packs a list of equal length UMI strings into 64 bit words using 2 bits per nucleotide, with the same
+    packing as barcode_index.pack_sequence() for each block of up to 32 nucleotides
+
+    returns:
+        2D uint64 array with one row per UMI and one column per block of 32 nucleotides, and a boolean array
+            that is False for any UMI that contains characters other than A, C, G, or T
+    """
+    codes = NT_TO_CODE[barcodes_to_array(UMIs)]
+    length = codes.shape[1]
+    packed = np.zeros((len(UMIs), -(-length // 32)), dtype=np.uint64)
+    for word, start in enumerate(range(0, length, 32)):
+        for position in range(start, min(start+32, length)):
+            packed[:, word] = (packed[:, word] << np.uint64(2)) | (codes[:, position] & 3)
+    return packed, (codes != 255).all(axis=1)
+
+def segment_masks(length, segments):
+    """returns a 2D uint64 array with one row per segment, of bit masks that select the nucleotides of that segment from UMIs packed by pack_UMIs()"""
+    masks = np.zeros((len(segments), -(-length // 32)), dtype=np.uint64)
+    for i, (start, end) in enumerate(segments):
+        for position in range(start, end):
+            word = position // 32
+            wordLength = min(32, length - word*32)
+            masks[i, word] |= np.uint64(3 << 2*(wordLength - 1 - position % 32))
+    return masks
+
+class UMIClusterer:
+
+    def __init__(self, UMIs, counts, maxDistance, blockSize=1000000):
+        """
+        arguments:
+
+        UMIs            - list of unique UMI strings. UMIs are only compared to UMIs of the same length, and UMIs
+                            containing characters other than A, C, G, or T are not grouped with any other UMI
+        counts          - array of the number of reads with each UMI
+        maxDistance     - maximum Hamming distance between two UMIs for them to be grouped together
+        blockSize       - approximate number of candidate pairs of UMIs compared at once by each process
+        """
+        self.UMIs = UMIs
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.maxDistance = maxDistance
+        self.blockSize = blockSize
+
+        # UMIs are processed in descending order of count, with UMIs of equal count in the order they are provided
+        self.order = np.lexsort((np.arange(len(UMIs)), -self.counts))
+
+        # for each set of equal length UMIs, the indices of the UMIs in the set, the packed UMIs, and for each segment the
+        # order of UMIs sorted by the segment, the position after the last UMI that shares the segment, and the segment's bit mask
+        self.lengthSets = []
+        lengths = np.fromiter((len(UMI) for UMI in UMIs), dtype=np.int64, count=len(UMIs))
+        for length in np.unique(lengths):
+            indices = np.flatnonzero(lengths == length)
+            if length == 0:
+                continue
+            packed, valid = pack_UMIs([UMIs[i] for i in indices])
+            indices, packed = indices[valid], packed[valid]
+            if len(indices) < 2:
+                continue
+            # if UMIs are too short to be split into maxDistance+1 segments, all UMIs of this length are compared, as a single empty segment
+            segments = segment_bounds(length, maxDistance+1) if maxDistance+1 <= length else [(0, 0)]
+            masks = segment_masks(length, segments)
+            segmentOrders = []
+            for mask in masks:
+                keys = packed & mask
+                order = np.lexsort(keys.T[::-1])
+                sortedKeys = keys[order]
+                starts = np.flatnonzero(np.concatenate([[True], (sortedKeys[1:] != sortedKeys[:-1]).any(axis=1)]))
+                ends = np.append(starts[1:], len(order))
+                segmentOrders.append((order, np.repeat(ends, ends-starts)))
+            self.lengthSets.append((indices, packed, masks, segmentOrders))
+
+    def pair_chunks(self):
+        """splits all candidate pairs of UMIs, which share at least one segment, into chunks of about self.blockSize pairs
+
+        returns:
+            list of (length set index, segment index, start, end) tuples, where start and end are positions in the
+                segment's sorted order of UMIs. Each UMI in the chunk is paired with all UMIs after it that share the segment
+        """
+        chunks = []
+        for setIndex, (_, _, _, segmentOrders) in enumerate(self.lengthSets):
+            for segmentIndex, (order, groupEnds) in enumerate(segmentOrders):
+                pairCounts = np.cumsum(groupEnds - np.arange(len(order)) - 1)
+                if pairCounts[-1] == 0:
+                    continue
+                bounds = np.searchsorted(pairCounts, np.arange(self.blockSize, pairCounts[-1], self.blockSize), side='right')
+                bounds = np.unique(np.concatenate([[0], bounds, [len(order)]]))
+                chunks.extend((setIndex, segmentIndex, int(start), int(end)) for start, end in zip(bounds[:-1], bounds[1:]))
+        return chunks
+
+    def close_pairs(self, setIndex, segmentIndex, start, end):
+        """compares a chunk of candidate pairs of UMIs produced by pair_chunks()
+
+        returns:
+            two arrays of the UMI indices i and j of each pair of UMIs within self.maxDistance of each other. Each pair is
+                only returned for the first segment that the UMIs share, so that pairs are not returned more than once
+        """
+        indices, packed, masks, segmentOrders = self.lengthSets[setIndex]
+        order, groupEnds = segmentOrders[segmentIndex]
+        positions = np.arange(start, end)
+        partners = groupEnds[start:end] - positions - 1
+        i = np.repeat(positions, partners)
+        j = i + 1 + np.arange(len(i)) - np.repeat(np.cumsum(partners) - partners, partners)
+        i, j = order[i], order[j]
+        mismatches = packed[i] ^ packed[j]
+        distances = MISMATCH_COUNT[mismatches.view(np.uint8)].reshape(len(i), packed.shape[1]*8).sum(axis=1)
+        close = distances <= self.maxDistance
+        for mask in masks[:segmentIndex]:
+            close &= (mismatches & mask).any(axis=1)
+        return indices[i[close]], indices[j[close]]
+
+    def adjacency(self, pairs):
+        """builds the directional adjacency graph from pairs of UMIs within self.maxDistance. A UMI with count a is connected to a UMI
+        with count b if a >= 2b-1. Stores the graph in compressed sparse row form, as self.edgeStarts and self.edgeTargets
+
+        returns:
+            arrays of source and target UMI indices of all edges
+        """
+        i, j = pairs
+        counts_i, counts_j = self.counts[i], self.counts[j]
+        forward = counts_i >= 2*counts_j - 1
+        reverse = counts_j >= 2*counts_i - 1
+        sources = np.concatenate([i[forward], j[reverse]])
+        targets = np.concatenate([j[forward], i[reverse]])
+        edgeOrder = np.argsort(sources, kind='stable')
+        self.edgeTargets = targets[edgeOrder]
+        self.edgeStarts = np.concatenate([[0], np.cumsum(np.bincount(sources, minlength=len(self.UMIs)))])
+        return sources, targets
+
+    def connected_sets(self, sources, targets):
+        """labels each UMI with the lowest index of all UMIs connected to it by edges in either direction, by propagating labels along
+        edges and then following each label to its own label, until no labels change"""
+        labels = np.arange(len(self.UMIs))
+        while True:
+            previous = labels
+            labels = labels.copy()
+            np.minimum.at(labels, sources, labels[targets])
+            np.minimum.at(labels, targets, labels[sources])
+            labels = labels[labels]
+            if np.array_equal(labels, previous):
+                return labels
+
+    def directional_groups(self, start, end):
+        """groups the UMIs at positions start to end of self.groupOrder. Starting from the UMI with the highest count that is not yet grouped,
+        all ungrouped UMIs that can be reached from it by following edges are grouped with it, as in UMI-tools. Positions must not split
+        a connected set of UMIs
+
+        returns:
+            list of the index of the UMI that leads the group of each UMI
+        """
+        edgeStarts, edgeTargets = self.edgeStarts, self.edgeTargets
+        leads = {}
+        for UMI in self.groupOrder[start:end].tolist():
+            if UMI in leads:
+                continue
+            leads[UMI] = UMI
+            queue = [UMI]
+            while queue:
+                node = queue.pop()
+                for neighbour in edgeTargets[edgeStarts[node]:edgeStarts[node+1]].tolist():
+                    if neighbour not in leads:
+                        leads[neighbour] = UMI
+                        queue.append(neighbour)
+        return [leads[UMI] for UMI in self.groupOrder[start:end].tolist()]
+
+    def group_chunks(self, groupLabels, chunkCount):
+        """splits positions in self.groupOrder into about chunkCount chunks of similar size, without splitting any connected set of UMIs
+
+        args:
+            groupLabels     - array of the connected set label of each UMI in self.groupOrder
+
+        returns:
+            list of (start, end) tuples of positions in self.groupOrder
+        """
+        if len(groupLabels) == 0:
+            return []
+        setStarts = np.flatnonzero(np.concatenate([[True], groupLabels[1:] != groupLabels[:-1]]))
+        targets = np.linspace(0, len(groupLabels), chunkCount+1)[1:-1]
+        bounds = setStarts[np.minimum(np.searchsorted(setStarts, targets), len(setStarts)-1)]
+        bounds = np.unique(np.concatenate([[0], bounds, [len(groupLabels)]]))
+        return [(int(start), int(end)) for start, end in zip(bounds[:-1], bounds[1:])]
+
+    def map_chunks(self, workerFunction, chunks, threads):
+        """applies a multiprocessing worker function to each chunk. If threads > 1, a new pool of processes is forked
+        for each call, so that the processes share the current state of this object, including any results of previous steps"""
+        if threads > 1 and len(chunks) > 1:
+            with mp.get_context('fork').Pool(min(threads, len(chunks)), initializer=init_worker, initargs=(self,)) as pool:
+                return pool.map(workerFunction, chunks)
+        init_worker(self)
+        return [workerFunction(chunk) for chunk in chunks]
+
+    def cluster(self, threads=1):
+        """groups all UMIs, using the given number of processes
+
+        returns:
+            array of the index of the UMI that leads the group of each UMI. The lead UMI is the UMI with the highest count in the group
+        """
+        chunks = self.pair_chunks()
+        closePairs = self.map_chunks(close_pairs_chunk, chunks, threads)
+        pairs = [np.concatenate([np.zeros(0, dtype=np.int64)] + [pair[k] for pair in closePairs]) for k in (0, 1)]
+        sources, targets = self.adjacency(pairs)
+
+        # only connected sets of more than one UMI need to be grouped, and each set is grouped independently
+        labels = self.connected_sets(sources, targets)
+        setSizes = np.bincount(labels, minlength=len(self.UMIs))
+        connected = self.order[setSizes[labels[self.order]] > 1]
+        self.groupOrder = connected[np.argsort(labels[connected], kind='stable')]
+        groupChunks = self.group_chunks(labels[self.groupOrder], threads*4)
+        groupLeads = self.map_chunks(directional_groups_chunk, groupChunks, threads)
+
+        leads = np.arange(len(self.UMIs))
+        leads[self.groupOrder] = np.array([lead for chunkLeads in groupLeads for lead in chunkLeads], dtype=np.int64)
+        return leads
+
+class UMIGrouper:
+
+    def __init__(self, BAMin, BAMout, logOut, maxDistance, logBufferSize=100000):
+        """
+        arguments:
+
+        BAMin           - BAM file output by UMI_extract.py, with the UMI of each read appended to the read name after the last '_'
+        BAMout          - BAM file to write all reads to, tagged with the ID (UG) and UMI (BX) of their UMI group
+        logOut          - tab separated file of the UMI group of each read, with the same columns as the `umi_tools group` log
+        maxDistance     - maximum Hamming distance between two UMIs for them to be grouped together
+        logBufferSize   - number of log rows held in memory before they are written
+        """
+        self.BAMin = BAMin
+        self.BAMout = BAMout
+        self.logOut = logOut
+        self.maxDistance = maxDistance
+        self.logBufferSize = logBufferSize
+
+    def read_UMIs(self):
+        """returns a list of the unique UMIs in self.BAMin, in the order they first appear, and an array of the index of the UMI of each read"""
+        UMIindex = {}
+        readUMIs = array('q')
+        with pysam.AlignmentFile(self.BAMin, 'rb') as BAMin:
+            for BAMentry in BAMin.fetch(until_eof=True):
+                UMI = BAMentry.query_name.rsplit('_', 1)[-1]
+                readUMIs.append(UMIindex.setdefault(UMI, len(UMIindex)))
+        return list(UMIindex), np.frombuffer(readUMIs, dtype=np.int64) if len(readUMIs) else np.zeros(0, dtype=np.int64)
+
+    def group(self, threads=1):
+        """groups the reads of self.BAMin by UMI, and writes the grouped reads to self.BAMout and the group of each read to self.logOut.
+        Group IDs are assigned in descending order of the read count of each group's lead UMI"""
+        UMIs, readUMIs = self.read_UMIs()
+        counts = np.bincount(readUMIs, minlength=len(UMIs))
+        clusterer = UMIClusterer(UMIs, counts, self.maxDistance)
+        leads = clusterer.cluster(threads)
+
+        groupCounts = np.bincount(leads, weights=counts, minlength=len(UMIs)).astype(np.int64)
+        isLead = leads == np.arange(len(UMIs))
+        groupIDs = np.zeros(len(UMIs), dtype=np.int64)
+        groupIDs[clusterer.order[isLead[clusterer.order]]] = np.arange(isLead.sum())
+        finalUMIs, finalCounts, finalIDs = leads.tolist(), groupCounts[leads].tolist(), groupIDs[leads].tolist()
+        counts = counts.tolist()
+
+        with pysam.AlignmentFile(self.BAMin, 'rb') as BAMin, pysam.AlignmentFile(self.BAMout, 'wb', template=BAMin) as BAMout, open(self.logOut, 'w') as logFile:
+            logWriter = csv.writer(logFile, delimiter='\t', lineterminator='\n')
+            logWriter.writerow(['read_id', 'contig', 'position', 'gene', 'umi', 'umi_count', 'final_umi', 'final_umi_count', 'unique_id'])
+            logList = []
+            for BAMentry, UMI in zip(BAMin.fetch(until_eof=True), readUMIs.tolist()):
+                finalUMI = UMIs[finalUMIs[UMI]]
+                BAMentry.set_tag('UG', finalIDs[UMI], 'i')
+                BAMentry.set_tag('BX', finalUMI, 'Z')
+                BAMout.write(BAMentry)
+                gene = BAMentry.get_tag('GN') if BAMentry.has_tag('GN') else 'NA'
+                logList.append([BAMentry.query_name, BAMentry.reference_name, BAMentry.reference_start, gene, UMIs[UMI], counts[UMI], finalUMI, finalCounts[UMI], finalIDs[UMI]])
+                if len(logList) >= self.logBufferSize:
+                    logWriter.writerows(logList)
+                    logList = []
+            logWriter.writerows(logList)
+
+if __name__ == '__main__':
+    main()
@@ -13,7 +13,7 @@ import pysam
 import os
 import shutil
 import datetime
-import bisect
+import heapq
 from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
 from Bio import SeqIO
@@ -56,11 +56,12 @@ class UMIBAMs:
         self.maximum = maximum
         self.batches = batches
 
-    def split(self):
+    def select_UMI_groups(self):
         """
-        determines which UMI groups to generate consensus sequences for based upon minimum and maximum set read count then,
-        for each UMI group, loops through the input BAM file and finds all the BAM entries belonging
-        to that UMI group, and writes the reads as a BAM file, then sorts the BAM file according to the 'UG' tag
+        determines which UMI groups to generate consensus sequences for based upon the minimum set read count
+
+        returns:
+            dictionary of the number of reads in the input BAM file for each selected UMI ID, as recorded in the UMI group log
         """
 
         logDF = pd.read_csv(self.logIn, sep='\t')
@@ -71,72 +72,70 @@ class UMIBAMs:
         elif len(UMI_groups_above_threshold) < 1000:
             print('[WARNING] Fewer than 1000 reads with UMI counts above UMI threshold. Threshold may be too high or sequencing run was of poor quality. Examine `plots/{self.tag}_UMIgroup-distribution` and plots in `plots/nanoplot/` directory to determine if there is a problem.')
 
-        UMI_groups_above_threshold = UMI_groups_above_threshold.drop_duplicates(subset=['unique_id']).reset_index()
-        # add a column to batch sequences into groups to minimize looping through BAM file to find sequences, without putting the whole BAM file in memory
-        batchSize = 100000
-        UMI_groups_above_threshold['batch'] = UMI_groups_above_threshold.apply( lambda row: int(row['index']/batchSize), axis=1 )
-        
+        UMI_IDs = UMI_groups_above_threshold.drop_duplicates(subset=['unique_id'])['unique_id']
+        readCounts = logDF['unique_id'].value_counts()
+        return dict(zip(UMI_IDs.tolist(), readCounts[UMI_IDs].tolist()))
+
+    def iterate_UMI_groups(self):
+        """
+        in a single pass through the input BAM file, looks up the UMI group of each BAM entry by its 'UG' tag and keeps up to
+        the maximum number of reads for each selected UMI group. Each UMI group is yielded as soon as all of its reads have been
+        encountered, so that only UMI groups with reads remaining in the BAM file are kept in memory
+
+        yields:
+            UMI ID and list of (read name, sequence) tuples of the kept reads of the UMI group, in order of ascending quality, with sequences as bytes
+        """
+
+        # map each UMI ID to the number of its reads that have not yet been encountered, so each BAM entry is routed with a single hash lookup
+        UMI_remainingReadsDict = self.select_UMI_groups()
+
+        # for each UMI group, one min heap of reads per strand, (forward, reverse). Each read is stored as a (mean Qscore, -read number, read name, sequence) tuple,
+            # so the first read of each heap is the lowest quality read of that strand, or the most recently encountered of equally low quality reads
+        UMI_readHeapsDict = {}
+
+        with pysam.AlignmentFile(self.BAMin, 'rb') as BAMin:
+            for readNumber, BAMentry in enumerate(BAMin):
+                ID = BAMentry.get_tag('UG')
+                if ID not in UMI_remainingReadsDict:
+                    continue
+                readHeaps = UMI_readHeapsDict.setdefault(ID, ([], []))
+                BAMmeanQscore = np.mean(BAMentry.query_qualities) if BAMentry.query_qualities is not None else 0
+                heapq.heappush(readHeaps[BAMentry.is_reverse], (BAMmeanQscore, -readNumber, BAMentry.query_name, BAMentry.query_sequence.encode()))
+
+                # once the maximum # of reads have been reached, the lowest quality read of one strand is removed as more reads are encountered
+                    # to approach a strand bias of 0 and to increase the minimum average read quality score
+                forwardHeap, reverseHeap = readHeaps
+                if len(forwardHeap) + len(reverseHeap) > self.maximum:
+                    heapq.heappop(reverseHeap if len(forwardHeap) < len(reverseHeap) else forwardHeap)
+
+                UMI_remainingReadsDict[ID] -= 1
+                if UMI_remainingReadsDict[ID] == 0:
+                    del UMI_remainingReadsDict[ID]
+                    yield ID, self.sorted_reads(UMI_readHeapsDict.pop(ID))
+
+        # UMI groups with fewer reads in the BAM file than recorded in the log
+        for ID, readHeaps in UMI_readHeapsDict.items():
+            yield ID, self.sorted_reads(readHeaps)
+
+    @staticmethod
+    def sorted_reads(readHeaps):
+        return [(readName, sequence) for _, _, readName, sequence in sorted(readHeaps[0] + readHeaps[1])]
+
+    def split(self):
+        """
+        writes the reads of each selected UMI group to the fasta file for its batch, based on modulo of UMI ID, in order of
+        ascending quality, with UMI groups in the order that all of their reads have been encountered in the BAM file
+        """
+
         shutil.rmtree(self.tempDir, ignore_errors=True)
         os.mkdir(self.tempDir)
 
-        with pysam.AlignmentFile(self.BAMin, 'rb') as BAMin:
+        splitFastaDict = {x: open(f'{self.tempDir}/batch{x}.fasta', 'wb') for x in range(0, self.batches)}
+        for ID, reads in self.iterate_UMI_groups():
+            x = int(ID)%self.batches
+            for readName, sequence in reads:
+                splitFastaDict[x].write(f'>UMI-{ID}_{readName}\n'.encode() + sequence + b'\n')
 
-            # open all BAM output files for writing
-            splitFastaDict = {}
-            for x in range(0, self.batches):
-                fastaOutName = f'{self.tempDir}/batch{x}.fasta'
-                splitFastaDict[x] = open(fastaOutName, 'w')
-
-            # loop through the BAM file once per batch of sequences. note that this is not the same as the batches of output files
-            for batch_index in range(0, UMI_groups_above_threshold['batch'].max()+1):
-
-                batch_DF = UMI_groups_above_threshold[UMI_groups_above_threshold['batch']==batch_index]
-                batch_UMI_IDs = list(batch_DF['unique_id'])
-                UMI_BAMbatchDict = {}
-                UMI_strandTrackDict = {}     # dict to keep track of how many fwd/rvs strands have been encountered to aim for similar amounts to reduce systematic errors from strand bias. fwd recorded as 1, rvs recorded as -1 such that the sum of the list indicates the bias
-                UMI_qualityTrackDict = {}    # dict to keep track of average quality scores of reads
-
-                for BAMentry in BAMin:
-                    ID = BAMentry.get_tag('UG')
-                    if ID in batch_UMI_IDs:
-                        if ID not in UMI_BAMbatchDict:
-                            UMI_BAMbatchDict[ID] = []
-                            UMI_strandTrackDict[ID] = []
-                            UMI_qualityTrackDict[ID] = []
-                        if BAMentry.query_qualities is not None:
-                            BAMmeanQscore = np.mean(BAMentry.query_qualities)
-                            insertIndex = bisect.bisect_left(UMI_qualityTrackDict[ID], BAMmeanQscore) # grow list of BAM entries, Qscores, and strand tracking in order of Qscores so that lowest Qscore sequences get removed first
-                        else:
-                            insertIndex, BAMmeanQscore = 0, 0
-                        UMI_BAMbatchDict[ID].insert(insertIndex, BAMentry)
-                        UMI_qualityTrackDict[ID].insert(insertIndex, BAMmeanQscore)
-                        if BAMentry.is_reverse:
-                            UMI_strandTrackDict[ID].insert(insertIndex, -1)
-                        else:
-                            UMI_strandTrackDict[ID].insert(insertIndex, 1)
-
-                        # UMI IDs will be removed from list if the maximum # of reads have been reached and the difference
-                            # in counts of reads of one strand vs another is either 0 (for even # of maximum reads) or 1 (for odd # of maximum reads)
-                            # As more reads over the maximum are encountered, reads from the left are removed to approach a strand bias of 0 and to increase the minimum average read quality score
-                        UMI_group_strandBias = sum(UMI_strandTrackDict[ID])
-                        if len(UMI_BAMbatchDict[ID]) > self.maximum:
-                            if UMI_group_strandBias < 0:
-                                removeIndex = UMI_strandTrackDict[ID].index(-1) # index searches from the left so lowest quality score with desired strandedness will be removed first
-                                UMI_BAMbatchDict[ID].pop(removeIndex)
-                                UMI_strandTrackDict[ID].pop(removeIndex)
-                                UMI_qualityTrackDict[ID].pop(removeIndex)
-                            elif UMI_group_strandBias >= 0:
-                                removeIndex = UMI_strandTrackDict[ID].index(1)
-                                UMI_BAMbatchDict[ID].pop(removeIndex)
-                                UMI_strandTrackDict[ID].pop(removeIndex)
-                                UMI_qualityTrackDict[ID].pop(removeIndex)
-                BAMin.reset()  # allows for looping through again for the next batch
-
-                for ID, UMIgroupBAMentries in UMI_BAMbatchDict.items():
-                    x = int(ID)%self.batches
-                    for BAMentry in UMIgroupBAMentries:
-                        splitFastaDict[x].write(f'>UMI-{ID}_{BAMentry.qname}\n{BAMentry.query_sequence}\n')
-                
         # close output files
         for key in splitFastaDict:
             splitFastaDict[key].close()
@@ -0,0 +1,95 @@
+"""counting of the barcodes observed in a set of reads, for generating barcode fasta files from the most frequently
+    observed barcodes. BarcodeCounter stores each observed barcode as a 2 bit packed integer and counts all barcodes at
+    once with NumPy, and SpaceSavingCounter approximately counts only the most frequent barcodes using the Space-Saving
+    algorithm (Metwally et al. 2005), so that memory is bounded regardless of the number of distinct barcodes observed"""
+
+import heapq
+from array import array
+import numpy as np
+
+from barcode_index import NT_TO_BASE4
+
+BASE4_TO_NT = str.maketrans('0123', 'ACGT')
+
+def unpack_sequence(packed, length):
+    """inverse of barcode_index.pack_sequence(), returns the nucleotide sequence of a packed integer"""
+    return np.base_repr(int(packed), 4).zfill(length).translate(BASE4_TO_NT)
+
+class BarcodeCounter:
+
+    def __init__(self, length):
+        """
+        arguments:
+
+        length      - length of all barcodes that will be counted
+        """
+        self.length = length
+        self.packed = length <= 32          # barcodes longer than 32 nt don't fit into 64 bits, and are instead counted as strings
+        self.values = array('Q')
+        self.counts = {}
+
+    def add(self, barcode):
+        """adds a single observation of a barcode. Raises ValueError if the barcode contains any characters other
+        than A, C, G, or T"""
+        base4 = barcode.translate(NT_TO_BASE4)
+        packed = int(base4, 4)
+        if self.packed:
+            self.values.append(packed)
+        else:
+            self.counts[barcode] = self.counts.get(barcode, 0) + 1
+
+    def most_common(self):
+        """yields (barcode, count) tuples for all observed barcodes in descending order of count, with barcodes
+        of equal count ordered by first observation"""
+        if not self.packed:
+            yield from sorted(self.counts.items(), key=lambda item: -item[1])
+            return
+        values = np.frombuffer(self.values, dtype=np.uint64) if len(self.values) else np.zeros(0, dtype=np.uint64)
+        unique, firstIndex, counts = np.unique(values, return_index=True, return_counts=True)
+        order = np.lexsort((firstIndex, -counts))
+        for packed, count in zip(unique[order], counts[order]):
+            yield unpack_sequence(packed, self.length), int(count)
+
+class SpaceSavingCounter:
+
+    def __init__(self, capacity):
+        """
+        arguments:
+
+        capacity    - maximum number of distinct barcodes counted at once. Any barcode observed more than
+                        (number of observations / capacity) times is guaranteed to be counted, and the count of
+                        each barcode is overestimated by at most the count of the barcode it replaced
+        """
+        self.capacity = capacity
+        self.counts = {}        # barcode: [count, index of first observation]
+        self.heap = []          # (count, barcode) tuples, updated lazily, so a barcode's entry may hold an outdated lower count
+        self.observations = 0
+
+    def add(self, barcode):
+        """adds a single observation of a barcode. Raises ValueError if the barcode contains any characters other
+        than A, C, G, or T, to match BarcodeCounter"""
+        int(barcode.translate(NT_TO_BASE4), 4)
+        entry = self.counts.get(barcode)
+        if entry is not None:
+            entry[0] += 1
+        elif len(self.counts) < self.capacity:
+            self.counts[barcode] = [1, self.observations]
+            heapq.heappush(self.heap, (1, barcode))
+        else:
+            # replace the barcode with the lowest count, refreshing entries whose counts have changed since they were pushed
+            while True:
+                minCount, minBarcode = self.heap[0]
+                currentCount = self.counts[minBarcode][0]
+                if currentCount == minCount:
+                    break
+                heapq.heapreplace(self.heap, (currentCount, minBarcode))
+            del self.counts[minBarcode]
+            self.counts[barcode] = [minCount+1, self.observations]
+            heapq.heapreplace(self.heap, (minCount+1, barcode))
+        self.observations += 1
+
+    def most_common(self):
+        """yields (barcode, count) tuples for all counted barcodes in descending order of count, with barcodes
+        of equal count ordered by first observation"""
+        for barcode, (count, _) in sorted(self.counts.items(), key=lambda item: (-item[1][0], item[1][1])):
+            yield barcode, count
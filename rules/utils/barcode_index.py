@@ -0,0 +1,352 @@
+"""vectorized comparison of sets of equal length barcodes. Barcodes are stored as 2D NumPy arrays of
+    character codes, and pairs of barcodes within a Hamming distance d of each other are found using the
+    pigeonhole principle: if barcodes are split into d+1 segments, any two barcodes within distance d must be
+    identical in at least one segment. Only pairs sharing a segment are compared, in blocks, so that large
+    barcode sets can be validated without comparing all pairs. The same principle is used by HammingIndex
+    for error tolerant barcode lookup, with segments stored as 2 bit packed integers in sorted arrays"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+def barcodes_to_array(barcodes):
+    """converts a list of equal length barcode strings to a 2D uint8 array of ASCII codes, one row per barcode"""
+    if len(barcodes) == 0:
+        return np.zeros((0, 0), dtype=np.uint8)
+    return np.frombuffer(''.join(barcodes).encode('ascii'), dtype=np.uint8).reshape(len(barcodes), -1)
+
+def segment_bounds(length, segments):
+    """splits a barcode length into the given number of contiguous segments of near equal length,
+    returns a list of (start, end) tuples"""
+    edges = np.linspace(0, length, segments+1).round().astype(int)
+    return [(edges[i], edges[i+1]) for i in range(segments)]
+
+def candidate_pairs(barcodeArray, segments, blockSize=1000000):
+    """yields blocks of pairs of rows of a barcode array that are identical in at least one segment. A pair that is
+    identical in more than one segment is yielded once for each of these segments
+
+    args:
+        barcodeArray    - 2D array of barcodes from barcodes_to_array()
+        segments        - list of (start, end) segment bounds from segment_bounds()
+        blockSize       - approximate number of pairs to yield at once
+
+    yields:
+        index of the shared segment, and two int64 arrays of row indices i and j for each candidate pair, with i < j
+    """
+    for segmentIndex, (start, end) in enumerate(segments):
+        _, groups = np.unique(barcodeArray[:, start:end], axis=0, return_inverse=True)
+        groups = groups.reshape(-1)
+        order = np.argsort(groups, kind='stable')
+        boundaries = np.flatnonzero(np.diff(groups[order])) + 1
+        I, J, blockPairs = [], [], 0
+        for members in np.split(order, boundaries):
+            if len(members) < 2:
+                continue
+            i, j = np.triu_indices(len(members), k=1)
+            I.append(members[i])
+            J.append(members[j])
+            blockPairs += len(i)
+            if blockPairs >= blockSize:
+                yield segmentIndex, np.concatenate(I), np.concatenate(J)
+                I, J, blockPairs = [], [], 0
+        if blockPairs:
+            yield segmentIndex, np.concatenate(I), np.concatenate(J)
+
+def find_close_barcode_pairs(barcodes, maxDistance, blockSize=1000000):
+    """finds all pairs of barcodes within Hamming distance maxDistance of each other, including identical barcodes
+
+    args:
+        barcodes        - list of equal length barcode strings
+        maxDistance     - maximum Hamming distance for a pair of barcodes to be reported
+        blockSize       - approximate number of candidate pairs to compare at once
+
+    returns:
+        list of (barcode1, barcode2, distance) tuples, with barcode1 appearing before barcode2 in the list of barcodes
+    """
+    barcodeArray = barcodes_to_array(barcodes)
+    n, length = barcodeArray.shape
+    closePairs = []
+    if maxDistance + 1 > length:    # segments can't be formed, all pairs are candidates
+        I, J = np.triu_indices(n, k=1)
+        blocks = ((0, I[b:b+blockSize], J[b:b+blockSize]) for b in range(0, len(I), blockSize))
+        segments = [(0, length)]
+    else:
+        segments = segment_bounds(length, maxDistance+1)
+        blocks = candidate_pairs(barcodeArray, segments, blockSize)
+    for segmentIndex, i, j in blocks:
+        mismatches = barcodeArray[i] != barcodeArray[j]
+        distances = mismatches.sum(axis=1)
+        close = distances <= maxDistance
+        # only keep each pair for the first segment that it shares, so that pairs are not reported more than once
+        for start, end in segments[:segmentIndex]:
+            close &= mismatches[:, start:end].any(axis=1)
+        closePairs.extend(zip(i[close].tolist(), j[close].tolist(), distances[close].tolist()))
+    closePairs.sort()
+    return [(barcodes[i], barcodes[j], distance) for i, j, distance in closePairs]
+
+NT_TO_BASE4 = str.maketrans('ACGT', '0123')
+
+def pack_sequence(sequence):
+    """packs a nucleotide sequence of at most 32 nucleotides into an integer using 2 bits per nucleotide.
+    Raises ValueError if the sequence contains any characters other than A, C, G, or T"""
+    if len(sequence) == 0:
+        return 0
+    return int(sequence.translate(NT_TO_BASE4), 4)
+
+class HammingIndex:
+
+    def __init__(self, barcodes, maxDistance):
+        """
+        Error tolerant lookup of barcodes. Each barcode is split into at least maxDistance+1 segments, and for each segment
+        the 2 bit packed integers of that segment of all barcodes are stored as a sorted NumPy array. Any sequence within
+        maxDistance of a barcode must match it exactly in at least one segment, so candidates are found by searching each
+        segment array for the corresponding segment of the sequence, and are then verified by Hamming distance
+
+        arguments:
+
+        barcodes        - list of equal length barcode strings, containing only A, C, G, and T
+        maxDistance     - maximum Hamming distance between a sequence and a barcode for the sequence to be assigned to the barcode
+        """
+        barcodes = list(barcodes)
+        self.maxDistance = maxDistance
+        nonACGT = [bc for bc in barcodes if set(bc) - set('ACGT')]
+        if nonACGT:
+            raise ValueError('Barcodes used with a hammingDistance greater than 0 may only contain A, C, G, and T:\n' + '\n'.join(nonACGT))
+        self.length = len(barcodes[0]) if barcodes else 0
+        segmentCount = max(maxDistance+1, -(-self.length // 32))
+        if segmentCount > self.length:    # segments can't be formed, all barcodes are candidates for all sequences
+            self.segments = []
+        else:
+            self.segments = segment_bounds(self.length, segmentCount)
+        self.barcodeArray = barcodes_to_array(barcodes)
+        self.segmentKeys = []
+        self.segmentOrders = []
+        for start, end in self.segments:
+            keys = np.array([pack_sequence(bc[start:end]) for bc in barcodes], dtype=np.uint64)
+            order = np.argsort(keys, kind='stable')
+            self.segmentKeys.append(keys[order])
+            self.segmentOrders.append(order.astype(np.int32))
+
+    def save(self, directory):
+        """saves the index to a new directory as .npy files that can be memory mapped by load(). The directory is written
+        under a temporary name and then renamed, so that an index that is being saved is never loaded. If the directory
+        already exists, e.g. because the same index was saved by another process, the index is not saved"""
+        parentDir = os.path.dirname(os.path.abspath(directory))
+        os.makedirs(parentDir, exist_ok=True)
+        tempDir = tempfile.mkdtemp(dir=parentDir)
+        with open(os.path.join(tempDir, 'index.json'), 'w') as f:
+            json.dump({'maxDistance':self.maxDistance, 'length':self.length, 'segments':[[int(start), int(end)] for start, end in self.segments]}, f)
+        np.save(os.path.join(tempDir, 'barcodes.npy'), self.barcodeArray)
+        for i, (keys, order) in enumerate(zip(self.segmentKeys, self.segmentOrders)):
+            np.save(os.path.join(tempDir, f'segment{i}_keys.npy'), keys)
+            np.save(os.path.join(tempDir, f'segment{i}_order.npy'), order)
+        try:
+            os.rename(tempDir, directory)
+        except OSError:
+            shutil.rmtree(tempDir)
+
+    @classmethod
+    def load(cls, directory):
+        """loads an index saved by save(). Arrays are memory mapped rather than read, so loading takes the same time
+        regardless of the number of barcodes, and the pages of a cached index are shared by all processes that load it"""
+        index = cls.__new__(cls)
+        with open(os.path.join(directory, 'index.json')) as f:
+            meta = json.load(f)
+        index.maxDistance = meta['maxDistance']
+        index.length = meta['length']
+        index.segments = [tuple(segment) for segment in meta['segments']]
+        index.barcodeArray = np.load(os.path.join(directory, 'barcodes.npy'), mmap_mode='r')
+        index.segmentKeys = [np.load(os.path.join(directory, f'segment{i}_keys.npy'), mmap_mode='r') for i in range(len(index.segments))]
+        index.segmentOrders = [np.load(os.path.join(directory, f'segment{i}_order.npy'), mmap_mode='r') for i in range(len(index.segments))]
+        return index
+
+    def candidates(self, base4):
+        """returns an array of indices of barcodes that share at least one segment with a sequence, provided as
+        a string of base 4 digits produced by translating the sequence with NT_TO_BASE4. Barcodes that share
+        multiple segments with the sequence are included more than once"""
+        if not self.segments:
+            return np.arange(len(self.barcodeArray))
+        candidates = []
+        for (start, end), keys, order in zip(self.segments, self.segmentKeys, self.segmentOrders):
+            key = np.uint64(int(base4[start:end], 4))
+            candidates.append(order[keys.searchsorted(key, side='left'):keys.searchsorted(key, side='right')])
+        return np.concatenate(candidates)
+
+    def lookup(self, sequence):
+        """returns the barcode within maxDistance of the sequence, or None if there is no such barcode or if the
+        sequence contains characters other than A, C, G, or T. If multiple barcodes are within maxDistance,
+        the barcode that appears last in the list of barcodes is returned"""
+        if len(sequence) != self.length or self.length == 0:
+            return None
+        base4 = sequence.translate(NT_TO_BASE4)
+        try:
+            int(base4, 4)
+        except ValueError:
+            return None
+        candidates = self.candidates(base4)
+        if len(candidates) == 0:
+            return None
+        distances = (self.barcodeArray[candidates] != np.frombuffer(sequence.encode('ascii'), dtype=np.uint8)).sum(axis=1)
+        matches = candidates[distances <= self.maxDistance]
+        if len(matches) == 0:
+            return None
+        return self.barcodeArray[matches.max()].tobytes().decode('ascii')
+
+class IncrementalHammingIndex:
+
+    def __init__(self, length, maxDistance):
+        """
+        Index of barcodes that can be added to one at a time, for checking whether a sequence is within maxDistance of any
+        barcode already added. Uses the same pigeonhole segments as HammingIndex, with each segment stored in a dictionary
+
+        arguments:
+
+        length          - length of all barcodes and sequences
+        maxDistance     - maximum Hamming distance between a sequence and a barcode for the sequence to be within distance of the barcode
+        """
+        self.maxDistance = maxDistance
+        self.segments = segment_bounds(length, maxDistance+1) if maxDistance+1 <= length else []
+        self.segmentDicts = [{} for _ in self.segments]
+        self.barcodes = []
+
+    def add(self, barcode):
+        for (start, end), segmentDict in zip(self.segments, self.segmentDicts):
+            segmentDict.setdefault(barcode[start:end], []).append(len(self.barcodes))
+        self.barcodes.append(barcode)
+
+    def within_distance(self, sequence):
+        """returns True if the sequence is within maxDistance of any barcode that has been added"""
+        if not self.segments:
+            candidates = range(len(self.barcodes))
+        else:
+            candidates = set()
+            for (start, end), segmentDict in zip(self.segments, self.segmentDicts):
+                candidates.update(segmentDict.get(sequence[start:end], ()))
+        for i in candidates:
+            if sum(c1 != c2 for c1, c2 in zip(sequence, self.barcodes[i])) <= self.maxDistance:
+                return True
+        return False
+
+def barcode_cache_key(fastaFile, *settings):
+    """returns a hash of the contents of a barcode fasta file and any settings used to compile a barcode lookup from it,
+    for use as the name of a cached barcode lookup"""
+    fastaHash = hashlib.blake2b(digest_size=16)
+    with open(fastaFile, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            fastaHash.update(block)
+    fastaHash.update(repr(settings).encode())
+    return fastaHash.hexdigest()
+
+def deletion_variants(sequence, maxDeletions):
+    """returns the set of all sequences that can be produced by deleting at most maxDeletions characters from a sequence"""
+    variants = {sequence}
+    previous = {sequence}
+    for _ in range(maxDeletions):
+        previous = {variant[:i]+variant[i+1:] for variant in previous for i in range(len(variant))}
+        variants |= previous
+    return variants
+
+def pack_variant(sequence):
+    """packs a nucleotide sequence of any length into an integer using 2 bits per nucleotide, preceded by a 1 so
+    that sequences of different lengths produce different integers. Raises ValueError for non-ACGT characters"""
+    return int('1' + sequence.translate(NT_TO_BASE4), 4)
+
+def bounded_edit_distance(sequence1, sequence2, maxDistance):
+    """Levenshtein distance between two sequences, computed only within a diagonal band of width maxDistance.
+    Returns maxDistance+1 if the distance is greater than maxDistance"""
+    if abs(len(sequence1) - len(sequence2)) > maxDistance:
+        return maxDistance + 1
+    outside = maxDistance + 1
+    previous = list(range(len(sequence2)+1))
+    for i in range(1, len(sequence1)+1):
+        current = [outside] * (len(sequence2)+1)
+        if i <= maxDistance:
+            current[0] = i
+        for j in range(max(1, i-maxDistance), min(len(sequence2), i+maxDistance)+1):
+            current[j] = min(previous[j-1] + (sequence1[i-1] != sequence2[j-1]), previous[j] + 1, current[j-1] + 1)
+        if min(current) > maxDistance:
+            return outside
+        previous = current
+    return min(previous[-1], outside)
+
+class EditDistanceIndex:
+
+    def __init__(self, barcodes, maxDistance):
+        """
+        Indel tolerant lookup of barcodes using a deletion neighbourhood index. All sequences that can be produced by
+        deleting up to maxDistance nucleotides from each barcode are stored as 2 bit packed integer keys. Any sequence within
+        Levenshtein distance maxDistance of a barcode shares at least one such deletion variant with it, so candidates are found
+        by looking up the deletion variants of a sequence, and are then verified by a banded edit distance calculation
+
+        arguments:
+
+        barcodes        - list of equal length barcode strings, containing only A, C, G, and T
+        maxDistance     - maximum Levenshtein distance between a sequence and a barcode for the sequence to be assigned to the barcode
+        """
+        self.barcodes = list(barcodes)
+        self.maxDistance = maxDistance
+        nonACGT = [bc for bc in self.barcodes if set(bc) - set('ACGT')]
+        if nonACGT:
+            raise ValueError('Barcodes used with an editDistance greater than 0 may only contain A, C, G, and T:\n' + '\n'.join(nonACGT))
+        self.length = len(self.barcodes[0]) if self.barcodes else 0
+        self.deletionIndex = {}     # packed deletion variant: barcode index, or list of barcode indices if shared by multiple barcodes
+        for i, barcode in enumerate(self.barcodes):
+            for variant in deletion_variants(barcode, maxDistance):
+                key = pack_variant(variant)
+                existing = self.deletionIndex.get(key)
+                if existing is None:
+                    self.deletionIndex[key] = i
+                elif type(existing) == list:
+                    existing.append(i)
+                else:
+                    self.deletionIndex[key] = [existing, i]
+
+    def lookup(self, sequence, start, end):
+        """finds the barcode with the lowest edit distance to a region of a sequence. To tolerate indels at the edges of the region,
+        all subsequences whose start and end are shifted from those of the region by a combined total of at most maxDistance
+        are compared to barcodes, and the lowest edit distance of any of these subsequences is used
+
+        args:
+            sequence    - query sequence string
+            start, end  - expected start and end of the barcode within the sequence
+
+        returns:
+            the barcode within maxDistance of the region, or None if no barcode is within maxDistance or if
+                multiple barcodes are tied for the lowest edit distance
+        """
+        k = self.maxDistance
+        subsequences = {sequence[s:e] for s in range(max(start-k, 0), start+k+1) for e in range(end-k, min(end+k, len(sequence))+1)
+                            if abs(s-start) + abs(e-end) <= k and abs((e-s) - self.length) <= k}
+        variants = set()
+        for subsequence in subsequences:
+            variants |= deletion_variants(subsequence, k)
+        candidates = set()
+        for variant in variants:
+            try:
+                existing = self.deletionIndex.get(pack_variant(variant))
+            except ValueError:  # non-ACGT characters can't be part of any barcode
+                continue
+            if existing is None:
+                continue
+            elif type(existing) == list:
+                candidates.update(existing)
+            else:
+                candidates.add(existing)
+
+        bestDistance = k + 1
+        bestBarcodes = []
+        for i in candidates:
+            distance = min(bounded_edit_distance(subsequence, self.barcodes[i], k) for subsequence in subsequences)
+            if distance > k:
+                continue
+            elif distance < bestDistance:
+                bestDistance = distance
+                bestBarcodes = [self.barcodes[i]]
+            elif distance == bestDistance:
+                bestBarcodes.append(self.barcodes[i])
+        if len(bestBarcodes) == 1:
+            return bestBarcodes[0]
+        return None
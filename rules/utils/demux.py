@@ -1,7 +1,8 @@
 """
 Demultiplexing of BAM files.
 
-Input: BAM file, fasta file of terminal barcodes and/or internal barcodes
+Input: BAM file, fasta file of terminal barcodes and/or internal barcodes. If the BAM file is not indexed, e.g. an unsorted SAM
+    or BAM stream from the aligner, reads are demultiplexed in the order that they are read, and output files are sorted afterwards
 
 Output: Multiple BAM files containing demultiplexed reads, with the file name indicating the distinguishing barcodes.
     If terminal barcodes are not used, output name will be all_X.input.bam, where X is the internal barcode
@@ -26,7 +27,12 @@ from Bio import SeqIO
 from collections import Counter
 from timeit import default_timer as now
 import sys
+import tempfile
 import tracemalloc
+from reference_projection import ReferenceProjection, match_blocks
+from BAM_chunks import chunk_BAM, iterate_BAM_chunk
+from BAM_writers import BAMWriterPool
+from barcode_index import find_close_barcode_pairs, barcode_cache_key, HammingIndex, EditDistanceIndex
 
 def main():
 
@@ -39,7 +45,28 @@ def main():
     outputDir = str(snakemake.output.flag).split(f'/.{tag}_demultiplex.done')[0]
     outputStats = snakemake.output.stats
     bcp = BarcodeParser(config, tag)
-    bcp.demux_BAM(BAMin, outputDir, outputStats)
+    bcp.demux_BAM(BAMin, outputDir, outputStats, snakemake.threads)
+
+def init_worker(barcodeParser):
+    """initializer for processes in a multiprocessing pool. Processes are forked, so the BarcodeParser
+    object, including all barcode dictionaries, is shared with the parent process rather than being copied for each chunk"""
+    global workerBarcodeParser
+    workerBarcodeParser = barcodeParser
+
+def demux_chunk(chunk):
+    """multiprocessing worker function, demultiplexes a chunk of reads from the BAM file input into its own set of shard BAM files.
+    `chunk` is a tuple of the BAM file input, the shard directory, the BGZF virtual offset of the first read, and the number of reads in the chunk"""
+    return workerBarcodeParser.demux_BAM_chunk(*chunk)
+
+def count_chunk(chunk):
+    """multiprocessing worker function for the counting pass of two pass demultiplexing, identifies barcodes for a chunk of reads without writing them.
+    `chunk` is a tuple of the BAM file input, the shard directory, the BGZF virtual offset of the first read, and the number of reads in the chunk"""
+    return workerBarcodeParser.count_BAM_chunk(*chunk)
+
+def write_chunk(chunk):
+    """multiprocessing worker function for the writing pass of two pass demultiplexing, writes a chunk of reads to its own set of shard BAM files.
+    `chunk` is the tuple provided to count_chunk() followed by the arguments of write_BAM_entries() after `spillPath`"""
+    return workerBarcodeParser.write_BAM_chunk(*chunk)
 
 class BarcodeParser:
 
@@ -65,18 +92,25 @@ class BarcodeParser:
         barcodes in fasta must be in fasta form: >barcodeName
                                                   NNNNNNNN
         function will then create a dictionary of these barcodes in the form {NNNNNNNN: barcodeName}
+        if multiple records in the fasta file have the same sequence, all of them are reported in a single error
         
         inputs:
             bcFASTA:    string, file name of barcode fasta file used for reference
             revComp:    bool, if set to True, barcode sequences will be stored as reverse complements of the sequences in the fasta file
         """
         bcDict = {}
+        duplicates = []
         for entry in SeqIO.parse(bcFASTA, 'fasta'):
             bcName = entry.id
             bc = str(entry.seq).upper()
             if revComp:
                 bc = Seq.reverse_complement(bc)
+            if bc in bcDict:
+                duplicates.append(f'Barcode {bcName} has the same sequence as barcode {bcDict[bc]}: {bc}')
+                continue
             bcDict[bc]=bcName
+        if duplicates:
+            raise ValueError(f'{len(duplicates)} barcodes in {bcFASTA} duplicate the sequence of a previous barcode. Duplicate barcodes are not allowed.\n' + '\n'.join(duplicates))
         return bcDict
 
     @staticmethod
@@ -114,6 +148,7 @@ class BarcodeParser:
             except ValueError:
                 raise ValueError(f'Barcode context not found in reference sequence. Modify context or reference sequence to ensure an exact match is present.\n\nRun tag: `{self.tag}`\nbarcode type: `{bcType}`\nbarcode sequence context: `{dictOfContexts[bcType]}`\nreference sequence: `{self.reference.id}`\nreference sequence fasta file: `{self.refSeqfasta}`')
         self.barcodeContexts = dictOfContexts
+        self.referenceProjection = ReferenceProjection(self.reference.seq, dictOfContexts)
 
     def add_barcode_dicts(self):
         """
@@ -137,122 +172,56 @@ class BarcodeParser:
                 raise FileNotFoundError(f'barcode fasta file not found.\n\nRun tag: `{self.tag}`\nbarcode type: `{bcType}`\nreference sequence: `{self.reference.id}`\nfasta file: `{fastaFile}`')
         self.barcodeDicts = dictOfDicts
 
-    @staticmethod
-    def hamming_distance(string1, string2):
-        """calculates hamming distance, taken from https://stackoverflow.com/questions/54172831/hamming-distance-between-two-strings-in-python"""
-        return sum(c1 != c2 for c1, c2 in zip(string1.upper(), string2.upper()))
-
-    @staticmethod
-    def contains_duplicates(X):
-        return len(set(X)) != len(X)
-
-    def add_barcode_hamming_distance(self):
-        """adds barcode hamming distance for each type of barcode (default value = 0), and ensures that
-        (1) hamming distances of all possible pairs of barcodes within the fasta file of each barcode
-        type are greater than the set hamming distance and (2) that each barcode is the same length as
-        the length of Ns in the provided sequence context"""
-        hammingDistanceDict = {}
+    def get_barcode_index_cache(self, barcodeType, hamDist):
+        """returns the directory of the cached HammingIndex for a barcode type, named by a hash of the barcode fasta file contents,
+        reverseComplement, and hamming distance, or None if barcode_index_cache is not set in the config file or the hamming distance is 0"""
+        cacheDir = self.config.get('barcode_index_cache', False)
+        if not cacheDir or hamDist == 0:
+            return None
+        return os.path.join(cacheDir, barcode_cache_key(self.barcodeInfo[barcodeType]['fasta'], bool(self.barcodeInfo[barcodeType]['reverseComplement']), hamDist))
+
+    def add_hamming_distance_barcode_index(self):
+        """Adds a second barcode lookup based upon hamming distance (default value = 0). For each barcode type, ensures that
+        (1) hamming distances of all possible pairs of barcodes within the fasta file of each barcode type are greater than
+        the set hamming distance and (2) that each barcode is the same length as the length of Ns in the provided sequence context.
+        If the hamming distance is >0, adds a HammingIndex of the barcodes defined in the barcode fasta file, which
+        finds the barcode within the specified hamming distance of a sequence for that barcode type. If a sequence
+        is within the hamming distance of multiple barcodes, the barcode that appears last in the fasta file is used.
+        Only utilized when a barcode cannot be found in the provided barcode fasta file and hamming distance for the barcode type is >0.
+        If barcode_index_cache is set in the config file, indexes are loaded from the cache if they have already been compiled, or saved to it if not"""
+        hammingDistanceBarcodeLookup = {}
         for barcodeType in self.barcodeDicts:
-            if 'hammingDistance' in self.barcodeInfo[barcodeType]:
-                hammingDistanceDict[barcodeType] = self.barcodeInfo[barcodeType]['hammingDistance']
-            else:
-                hammingDistanceDict[barcodeType] = 0 #default Hamming distance of 0
-            barcodes = [bc for bc in self.barcodeDicts[barcodeType]]
+            hamDist = self.barcodeInfo[barcodeType].get('hammingDistance', 0)
+            barcodes = list(self.barcodeDicts[barcodeType])
             context = self.barcodeContexts[barcodeType].upper()
             barcodeLength = context.rindex('N') - context.index('N') + 1
-            checkHammingDistances = True
-            if len(barcodes)>1000:
-                checkHammingDistances = False
-                print(f'[NOTICE] More than 1000 barcodes present in barcode fasta file {self.barcodeInfo[barcodeType]["fasta"]}, not checking pairwise hamming distances')
-            checkDup = False
-            if self.contains_duplicates(barcodes):
-                checkDup = True
-            for i,bc in enumerate(barcodes):
-                if checkDup:
-                    assert (barcodes.count(bc) == 1), f'Barcode {bc} present more than once in {self.barcodeInfo[barcodeType]["fasta"]} Duplicate barcodes are not allowed.'
-                assert (len(bc) == barcodeLength), f'Barcode {bc} is longer than the expected length of {barcodeLength} based on {self.barcodeContexts[barcodeType]}'
-                if checkHammingDistances:
-                    otherBCs = barcodes[:i]+barcodes[i+1:]
-                    for otherBC in otherBCs:
-                        hamDist = self.hamming_distance(bc, otherBC)
-                        assert (hamDist > hammingDistanceDict[barcodeType]), f'Barcode {bc} is within hammingDistance {hamDist} of barcode {otherBC}'
-        self.hammingDistances = hammingDistanceDict
-
-    @staticmethod
-    def hamming_distance_dict(sequence, hamming_distance):
-        """given a sequence as a string (sequence) and a desired hamming distance,
-        finds all sequences that are at or below the specified hamming distance away
-        from the sequence and returns a dictionary where values are the given sequence
-        and keys are every sequence whose hamming distance from `sequence` is less
-        than or equal to `hamming_distance`"""
-        
-        hammingDistanceSequences = [[sequence]] # list to be populated with lists of sequences that are the index hamming distance from the first sequence
-
-        for hd in range(0, hamming_distance):
-            new_seqs = []
-            for seq in hammingDistanceSequences[hd]:
-                for i, a in enumerate(seq):
-                    if a != sequence[i]: continue
-                    for nt in list('ATGC'):
-                        if nt == a: continue
-                        else: new_seqs.append(seq[:i]+nt+seq[i+1:])
-            hammingDistanceSequences.append(new_seqs)
-
-        allHDseqs = list(itertools.chain.from_iterable(hammingDistanceSequences)) # combine all sequences into a single list
-
-        outDict = {}
-        for seq in allHDseqs:
-            outDict[seq] = sequence
-
-        return outDict
-
-    def add_hamming_distance_barcode_dict(self):
-        """Adds a second barcode dictionary based upon hamming distance. For each barcode type, if the
-        hamming distance is >0, adds a dictionary where values are barcodes defined in the barcode fasta file,
-        and keys are all sequences of the same length with hamming distance from each specific barcode less than
-        or equal to the specified hamming distance for that barcode type. Only utilized when a barcode cannot
-        be found in the provided barcode fasta file and hamming distance for the barcode type is >0"""
-        hammingDistanceBarcodeLookup = {}
-        for barcodeType in self.hammingDistances:
-            hamDist = self.hammingDistances[barcodeType]
+            wrongLength = [bc for bc in barcodes if len(bc) != barcodeLength]
+            if wrongLength:
+                raise ValueError(f'Barcodes in {self.barcodeInfo[barcodeType]["fasta"]} differ from the expected length of {barcodeLength} based on {self.barcodeContexts[barcodeType]}:\n' + '\n'.join(wrongLength))
+            cachePath = self.get_barcode_index_cache(barcodeType, hamDist)
+            if cachePath and os.path.isdir(cachePath):  # barcodes were already validated when the cached lookup was compiled
+                hammingDistanceBarcodeLookup[barcodeType] = HammingIndex.load(cachePath)
+                continue
+            closePairs = find_close_barcode_pairs(barcodes, hamDist)
+            if closePairs:
+                raise ValueError(f'{len(closePairs)} pairs of barcodes in {self.barcodeInfo[barcodeType]["fasta"]} are within hammingDistance {hamDist} of each other. Duplicate barcodes are not allowed.\n' + '\n'.join(f'Barcode {bc1} is within hammingDistance {pairDist} of barcode {bc2}' for bc1, bc2, pairDist in closePairs))
             if hamDist > 0:
-                barcodeTypeHDdict = {}
-                for barcode in self.barcodeDicts[barcodeType]:
-                    barcodeTypeHDdict.update(self.hamming_distance_dict(barcode,hamDist))
-                hammingDistanceBarcodeLookup[barcodeType] = barcodeTypeHDdict
-        self.hammingDistanceBarcodeDict = hammingDistanceBarcodeLookup
-
-    def find_N_start_end(self, sequence, context):
-        """given a sequence with barcode locations marked as Ns, and a barcode sequence context (e.g. ATCGNNNNCCGA),
-        this function will return the beginning and end of the Ns within the appropriate context if it exists only once.
-        If the context does not exist or if it is uncertain (due to insertions), will return 'fail', 'fail'"""
-
-        location = sequence.find(context)
-        if location == -1:
-            self.failureReason = 'context_not_present_in_reference_sequence'
-            return 'fail', 'fail'
-        N_start = location + context.find('N')
-        N_end = location + len(context) - context[::-1].find('N')
-        if (sequence[max(N_start-1,0)] or sequence[min(N_end+1,len(sequence)-1)]) == '-':
-            self.failureReason = 'low_confidence_barcode_identification'
-            return 'fail', 'fail'
-
-        return N_start, N_end
-
-    def align_reference(self, BAMentry):
-        """given a pysam.AlignmentFile BAM entry,
-        builds the reference alignment string with indels accounted for"""
-        index = BAMentry.reference_start
-        refAln = ''
-        for cTuple in BAMentry.cigartuples:
-            if cTuple[0] == 0: #match
-                refAln += self.reference.seq[index:index+cTuple[1]]
-                index += cTuple[1]
-            elif cTuple[0] == 1: #insertion
-                refAln += '-'*cTuple[1]
-            elif cTuple[0] == 2: #deletion
-                index += cTuple[1]
-        return refAln
+                hammingDistanceBarcodeLookup[barcodeType] = HammingIndex(barcodes, hamDist)
+                if cachePath:
+                    hammingDistanceBarcodeLookup[barcodeType].save(cachePath)
+        self.hammingDistanceBarcodeIndex = hammingDistanceBarcodeLookup
+
+    def add_edit_distance_barcode_index(self):
+        """Adds an indel tolerant barcode lookup. For each barcode type with an editDistance >0 set in barcodeInfo,
+        adds an EditDistanceIndex of the barcodes defined in the barcode fasta file. Only utilized when a barcode
+        cannot be identified by exact match or hamming distance, including when the barcode context is
+        disrupted by an indel. If multiple barcodes are equally close, the barcode is not identified"""
+        editDistanceBarcodeLookup = {}
+        for barcodeType in self.barcodeDicts:
+            editDist = self.barcodeInfo[barcodeType].get('editDistance', 0)
+            if editDist > 0:
+                editDistanceBarcodeLookup[barcodeType] = EditDistanceIndex(list(self.barcodeDicts[barcodeType]), editDist)
+        self.editDistanceBarcodeIndex = editDistanceBarcodeLookup
 
     def add_group_barcode_type(self):
         """adds a list of the barcodeTypes that are used for grouping, a list of barcodeTypes that are not
@@ -353,9 +322,8 @@ class BarcodeParser:
         return out
 
 
-    def id_seq_barcodes(self, refAln, BAMentry):
+    def id_seq_barcodes(self, BAMentry):
         """Inputs:
-            refAln:         aligned reference string from align_reference()
             BAMentry:       pysam.AlignmentFile entry
         
         Returns a list of information for a provided `BAMentry` that will be used for demuxing
@@ -364,28 +332,30 @@ class BarcodeParser:
         sequenceBarcodesDict = {}
         barcodeNames = []
         bcDataList = []
+        blocks = match_blocks(BAMentry)
+        barcodeLocations = self.referenceProjection.project(BAMentry, blocks)
+        querySequence = BAMentry.query_alignment_sequence
         
         for barcodeType in self.barcodeDicts:
 
-            self.failureReason = None
             barcodeName = None
             notExactMatch = 0
             failureReason = {'context_not_present_in_reference_sequence':0, 'barcode_not_in_fasta':0, 'low_confidence_barcode_identification':0}
-            start,stop = self.find_N_start_end(refAln, self.barcodeContexts[barcodeType])
+            location = barcodeLocations[barcodeType]
 
-            if type(start)==int:
-                barcode = BAMentry.query_alignment_sequence[ start:stop ]
+            if type(location)==tuple:
+                barcode = querySequence[ location[0]:location[1] ]
             else:
                 barcodeName = 'fail'
-                failureReason[self.failureReason] = 1 # failure reason is set by self.find_N_start_end
+                failureReason[location] = 1 # failure reason is provided by the reference projection in place of a location
             
             if barcodeName != 'fail':
                 if barcode in self.barcodeDicts[barcodeType]:
                     barcodeName = self.barcodeDicts[barcodeType][barcode]
                 else:
-                    if barcodeType in self.hammingDistanceBarcodeDict:
-                        if barcode in self.hammingDistanceBarcodeDict[barcodeType]:
-                            closestBarcode = self.hammingDistanceBarcodeDict[barcodeType][barcode]
+                    if barcodeType in self.hammingDistanceBarcodeIndex:
+                        closestBarcode = self.hammingDistanceBarcodeIndex[barcodeType].lookup(barcode)
+                        if closestBarcode is not None:
                             barcodeName = self.barcodeDicts[barcodeType][closestBarcode]
                             notExactMatch = 1
                         else:
@@ -394,6 +364,16 @@ class BarcodeParser:
                     else:
                         barcodeName = 'fail'
                         failureReason['barcode_not_in_fasta'] = 1
+
+            # indel tolerant identification of barcodes that could not otherwise be identified, using the N region mapped across any indels
+            if barcodeName == 'fail' and barcodeType in self.editDistanceBarcodeIndex:
+                region = location if type(location)==tuple else self.referenceProjection.map_N_region(blocks, barcodeType)
+                if region:
+                    closestBarcode = self.editDistanceBarcodeIndex[barcodeType].lookup(querySequence, *region)
+                    if closestBarcode is not None:
+                        barcodeName = self.barcodeDicts[barcodeType][closestBarcode]
+                        notExactMatch = 1
+                        failureReason = dict.fromkeys(failureReason, 0)
             
             sequenceBarcodesDict[barcodeType] = barcodeName
             barcodeNames += [barcodeName]
@@ -402,18 +382,176 @@ class BarcodeParser:
         return sequenceBarcodesDict, barcodeNames, np.array(bcDataList)
 
 
-    def demux_BAM(self, BAMin, outputDir, outputStats):
-        bamfile = pysam.AlignmentFile(BAMin, 'rb')
+    def get_writer_pool(self, bamfile, outputDir, spillPath):
+        """returns a BAMWriterPool for writing demultiplexed reads to {outputDir}/{tag}_{outputBarcodes}.bam files"""
+        return BAMWriterPool(bamfile, outputDir, prefix=f'{self.tag}_', maxOpenFiles=self.maxOpenFiles,
+                                bufferSize=self.config.get('demux_buffer_size', 1000), maxBufferedBytes=self.maxBufferedBytes, spillPath=spillPath, spillTag=self.spillTag)
+
+    def identify_BAM_entry(self, BAMentry, rowCountsDict):
+        """identifies the barcodes of a single BAM entry, adds the BC tag for barcode types that are not used to split files,
+        and adds barcode data to the `rowCountsDict` Counter of demux stats rows. Returns the output file barcodes for the entry"""
+        sequenceBarcodesDict, barcodeNames, bcDataArray = self.id_seq_barcodes(BAMentry) #this takesd about 3 times as long as other steps in this loop, probably due to try except clauses
+        if len(self.noSplitBarcodeTypes) > 0:
+            noSplitBarcodeBAMtag = '_'.join([sequenceBarcodesDict.pop(noSplitBarcode) for noSplitBarcode in self.noSplitBarcodeTypes])
+            BAMentry.set_tag('BC', noSplitBarcodeBAMtag)
+        outputBarcodes, groupedBool = self.get_demux_output_prefix(sequenceBarcodesDict)
+        bcDataArray = np.insert(bcDataArray, 0, 1)                                                                    # insert 1 in front to serve as counter for total number of sequences with these barcodes
+        rowCountsDict[tuple([self.tag, outputBarcodes, groupedBool] + barcodeNames)] += bcDataArray     # add counters for demux and data on failure modes
+        return outputBarcodes
+
+    def count_BAM_entries(self, BAMentries):
+        """counting pass of two pass demultiplexing, identifies the barcodes of an iterable of BAM entries without writing them.
+        Returns a Counter of barcode data for demux stats rows, a list of output file barcodes, an array of the index of the output
+        file barcodes of each entry within this list, and a list of the BC tag of each entry, or None if all barcode types are used to split files"""
+        rowCountsDict = Counter()
+        outputBarcodesIndex = {}
+        assignments = []
+        BCtags = [] if len(self.noSplitBarcodeTypes) > 0 else None
+        for BAMentry in BAMentries:
+            outputBarcodes = self.identify_BAM_entry(BAMentry, rowCountsDict)
+            assignments.append(outputBarcodesIndex.setdefault(outputBarcodes, len(outputBarcodesIndex)))
+            if BCtags is not None:
+                BCtags.append(BAMentry.get_tag('BC'))
+        return rowCountsDict, list(outputBarcodesIndex), np.array(assignments, dtype=np.uint32), BCtags
+
+    def write_BAM_entries(self, bamfile, BAMentries, outputDir, spillPath, outputBarcodesList, assignments, BCtags, banished):
+        """writing pass of two pass demultiplexing, writes an iterable of BAM entries using the barcodes identified by count_BAM_entries()
+        for the same entries. Entries with output file barcodes in `banished` are all written to `spillPath`, with the output file
+        barcodes stored in a BAM tag, and all other entries are written to {outputDir}/{tag}_{outputBarcodes}.bam. Returns a list of
+        the output file barcodes written to their own file"""
+        writerPool = self.get_writer_pool(bamfile, outputDir, spillPath)
+        with pysam.AlignmentFile(spillPath, 'wb', template=bamfile) as spillFile:
+            for BAMentry, assignment, BCtag in zip(BAMentries, assignments, BCtags or itertools.repeat(None)):
+                if BCtag is not None:
+                    BAMentry.set_tag('BC', BCtag)
+                outputBarcodes = outputBarcodesList[assignment]
+                if outputBarcodes in banished:
+                    BAMentry.set_tag(self.spillTag, outputBarcodes)
+                    spillFile.write(BAMentry)
+                else:
+                    writerPool.write(outputBarcodes, BAMentry)
+        outputFiles, _ = writerPool.close()
+        return outputFiles
+
+    def demux_BAM_entries(self, bamfile, BAMentries, outputDir, spillPath=None):
+        """demultiplexes an iterable of BAM entries, writing each to {outputDir}/{tag}_{outputBarcodes}.bam,
+        using the header of `bamfile` as a template. If spillPath is provided, output files that will not be analyzed further
+        and that have fewer than demux_buffer_size reads are instead written to `spillPath`.
+        Returns a Counter of barcode data for demux stats rows, a list of the output file barcodes written to their own file,
+        and a list of the output file barcodes written to the spill file"""
+
+        # reads are buffered for each barcode combination and written in blocks, with a limited number of files open at once
+        writerPool = self.get_writer_pool(bamfile, outputDir, spillPath)
+        rowCountsDict = Counter()
+        for BAMentry in BAMentries:
+            outputBarcodes = self.identify_BAM_entry(BAMentry, rowCountsDict)
+            writerPool.write(outputBarcodes, BAMentry)
+
+        if spillPath and self.config.get('demux_spill', True):
+            spill = self.get_banished_output_barcodes(rowCountsDict)
+        else:
+            spill = None
+        outputFiles, spilledFiles = writerPool.close(spill)
+
+        return rowCountsDict, outputFiles, spilledFiles
+
+    def get_banished_output_barcodes(self, rowCountsDict):
+        """returns the set of output file barcodes for files that should not be analyzed further, either because the
+        file has a sequence count below the set threshold or because sequences in the file failed any barcodes
+        or were not assigned a named barcode group, as set in the config file"""
+        fileCounts = Counter()
+        for row, counters in rowCountsDict.items():
+            fileCounts[row[1]] += counters[0]
+        totalSeqs = sum(fileCounts.values())
+        barcodeTypes = list(self.barcodeDicts)
+        screenedIndices = [barcodeTypes.index(barcodeType) for barcodeType in self.groupedBarcodeTypes+self.ungroupedBarcodeTypes]
+
+        banished = set()
+        for tag, outputBarcodes, groupedBool, *barcodeNames in rowCountsDict:
+            if fileCounts[outputBarcodes] < self.config['demux_threshold'] * totalSeqs:
+                banished.add(outputBarcodes)
+            if self.config.get('demux_screen_failures', False):
+                if any(barcodeNames[i] == 'fail' for i in screenedIndices):
+                    banished.add(outputBarcodes)
+            if (self.config.get('demux_screen_no_group', False) == True) and not groupedBool:
+                banished.add(outputBarcodes)
+        return banished
+
+    def demux_BAM_chunk(self, BAMin, shardDir, offset, count):
+        """demultiplexes a chunk of reads produced by chunk_BAM() into shard BAM files within `shardDir`, one for each output file.
+        Only reads aligned to the reference sequence are demultiplexed, matching the reads returned by fetch() in the serial path.
+        Which output files will not be analyzed further is only known once all chunks are demultiplexed, so shards of these
+        output files are written to the spill file by demux_BAM()"""
+        with pysam.AlignmentFile(BAMin, 'rb') as bamfile:
+            os.makedirs(shardDir, exist_ok=True)
+            return self.demux_BAM_entries(bamfile, self.chunk_BAM_entries(bamfile, offset, count), shardDir)
+
+    def chunk_BAM_entries(self, bamfile, offset, count):
+        """yields the reads of a chunk produced by chunk_BAM() that are aligned to the reference sequence"""
+        referenceID = bamfile.get_tid(self.reference.id)
+        return (BAMentry for BAMentry in iterate_BAM_chunk(bamfile, offset, count) if BAMentry.reference_id == referenceID)
+
+    def count_BAM_chunk(self, BAMin, shardDir, offset, count):
+        """counting pass of two pass demultiplexing for a chunk of reads produced by chunk_BAM()"""
+        with pysam.AlignmentFile(BAMin, 'rb') as bamfile:
+            return self.count_BAM_entries(self.chunk_BAM_entries(bamfile, offset, count))
+
+    def write_BAM_chunk(self, BAMin, shardDir, offset, count, *writeArgs):
+        """writing pass of two pass demultiplexing for a chunk of reads produced by chunk_BAM(), writes reads to shard
+        BAM files within `shardDir`, and reads of output files that will not be analyzed further to a spill shard file"""
+        with pysam.AlignmentFile(BAMin, 'rb') as bamfile:
+            os.makedirs(shardDir, exist_ok=True)
+            return self.write_BAM_entries(bamfile, self.chunk_BAM_entries(bamfile, offset, count), shardDir, os.path.join(shardDir, 'spill.bam'), *writeArgs)
+
+    def demux_BAM_two_pass(self, BAMin, bamfile, outputDir, spillPath, threads):
+        """demultiplexes reads in two passes. Barcodes of all reads are first identified without writing any reads, to determine
+        which output files will be analyzed further, then only these output files are written, and all other reads are written to
+        the spill file. Returns a Counter of barcode data for demux stats rows"""
+        if threads > 1:
+            chunkSize = -(-(bamfile.mapped + bamfile.unmapped) // threads)
+            with tempfile.TemporaryDirectory(dir=outputDir) as tempDir:
+                chunks = [(BAMin, os.path.join(tempDir, str(i)), offset, count) for i, (offset, count) in enumerate(chunk_BAM(BAMin, max(chunkSize, 1)))]
+                with mp.get_context('fork').Pool(threads, initializer=init_worker, initargs=(self,)) as pool:
+                    countResults = pool.map(count_chunk, chunks)
+                    rowCountsDict = Counter()
+                    for chunkRowCounts, _, _, _ in countResults:
+                        for row, counters in chunkRowCounts.items():
+                            rowCountsDict[row] += counters
+                    banished = self.get_banished_output_barcodes(rowCountsDict)
+                    chunkResults = pool.map(write_chunk, [chunk + countResult[1:] + (banished,) for chunk, countResult in zip(chunks, countResults)])
+
+                # concatenate shards and spill shards in chunk order
+                writerPool = self.get_writer_pool(bamfile, outputDir, spillPath)
+                for chunk, chunkOutputFiles in zip(chunks, chunkResults):
+                    for outputBarcodes in chunkOutputFiles:
+                        writerPool.add_part(outputBarcodes, os.path.join(chunk[1], f'{self.tag}_{outputBarcodes}.bam'))
+                writerPool.close()
+                pysam.cat('-o', spillPath, *[os.path.join(chunk[1], 'spill.bam') for chunk in chunks])
+        else:
+            rowCountsDict, *countResult = self.count_BAM_entries(bamfile.fetch(self.reference.id))
+            banished = self.get_banished_output_barcodes(rowCountsDict)
+            self.write_BAM_entries(bamfile, bamfile.fetch(self.reference.id), outputDir, spillPath, *countResult, banished)
+        return rowCountsDict
+
+    def demux_BAM(self, BAMin, outputDir, outputStats, threads=1):
+        """demultiplexes all reads in BAMin aligned to the reference sequence into {outputDir}/{tag}_{outputBarcodes}.bam files,
+        writes demux stats to outputStats, and moves files that should not be analyzed further to a subdirectory.
+        If threads > 1, the BAM file is split into one contiguous chunk of reads per process, each process writes reads to
+        its own shard of each output file, and shards are then concatenated in the order of the chunks. If demux_two_pass is
+        set, output files that will not be analyzed further are never written, see demux_BAM_two_pass(). If BAMin is not an
+        indexed BAM file, reads are demultiplexed in a single pass as they are read, and output files that will be analyzed
+        further are then sorted, which allows demultiplexing from an unsorted SAM or BAM stream"""
+        bamfile = pysam.AlignmentFile(BAMin, 'r')
+        streamInput = not bamfile.has_index()
+        self.maxOpenFiles = max(self.config.get('demux_max_open_files', 256) // threads, 1)
+        self.maxBufferedBytes = max(int(self.config.get('demux_max_buffered_mb', 500) * 1000000) // threads, 1)
+        self.spillTag = 'YG'
         self.add_barcode_contexts()
         self.add_barcode_dicts()
-        self.add_barcode_hamming_distance()
-        self.add_hamming_distance_barcode_dict()
+        self.add_hamming_distance_barcode_index()
+        self.add_edit_distance_barcode_index()
         self.add_group_barcode_type()
         self.add_barcode_name_dict()
-
-        # dictionary where keys are file name parts indicating the barcodes and values are file objects corresponding to those file name parts
-            # file objects are only created if the specific barcode combination is seen
-        outFileDict = {}
         
         # columns names for dataframe to be generated from rows output by id_seq_barcodes
         colNames = ['tag', 'output_file_barcodes', 'named_by_group']
@@ -433,21 +571,60 @@ class BarcodeParser:
         colNames.extend( ['barcodes_count'] + barcodeFailureColNames)
 
         os.makedirs(outputDir, exist_ok=True)
-        rowCountsDict = Counter()
-        for BAMentry in bamfile.fetch(self.reference.id):
-            refAln = self.align_reference(BAMentry)
-            sequenceBarcodesDict, barcodeNames, bcDataArray = self.id_seq_barcodes(refAln, BAMentry) #this takesd about 3 times as long as other steps in this loop, probably due to try except clauses
-            if len(self.noSplitBarcodeTypes) > 0:
-                noSplitBarcodeBAMtag = '_'.join([sequenceBarcodesDict.pop(noSplitBarcode) for noSplitBarcode in self.noSplitBarcodeTypes])
-                BAMentry.set_tag('BC', noSplitBarcodeBAMtag)
-            outputBarcodes, groupedBool = self.get_demux_output_prefix(sequenceBarcodesDict)
-            if not outFileDict.get(outputBarcodes, False):
-                fName = os.path.join(outputDir, f'{self.tag}_{outputBarcodes}.bam')
-                outFileDict[outputBarcodes] = pysam.AlignmentFile(fName, 'wb', template=bamfile)
-            
-            outFileDict[outputBarcodes].write(BAMentry)
-            bcDataArray = np.insert(bcDataArray, 0, 1)                                                                    # insert 1 in front to serve as counter for total number of sequences with these barcodes
-            rowCountsDict[tuple([self.tag, outputBarcodes, groupedBool] + barcodeNames)] += bcDataArray     # add counters for demux and data on failure modes
+        banishDir = os.path.join(outputDir, 'no_subsequent_analysis')
+        os.makedirs(banishDir, exist_ok=True)
+        spillPath = os.path.join(banishDir, f'{self.tag}_spill.bam')
+        if streamInput:
+            referenceID = bamfile.get_tid(self.reference.id)
+            BAMentries = (BAMentry for BAMentry in bamfile.fetch(until_eof=True) if BAMentry.reference_id == referenceID)
+            rowCountsDict, _, spilledFiles = self.demux_BAM_entries(bamfile, BAMentries, outputDir, spillPath)
+        elif self.config.get('demux_two_pass', False):
+            rowCountsDict = self.demux_BAM_two_pass(BAMin, bamfile, outputDir, spillPath, threads)
+            spilledFiles = self.get_banished_output_barcodes(rowCountsDict)
+        elif threads > 1:
+            chunkSize = -(-(bamfile.mapped + bamfile.unmapped) // threads)
+            with tempfile.TemporaryDirectory(dir=outputDir) as tempDir:
+                chunks = [(BAMin, os.path.join(tempDir, str(i)), offset, count) for i, (offset, count) in enumerate(chunk_BAM(BAMin, max(chunkSize, 1)))]
+                with mp.get_context('fork').Pool(threads, initializer=init_worker, initargs=(self,)) as pool:
+                    chunkResults = pool.map(demux_chunk, chunks)
+
+                # merge counters in chunk order so that rows are ordered by first appearance, as in the serial path
+                rowCountsDict = Counter()
+                for chunkRowCounts, _, _ in chunkResults:
+                    for row, counters in chunkRowCounts.items():
+                        rowCountsDict[row] += counters
+
+                # concatenate shards in chunk order. As in the serial path, output files that will not be analyzed further and that
+                # have fewer than demux_buffer_size reads are instead written to the spill file, so that only these reads are written a second time
+                spill = set()
+                if self.config.get('demux_spill', True):
+                    fileCounts = Counter()
+                    for row, counters in rowCountsDict.items():
+                        fileCounts[row[1]] += counters[0]
+                    bufferSize = self.config.get('demux_buffer_size', 1000)
+                    spill = {outputBarcodes for outputBarcodes in self.get_banished_output_barcodes(rowCountsDict) if fileCounts[outputBarcodes] < bufferSize}
+                writerPool = self.get_writer_pool(bamfile, outputDir, spillPath)
+                spillShards = {}
+                for chunk, (_, chunkOutputFiles, _) in zip(chunks, chunkResults):
+                    for outputBarcodes in chunkOutputFiles:
+                        shard = os.path.join(chunk[1], f'{self.tag}_{outputBarcodes}.bam')
+                        if outputBarcodes in spill:
+                            spillShards.setdefault(outputBarcodes, []).append(shard)
+                        else:
+                            writerPool.add_part(outputBarcodes, shard)
+                writerPool.close()
+                spilledFiles = [outputBarcodes for outputBarcodes in dict.fromkeys(row[1] for row in rowCountsDict) if outputBarcodes in spillShards]
+                if spilledFiles:
+                    with pysam.AlignmentFile(spillPath, 'wb', template=bamfile) as spillFile:
+                        for outputBarcodes in spilledFiles:
+                            for shard in spillShards[outputBarcodes]:
+                                with pysam.AlignmentFile(shard, 'rb', check_sq=False) as shardFile:
+                                    for BAMentry in shardFile.fetch(until_eof=True):
+                                        BAMentry.set_tag(self.spillTag, outputBarcodes)
+                                        spillFile.write(BAMentry)
+        else:
+            rowCountsDict, _, spilledFiles = self.demux_BAM_entries(bamfile, bamfile.fetch(self.reference.id), outputDir, spillPath)
+        bamfile.close()
             
         # combine barcode info (strings) and counters (int) from dict into a list of row lists
         rows = []
@@ -456,9 +633,6 @@ class BarcodeParser:
             counters = counters.tolist()
             rows.append(row + counters)
 
-        for sortedBAM in outFileDict:
-            outFileDict[sortedBAM].close()
-            
         # add counts for both number of sequences in file as well as number of sequences with same exact barcodes
         demuxStats = pd.DataFrame(rows, columns=colNames)
         totalSeqs = demuxStats['barcodes_count'].sum()
@@ -469,26 +643,21 @@ class BarcodeParser:
         demuxStats = demuxStats.groupby(groupByColNames).agg(sumColsDict).reset_index()
         demuxStats.sort_values(['demuxed_count','barcodes_count'], ascending=False, inplace=True)
 
-        # move files with sequence counts below the set threshold or having failed any barcodes to a subdirectory
-        banishDir = os.path.join(outputDir, 'no_subsequent_analysis')
-        os.makedirs(banishDir, exist_ok=True)
-        banished = [] # prevent banishing same file more than once
-        for i, row in demuxStats.iterrows():
-            if row['output_file_barcodes'] in banished: continue
-            banish = False
-            if row['demuxed_count'] < self.config['demux_threshold'] * totalSeqs:
-                banish = True
-            if self.config.get('demux_screen_failures', False):
-                for barcodeType in self.groupedBarcodeTypes+self.ungroupedBarcodeTypes:
-                    if row[barcodeType] == 'fail':
-                        banish = True
-            if (self.config.get('demux_screen_no_group', False) == True) and not row['named_by_group']:
-                banish = True
-            if banish:
-                original = os.path.join(outputDir, f"{self.tag}_{row['output_file_barcodes']}.bam")
-                target = os.path.join(banishDir, f"{self.tag}_{row['output_file_barcodes']}.bam")
-                shutil.move(original, target)
-                banished.append(row['output_file_barcodes'])
+        # move files with sequence counts below the set threshold or having failed any barcodes to a subdirectory. Files
+            # that were written to the spill file are already in this subdirectory
+        banished = self.get_banished_output_barcodes(rowCountsDict)
+        for outputBarcodes in banished:
+            if outputBarcodes in spilledFiles: continue
+            original = os.path.join(outputDir, f"{self.tag}_{outputBarcodes}.bam")
+            target = os.path.join(banishDir, f"{self.tag}_{outputBarcodes}.bam")
+            shutil.move(original, target)
+
+        # reads from a stream are written in the order they were read, so files to be analyzed further must be sorted for indexing
+        if streamInput:
+            for outputBarcodes in set(row[1] for row in rowCountsDict) - banished:
+                fName = os.path.join(outputDir, f"{self.tag}_{outputBarcodes}.bam")
+                pysam.sort('-@', str(threads), '-o', fName+'.sorted', fName)
+                os.replace(fName+'.sorted', fName)
 
         demuxStats.drop('named_by_group', axis=1, inplace=True)
         demuxStats.to_csv(outputStats, index=False)
@@ -0,0 +1,166 @@
+"""aggregation of per-sequence genotypes into unique genotypes with bounded memory. Each genotype is keyed by
+    a 64 bit hash, and a running count, the representative sequence with the highest average quality score,
+    and the first appearance of each unique genotype are kept in memory. Once the number of unique genotypes
+    in memory exceeds a limit, they are spilled to disk in partitions according to their hash, and partitions
+    are merged and sorted one at a time once all sequences have been added. The sequence ID and genotype hash
+    of every sequence are streamed to disk so that sequences can be linked to their final genotype IDs"""
+
+import os
+import pickle
+import heapq
+import hashlib
+import numpy as np
+
+class GenotypeAggregator:
+
+    def __init__(self, tempDir=None, maxGenotypes=1000000, partitions=16, seqBufferSize=100000):
+        """
+        arguments:
+
+        tempDir         - directory to spill genotypes and sequence IDs to. If None, all data is kept in memory,
+                            e.g. for aggregating the genotypes of a chunk of sequences that will be merged into
+                            another GenotypeAggregator with update()
+        maxGenotypes    - number of unique genotypes to keep in memory before spilling to disk
+        partitions      - number of partitions that genotypes are split into when spilled to disk
+        seqBufferSize   - number of sequence IDs to keep in memory before writing to disk
+        """
+        self.tempDir = tempDir
+        self.maxGenotypes = maxGenotypes
+        self.partitions = partitions
+        self.seqBufferSize = seqBufferSize
+        self.genotypes = {}     # genotype hash: [count, best avg quality score, seq ID with best avg quality score, BAM virtual offset of this sequence, index of first sequence, genotype]
+        self.seqIDs = []        # sequence IDs and genotype hashes that have not yet been written to disk
+        self.seqHashes = []
+        self.seqCount = 0
+        self.spillRuns = 0
+        if self.tempDir:
+            self.seqIDsPath = os.path.join(self.tempDir, 'seq_IDs.txt')
+            self.seqHashesPath = os.path.join(self.tempDir, 'seq_hashes.bin')
+            open(self.seqIDsPath, 'w').close()
+            open(self.seqHashesPath, 'wb').close()
+
+    @staticmethod
+    def hash_genotype(genotype):
+        """64 bit hash of a genotype tuple, which must only contain python builtin types so that the repr is consistent"""
+        return int.from_bytes(hashlib.blake2b(repr(genotype).encode(), digest_size=8).digest(), 'little')
+
+    @staticmethod
+    def combine(genotypes, genotypeHash, count, avgQscore, seqID, seqOffset, firstSeq, genotype):
+        """adds data for a genotype to a dictionary of genotypes. Data must be added in the order that sequences
+        appear, so that the first sequence with the highest average quality score is kept as the representative"""
+        entry = genotypes.get(genotypeHash)
+        if entry is None:
+            genotypes[genotypeHash] = [count, avgQscore, seqID, seqOffset, firstSeq, genotype]
+            return
+        if entry[5] != genotype:
+            raise ValueError(f'Genotype hash collision between genotypes {entry[5]} and {genotype}')
+        entry[0] += count
+        if avgQscore > entry[1]:
+            entry[1] = avgQscore
+            entry[2] = seqID
+            entry[3] = seqOffset
+
+    def add(self, seqID, avgQscore, genotype, seqOffset=None):
+        """adds a single sequence with the provided genotype tuple. seqOffset is the BAM virtual offset of the sequence,
+        which is kept for the representative sequence of each genotype so that it can be retrieved without a name index"""
+        genotypeHash = self.hash_genotype(genotype)
+        self.combine(self.genotypes, genotypeHash, 1, avgQscore, seqID, seqOffset, self.seqCount, genotype)
+        self.seqIDs.append(seqID)
+        self.seqHashes.append(genotypeHash)
+        self.seqCount += 1
+        self.check_memory()
+
+    def update(self, other):
+        """adds all sequences from another in-memory GenotypeAggregator, which must contain sequences that
+        appear after all sequences already added"""
+        for genotypeHash, (count, avgQscore, seqID, seqOffset, firstSeq, genotype) in other.genotypes.items():
+            self.combine(self.genotypes, genotypeHash, count, avgQscore, seqID, seqOffset, firstSeq+self.seqCount, genotype)
+        self.seqIDs.extend(other.seqIDs)
+        self.seqHashes.extend(other.seqHashes)
+        self.seqCount += other.seqCount
+        self.check_memory()
+
+    def check_memory(self):
+        if not self.tempDir:
+            return
+        if len(self.seqIDs) >= self.seqBufferSize:
+            self.flush_seqs()
+        if len(self.genotypes) >= self.maxGenotypes:
+            self.spill()
+
+    def flush_seqs(self):
+        """appends buffered sequence IDs and genotype hashes to disk"""
+        with open(self.seqIDsPath, 'a') as f:
+            f.writelines(seqID+'\n' for seqID in self.seqIDs)
+        with open(self.seqHashesPath, 'ab') as f:
+            np.array(self.seqHashes, dtype=np.uint64).tofile(f)
+        self.seqIDs.clear()
+        self.seqHashes.clear()
+
+    def spill_path(self, run, partition):
+        return os.path.join(self.tempDir, f'genotypes_run{run}_partition{partition}.pkl')
+
+    def spill(self):
+        """writes all genotypes in memory to disk as a new run, split into partitions by hash"""
+        partitionFiles = [open(self.spill_path(self.spillRuns, partition), 'wb') for partition in range(self.partitions)]
+        for genotypeHash, entry in self.genotypes.items():
+            pickle.dump((genotypeHash, *entry), partitionFiles[genotypeHash % self.partitions])
+        for f in partitionFiles:
+            f.close()
+        self.genotypes = {}
+        self.spillRuns += 1
+
+    @staticmethod
+    def load_records(path):
+        """yields all records pickled to a file"""
+        with open(path, 'rb') as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    return
+
+    def sorted_genotypes(self, key):
+        """returns an iterator of all unique genotypes, sorted by the provided key function, as tuples of
+        (genotype hash, count, best avg quality score, representative seq ID, representative seq BAM virtual offset, index of first sequence, genotype).
+        Sets self.uniqueCount to the number of unique genotypes"""
+
+        if self.spillRuns == 0:
+            records = sorted([(genotypeHash, *entry) for genotypeHash, entry in self.genotypes.items()], key=key)
+            self.uniqueCount = len(records)
+            return iter(records)
+
+        # merge runs for each partition, then sort each partition and merge the sorted partitions
+        self.spill()
+        self.uniqueCount = 0
+        sortedPaths = []
+        for partition in range(self.partitions):
+            merged = {}
+            for run in range(self.spillRuns):
+                runPath = self.spill_path(run, partition)
+                for record in self.load_records(runPath):
+                    self.combine(merged, *record)
+                os.remove(runPath)
+            records = sorted([(genotypeHash, *entry) for genotypeHash, entry in merged.items()], key=key)
+            del merged
+            self.uniqueCount += len(records)
+            sortedPath = os.path.join(self.tempDir, f'genotypes_sorted_partition{partition}.pkl')
+            with open(sortedPath, 'wb') as f:
+                for record in records:
+                    pickle.dump(record, f)
+            sortedPaths.append(sortedPath)
+        return heapq.merge(*[self.load_records(path) for path in sortedPaths], key=key)
+
+    def seq_hashes(self, blockSize=100000):
+        """yields blocks of sequence IDs and corresponding genotype hashes in the order that sequences were
+        added, as a list of sequence IDs and a uint64 array of genotype hashes"""
+        if not self.tempDir:
+            yield self.seqIDs, np.array(self.seqHashes, dtype=np.uint64)
+            return
+        self.flush_seqs()
+        with open(self.seqIDsPath) as idFile, open(self.seqHashesPath, 'rb') as hashFile:
+            while True:
+                hashes = np.fromfile(hashFile, dtype=np.uint64, count=blockSize)
+                if len(hashes) == 0:
+                    return
+                yield [idFile.readline().rstrip('\n') for _ in range(len(hashes))], hashes
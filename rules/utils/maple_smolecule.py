@@ -1,5 +1,5 @@
 """Creation of consensus sequences from repetitive reads."""
-from collections import namedtuple
+from collections import deque, namedtuple
 from concurrent.futures import ProcessPoolExecutor
 import functools
 import os
@@ -115,6 +115,27 @@ class Read(object):
                 if med_length > length_filter:
                     yield cls(read_id, reference, subreads)
 
+    @classmethod
+    def multi_from_groups(
+            cls, groups, reference, depth_filter=1, length_filter=0):
+        """Create multiple `Read` s from subreads that are already grouped.
+
+        :param groups: iterable of (read_id, subreads) tuples, where subreads
+            is a list of `Subread` s.
+        :param reference: str, reference sequence that will be used for alignment
+        :param depth_filter: require reads to have at least this many subreads.
+        :param length_filter: require reads to have a median subread length
+            above this value.
+
+        """
+        depth_filter = max(1, depth_filter)
+        for read_id, subreads in groups:
+            subreads = [x for x in subreads if len(x.seq) > 0]
+            if len(subreads) >= depth_filter:
+                med_length = np.median([len(x.seq) for x in subreads])
+                if med_length > length_filter:
+                    yield cls(read_id, reference, subreads)
+
     @property
     def seqs(self):
         """Return a list of the subread sequences."""
@@ -314,36 +335,82 @@ def ignore_exception(func, *args, **kwargs):
     return None
 
 
-def poa_workflow(reads, threads, method='spoa'):
-    """Worker function for processing repetitive reads.
+def bounded_map(executor, func, iterable, queue_size):
+    """Map a function over an iterable using an executor, in order.
+
+    Unlike `Executor.map`, items are only taken from the iterable while
+    fewer than `queue_size` results are pending, so that a lazily generated
+    iterable is not consumed all at once.
+
+    :param executor: `concurrent.futures.Executor` instance.
+    :param func: function to apply to each item.
+    :param iterable: items to process.
+    :param queue_size: maximum number of pending results.
+
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= queue_size:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def poa_results(reads, threads, method='spoa', queue_size=None):
+    """Create pre-medaka consensus sequences and alignments for reads.
 
-    :param reads: list of `Read` s.
+    :param reads: iterable of `Read` s.
     :param threads: number of threads to use for processing.
+    :param queue_size: maximum number of reads queued for processing at
+        once. If None, all reads are queued at once.
+
+    :yields: (name, consensus, alignments) tuples, in the order of `reads`.
 
     """
-    # TODO: this is quite memory inefficient, but we can only build the header
-    #       by seeing everything.
     logger = medaka.common.get_named_logger('POAManager')
-    header = {'HD': {'VN': 1.0}, 'SQ': []}
-    consensuses = []
-    alignments = []
+    count = 0
 
     worker = functools.partial(ignore_exception, _read_worker, method=method)
     with ProcessPoolExecutor(max_workers=threads) as executor:
-        for res in executor.map(worker, reads):
+        if queue_size is None:
+            results = executor.map(worker, reads)
+        else:
+            results = bounded_map(executor, worker, reads, queue_size)
+        for res in results:
             if res is None:
                 continue
             rname, consensus, aligns = res
             logger.debug('Finished {}.'.format(rname))
             if consensus is not None:
-                header['SQ'].append({
-                    'LN': len(consensus),
-                    'SN': rname})
-                consensuses.append([rname, consensus])
-                alignments.append(aligns)
+                count += 1
+                yield rname, consensus, aligns
         logger.info(
-            "Created {} consensus with {} alignments.".format(
-                len(consensuses), len(alignments)))
+            "Created {} consensus with {} alignments.".format(count, count))
+
+
+def poa_workflow(reads, threads, method='spoa', queue_size=None):
+    """Worker function for processing repetitive reads.
+
+    :param reads: iterable of `Read` s.
+    :param threads: number of threads to use for processing.
+    :param queue_size: maximum number of reads queued for processing at
+        once. If None, all reads are queued at once.
+
+    """
+    # all consensus sequences and alignments are held in memory, as the
+    # header can only be built once every read has been processed.
+    # `poa_results` can instead be used to write them out as they complete.
+    header = {'HD': {'VN': 1.0}, 'SQ': []}
+    consensuses = []
+    alignments = []
+    for rname, consensus, aligns in poa_results(
+            reads, threads, method=method, queue_size=queue_size):
+        header['SQ'].append({
+            'LN': len(consensus),
+            'SN': rname})
+        consensuses.append([rname, consensus])
+        alignments.append(aligns)
     return header, consensuses, alignments
 
 
@@ -367,8 +434,14 @@ class MyArgs:
             return getattr(self.defaults, attr)
 
 
-def main(args):
-    """Entry point for repeat read consensus creation."""
+def prepare_args(args):
+    """Wrap parsed `maple_smolecule` arguments with the `consensus` defaults.
+
+    :param args: parsed `maple_smolecule` arguments.
+
+    :returns: `MyArgs` instance.
+
+    """
     parser = medaka.medaka.medaka_parser()
     defaults = parser.parse_args([
         "consensus", medaka.medaka.CheckBam.fake_sentinel,
@@ -376,56 +449,64 @@ def main(args):
 
     args = MyArgs(args, defaults)
 
-    logger = medaka.common.get_named_logger('Smolecule')
     if args.chunk_ovlp >= args.chunk_len:
         raise ValueError(
             'chunk_ovlp {} must be smaller than chunk_len {}'.format(
                 args.chunk_ovlp, args.chunk_len))
     medaka.common.mkdir_p(args.output, info='Results will be overwritten.')
+    return args
 
-    def _multi_file_reader():
-        for fname in args.fasta:
-            try:
-                yield Read.from_fastx(fname)
-            except Exception:
-                pass
 
-    with open(args.reference, 'r') as ref:
+def read_reference(fname):
+    """Read the reference sequence from a single entry fasta file."""
+    with open(fname, 'r') as ref:
         reference = ref.readlines()[1].upper()
+    return reference
 
-    if len(args.fasta) > 1:
-        logger.info(
-            "Given {} input files, assuming one read per file.".format(
-                len(args.fasta)))
-        reads = _multi_file_reader()
-    else:
-        logger.info(
-            "Given one input file, subreads are assumed "
-            "to be grouped by read.")
-        reads = Read.multi_from_fastx(
-            args.fasta[0], reference, depth_filter=args.depth, length_filter=args.length)
 
-    logger.info(
-        "Running {} pre-medaka consensus for all reads.".format(args.method))
-    t0 = now()
-    header, consensuses, alignments = poa_workflow(
-        reads, args.threads, method=args.method)
-    t1 = now()
+def write_medaka_inputs(out_dir, header, consensuses, alignments):
+    """Write the output of `poa_workflow` to medaka input files.
 
+    :param out_dir: output directory, which must already exist.
+    :param header: bam header produced by `poa_workflow`.
+    :param consensuses: list of [name, consensus] lists produced by
+        `poa_workflow`.
+    :param alignments: list of lists of `Alignment` s produced by
+        `poa_workflow`.
+
+    :returns: paths of the alignment bam and the POA consensus fasta.
+
+    """
+    logger = medaka.common.get_named_logger('Smolecule')
     logger.info(
         "Writing medaka input bam for {} reads.".format(len(alignments)))
-    bam_file = os.path.join(args.output, 'subreads_to_spoa.bam')
+    bam_file = os.path.join(out_dir, 'subreads_to_spoa.bam')
     write_bam(bam_file, alignments, header)
 
-    spoa_file = os.path.join(args.output, 'poa.fasta')
+    spoa_file = os.path.join(out_dir, 'poa.fasta')
     with open(spoa_file, 'w') as fh:
         for rname, cons in consensuses:
             fh.write('>{}\n{}\n'.format(rname, cons))
+    return bam_file, spoa_file
+
+
+def medaka_consensus(args, out_dir, bam_file, spoa_file):
+    """Run medaka on alignments of subreads to POA consensus sequences.
+
+    :param args: arguments produced by `prepare_args`.
+    :param out_dir: output directory, which must already exist.
+    :param bam_file: indexed bam of subread alignments, as written by
+        `write_bam`.
+    :param spoa_file: fasta of POA consensus sequences, in the same order
+        as the bam header.
 
+    :returns: path of the consensus output file.
+
+    """
+    logger = medaka.common.get_named_logger('Smolecule')
     logger.info("Running medaka consensus.")
     t2 = now()
     args.bam = bam_file
-    out_dir = args.output
     args.output = os.path.join(out_dir, 'consensus.hdf')
     # we run this in a subprocess so GPU resources are all cleaned
     # up when things are finished
@@ -447,6 +528,45 @@ def main(args):
     logger.info(
         "Single-molecule consensus sequences written to {}.".format(
             args.output))
+    logger.info("medaka time: {:.0f}s".format(t3 - t2))
+    return args.output
+
+
+def main(args):
+    """Entry point for repeat read consensus creation."""
+    args = prepare_args(args)
+
+    logger = medaka.common.get_named_logger('Smolecule')
+
+    def _multi_file_reader():
+        for fname in args.fasta:
+            try:
+                yield Read.from_fastx(fname)
+            except Exception:
+                pass
+
+    reference = read_reference(args.reference)
+
+    if len(args.fasta) > 1:
+        logger.info(
+            "Given {} input files, assuming one read per file.".format(
+                len(args.fasta)))
+        reads = _multi_file_reader()
+    else:
+        logger.info(
+            "Given one input file, subreads are assumed "
+            "to be grouped by read.")
+        reads = Read.multi_from_fastx(
+            args.fasta[0], reference, depth_filter=args.depth, length_filter=args.length)
+
     logger.info(
-        "POA time: {:.0f}s, medaka time: {:.0f}s".format(
-            t1 - t0, t3 - t2))
+        "Running {} pre-medaka consensus for all reads.".format(args.method))
+    t0 = now()
+    header, consensuses, alignments = poa_workflow(
+        reads, args.threads, method=args.method)
+    t1 = now()
+    logger.info("POA time: {:.0f}s".format(t1 - t0))
+
+    bam_file, spoa_file = write_medaka_inputs(
+        args.output, header, consensuses, alignments)
+    medaka_consensus(args, args.output, bam_file, spoa_file)
@@ -5,22 +5,73 @@ import numpy as np
 import pandas as pd
 import re
 import pysam
+import os
+import csv
+import tempfile
+import multiprocessing as mp
+from BAM_chunks import chunk_BAM
+from genotype_aggregation import GenotypeAggregator
 
 ### Asign variables from config file
 config = snakemake.config
-BAMin = str(snakemake.input.bam)
-tag = BAMin.strip('.bam').split('/')[1].split('_')[0]
+tag = snakemake.wildcards.tag
 ###
 
 outputDir = 'mutation_data'
 
 def main():
-    x = MutationAnalysis(config, tag, BAMin, snakemake.output)
-    x.process_seqs()
+    if hasattr(snakemake.input, 'bams'): # batch of demultiplexed barcode groups
+        analyze_BAM_groups([str(BAM) for BAM in snakemake.input.bams], snakemake.params.stagingDir, snakemake.threads)
+    else:
+        x = MutationAnalysis(config, tag, str(snakemake.input.bam), snakemake.output, snakemake.threads)
+        x.process_seqs()
+
+def analyze_BAM_groups(BAMs, stagingDir, threads):
+    """analyzes each of a list of demultiplexed BAM files, named as demux/{tag}_{barcodes}.bam, writing outputs for each to
+    {stagingDir}/{barcodes}/{tag}_{barcodes}_{datatype}. Reference data is prepared once and shared by all barcode groups,
+    and if threads > 1, barcode groups are analyzed in parallel by a pool of worker processes, largest BAM files first"""
+
+    if not BAMs:    # no barcode groups were demultiplexed for this tag
+        return
+    x = MutationAnalysis(config, tag, BAMs[0], [], 1)
+    datatypes = ['alignments.txt', 'genotypes.csv', 'seq-IDs.csv', 'failures.csv', 'NT-muts-frequencies.csv', 'NT-muts-distribution.csv']
+    if x.doAAanalysis:
+        datatypes.extend(['AA-muts-frequencies.csv', 'AA-muts-distribution.csv'])
+    groups = []
+    for BAM in sorted(BAMs, key=os.path.getsize, reverse=True):
+        barcodes = os.path.basename(BAM)[len(tag)+1:-len('.bam')]
+        os.makedirs(os.path.join(stagingDir, barcodes), exist_ok=True)
+        groups.append((BAM, [os.path.join(stagingDir, barcodes, f'{tag}_{barcodes}_{datatype}') for datatype in datatypes]))
+
+    if threads > 1:
+        with mp.get_context('fork').Pool(threads, initializer=init_worker, initargs=(x,)) as pool:
+            for _ in pool.imap_unordered(analyze_group, groups):
+                pass
+    else:
+        init_worker(x)
+        for group in groups:
+            analyze_group(group)
+
+def init_worker(mutationAnalysis):
+    """initializer for processes in a multiprocessing pool. Processes are forked, so the MutationAnalysis
+    object, including all reference data, is shared with the parent process rather than being copied for each chunk"""
+    global workerMutationAnalysis
+    workerMutationAnalysis = mutationAnalysis
+
+def analyze_chunk(chunk):
+    """multiprocessing worker function, analyzes a chunk of reads from the BAM file input.
+    `chunk` is a tuple of the BGZF virtual offset of the first read and the number of reads in the chunk"""
+    return workerMutationAnalysis.analyze_BAM_chunk(*chunk)
+
+def analyze_group(group):
+    """multiprocessing worker function, analyzes a single barcode group. `group` is a tuple of the BAM file
+    input and the list of output file names"""
+    workerMutationAnalysis.BAMin, workerMutationAnalysis.outputList = group
+    workerMutationAnalysis.process_seqs()
 
 class MutationAnalysis:
 
-    def __init__(self, config, tag, BAMin, output):
+    def __init__(self, config, tag, BAMin, output, threads=1):
         """
         arguments:
 
@@ -28,6 +79,7 @@ class MutationAnalysis:
         tag             - tag for which all BAM files will be demultiplexed, defined in config file
         BAMin           - BAM file input
         output          - list of output file names
+        threads         - number of processes to use. If >1, the BAM file is split into chunks of reads that are analyzed in parallel
         """
         refSeqfasta = config['runs'][tag]['reference']
         self.ref = list(SeqIO.parse(refSeqfasta, 'fasta'))[0]
@@ -41,6 +93,10 @@ class MutationAnalysis:
         self.desiredGenotypeIDs = config.get('genotype_ID_alignments', 0)
         self.BAMin = BAMin
         self.outputList = output
+        self.threads = threads
+        self.chunkSize = config.get('mutation_analysis_chunk_size', 10000)
+        self.mutsBatchSize = 1000 # number of sequences for which mutations are accumulated before being added to mutation arrays
+        self.maxGenotypesInMemory = config.get('mutation_analysis_genotypes_in_memory', 1000000)
         self.refTrimmedStart = self.refStr.find(self.refTrimmedStr)
         self.useReverseComplement = False
         if self.refTrimmedStart == -1:
@@ -68,13 +124,60 @@ class MutationAnalysis:
         self.AAs = "ACDEFGHIKLMNPQRSTVWY*"
         self.NTs = "ATGC"
 
+        # integer encoding of indels, see render_genotype(). Indel positions may be negative, for deletions that begin before the trimmed reference
+        self.indelIDoffset = len(self.refStr)+1
+        self.indelIDmultiplier = 2*self.indelIDoffset
+
+        # uint8 representations of sequences used to build alignments with numpy. the reference within the trimmed reference is
+        #   the same for every alignment because insertions are not added to alignments
+        self.gap = ord('-')
+        self.refTrimmedArray = np.frombuffer(self.refStr[self.refTrimmedStart:self.refTrimmedEnd].encode('ascii'), dtype=np.uint8)
+        IUPAC = 'ACGTRYSWKMBDHVN'
+        self.complementTable = np.arange(256, dtype=np.uint8) # lookup table of ASCII codes for base complements, other characters are unchanged
+        self.complementTable[np.frombuffer(IUPAC.encode('ascii'), dtype=np.uint8)] = np.frombuffer(str(Seq(IUPAC).complement()).encode('ascii'), dtype=np.uint8)
+        self.complementStrTable = str.maketrans(IUPAC, str(Seq(IUPAC).complement())) # same as above, for inserted sequences
+
+        # lookup tables used to identify mutations without per-base python operations. ASCII codes of characters that are not in
+        #   self.NTs or self.AAs index the last column, as str.find() returning -1 did previously
+        self.NTindex = np.full(256, len(self.NTs)-1, dtype=np.intp)
+        self.NTindex[np.frombuffer(self.NTs.encode('ascii'), dtype=np.uint8)] = np.arange(len(self.NTs))
+        self.AAindex = np.full(256, len(self.AAs)-1, dtype=np.intp)
+        self.AAindex[np.frombuffer(self.AAs.encode('ascii'), dtype=np.uint8)] = np.arange(len(self.AAs))
+        bases = 'ACGT'
+        self.baseCodes = np.full(256, 4, dtype=np.intp) # 2 bit code for each unambiguous base, 4 for any other character
+        self.baseCodes[np.frombuffer(bases.encode('ascii'), dtype=np.uint8)] = np.arange(4)
+        codons = ''.join([a+b+c for a in bases for b in bases for c in bases])
+        self.codonTable = np.frombuffer(str(Seq(codons).translate()).encode('ascii'), dtype=np.uint8) # ASCII code of the amino acid encoded by each of the 64 codons, indexed by 16*base1 + 4*base2 + base3
+        self.ambiguousCodons = {} # cache of translations for codons that contain characters other than A, C, G, or T
+
+        # reference sequence and amino acids as they appear in alignments, used to render the wild type of each mutation
+        if self.useReverseComplement:
+            self.alignmentRef = self.complementTable[self.refTrimmedArray[::-1]]
+        else:
+            self.alignmentRef = self.refTrimmedArray
+        if self.doAAanalysis:
+            protLength = int(len(self.refProtein)/3)
+            self.refAAs = self.translate_codons(self.alignmentRef[self.refProteinStart + 3*np.arange(protLength)[:,None] + np.arange(3)])
 
     def clean_alignment(self, BAMentry):
         """given a pysam.AlignmentFile BAM entry,
         trims the ends off the query and reference sequences according to the trimmed reference,
-        aligns these two strings as well as the quality scores, and creates an alignment string between the
-        two trimmed sequences  where '|'=match, and '.'=mismatch, and returns these three strings, the list of quality
-        scores, a list of all insertions, and a list of all deletions
+        and aligns these two sequences as well as the quality scores. The alignment is built as
+        uint8 arrays by vectorized operations over the match segments of the CIGAR, so no per-base
+        python objects are created. Returns a list of the following:
+
+        If the trimmed reference is the reverse complement of the reference (self.useReverseComplement), the alignment is built
+        directly in the orientation of the trimmed reference, with the query complemented and all positions given within the trimmed reference
+
+            ref         - uint8 array of reference sequence ASCII codes within the trimmed reference
+            matches     - bool array, True where the aligned query base is identical to the reference base
+            seq         - uint8 array of query sequence ASCII codes aligned to ref, with '-' for deleted bases
+            qScores     - uint8 array of query quality scores aligned to ref, with 0 for deleted bases, or None
+                            if quality scores are not being used
+            insertions  - list of tuples where first element is index within trimmed reference, second element is sequence inserted
+            deletions   - list of tuples where first element is index within trimmed reference, second element is number of bases deleted
+
+        strings for a human readable alignment are only produced on request, by format_alignment()
         """
 
         if BAMentry.reference_name != self.ref.id:
@@ -89,84 +192,78 @@ class MutationAnalysis:
             self.alignmentFailureReason = ('alignment ends before trimmed reference end', 'N/A')
             return None
 
-        refIndex = BAMentry.reference_start
-        queryIndex = 0
-        refAln = ' ' * refIndex  #pad beginning of alignment when alignment begins after beginning of reference
-        queryAln = ' ' * refIndex
-        queryQualities = [-1] * refIndex if self.fastq else None
-        alignStr = ' ' * refIndex
+        querySeq = BAMentry.query_alignment_sequence # property that copies the sequence, so only retrieved once
+
+        # reference and query start positions of each cigar operation. Only matches (0), insertions (1), and deletions (2) are used
+        cigar = np.array(BAMentry.cigartuples, dtype=np.int64)
+        ops, lengths = cigar[:,0], cigar[:,1]
+        refLengths = np.where((ops==0) | (ops==2), lengths, 0)
+        queryLengths = np.where((ops==0) | (ops==1), lengths, 0)
+        refStarts = BAMentry.reference_start + np.cumsum(refLengths) - refLengths
+        queryStarts = np.cumsum(queryLengths) - queryLengths
+
         insertions = [] # list of tuples where first element is index within trimmed reference, second element is sequence inserted
         deletions = []  # list of tuples where first element is index within trimmed reference, second element is number of bases deleted
 
-        for cTuple in BAMentry.cigartuples: # build pretty alignment through combining consecutive segments, which are determined by the cigar tuples, in which the first value determines the operation and the second value determines the length
-
-            if cTuple[0] == 0: #no indel
-                refSegment = self.refStr[refIndex:refIndex+cTuple[1]]
-                querySegment = BAMentry.query_alignment_sequence[queryIndex:queryIndex+cTuple[1]]
-                alignSegment = ''.join(['|' if r==q else '.' for r,q in zip(refSegment,querySegment)])
-                refAln += refSegment
-                queryAln += querySegment
-                if self.fastq:
-                    queryQualities += BAMentry.query_alignment_qualities[queryIndex:queryIndex+cTuple[1]]
-                alignStr += alignSegment
-                refIndex += cTuple[1]
-                queryIndex += cTuple[1]
-
-            elif cTuple[0] == 1: #insertion, not added to sequence to maintain alignment to reference
-                if self.doAAanalysis and not self.config['analyze_seqs_w_frameshift_indels'] and cTuple[1]%3 != 0 and self.refProteinStart <= refIndex < self.refProteinEnd: # frameshift, discard sequence if protein sequence analysis is being done and indel sequences are being ignored
+        indels = (ops==1) | (ops==2)
+        for op, length, refIndex, queryIndex in zip(ops[indels].tolist(), lengths[indels].tolist(), refStarts[indels].tolist(), queryStarts[indels].tolist()):
+
+            if op == 1: #insertion, not added to sequence to maintain alignment to reference
+                if self.doAAanalysis and not self.config['analyze_seqs_w_frameshift_indels'] and length%3 != 0 and self.refProteinStart <= refIndex < self.refProteinEnd: # frameshift, discard sequence if protein sequence analysis is being done and indel sequences are being ignored
                     self.alignmentFailureReason = ('frameshift insertion', queryIndex)
                     return None
                 if self.refTrimmedStart <= refIndex < self.refTrimmedEnd: # record insertions as tuples of position and sequence
-                    insertions.append((refIndex-self.refTrimmedStart, BAMentry.query_alignment_sequence[queryIndex:queryIndex+cTuple[1]]))
-                queryIndex += cTuple[1]
+                    insertions.append((refIndex-self.refTrimmedStart, querySeq[queryIndex:queryIndex+length]))
 
-            elif cTuple[0] == 2: #deletion, '-' added to sequence to maintain alignment to reference
-                if self.doAAanalysis and not self.config['analyze_seqs_w_frameshift_indels'] and cTuple[1]%3 != 0 and ( self.refProteinStart <= refIndex + cTuple[1] ) and ( refIndex < self.refProteinEnd ): # frameshift, discard sequence if protein sequence analysis is being done and indel sequences are being ignored
+            else: #deletion, '-' added to sequence to maintain alignment to reference
+                if self.doAAanalysis and not self.config['analyze_seqs_w_frameshift_indels'] and length%3 != 0 and ( self.refProteinStart <= refIndex + length ) and ( refIndex < self.refProteinEnd ): # frameshift, discard sequence if protein sequence analysis is being done and indel sequences are being ignored
                     self.alignmentFailureReason = ('frameshift deletion', queryIndex)
                     return None
-                refAln += self.refStr[refIndex:refIndex+cTuple[1]]
-                queryAln += '-'*cTuple[1]
-                alignStr += ' '*cTuple[1]
-                if self.fastq:
-                    queryQualities += [0]*cTuple[1]
                 # record deletions that are present within the nucleotide analysis window
-                if ( self.refTrimmedStart <= refIndex + cTuple[1] ) and ( refIndex < self.refTrimmedEnd ): # record deletions as tuples of position and length
-                    deletions.append((refIndex-self.refTrimmedStart, cTuple[1]))
-                refIndex += cTuple[1]
-
-        return  [refAln[self.refTrimmedStart:self.refTrimmedEnd],
-                alignStr[self.refTrimmedStart:self.refTrimmedEnd],
-                queryAln[self.refTrimmedStart:self.refTrimmedEnd],
-                queryQualities[self.refTrimmedStart:self.refTrimmedEnd] if self.fastq else None,
-                insertions,
-                deletions]
-
-    def clean_alignment_reverse_complement(self, cleanAlignment):
-        """
-        given the output from `clean_alignment`, will remake each of the components using the reverse
-        (for alignment string and deletions), and reverse complement (for reference, query sequence,
-        and insertions) of the sequence
-        """
-        
-        ref, alignStr, seq, qScores, insertions, deletions = cleanAlignment
-
-        ref = str(Seq(ref).reverse_complement())
-        alignStr = alignStr[::-1]
-        seq = str(Seq(seq).reverse_complement())
-        qScores = qScores[::-1] if qScores else None
-
-        insertions.reverse()
-        deletions.reverse()
+                if ( self.refTrimmedStart <= refIndex + length ) and ( refIndex < self.refTrimmedEnd ): # record deletions as tuples of position and length
+                    deletions.append((refIndex-self.refTrimmedStart, length))
+
+        # expand match segments into the reference position of every matched base and the query position aligned to it,
+        #   then keep only those within the trimmed reference. Positions within the trimmed reference that are not covered are deletions
+        isMatch = ops==0
+        matchLengths = lengths[isMatch]
+        segmentOffsets = np.cumsum(matchLengths) - matchLengths
+        refPositions = np.repeat(refStarts[isMatch] - segmentOffsets, matchLengths) + np.arange(matchLengths.sum())
+        queryPositions = refPositions + np.repeat(queryStarts[isMatch] - refStarts[isMatch], matchLengths)
+        first, last = np.searchsorted(refPositions, [self.refTrimmedStart, self.refTrimmedEnd])
+        alignedPositions = refPositions[first:last] - self.refTrimmedStart
+        queryPositions = queryPositions[first:last]
+        queryBases = np.frombuffer(querySeq.encode('ascii'), dtype=np.uint8)[queryPositions]
+
+        ref = self.alignmentRef
+        if self.useReverseComplement:
+            alignedPositions = (len(ref)-1) - alignedPositions
+            queryBases = self.complementTable[queryBases]
+            insertions = [(len(ref)-index, NTs.translate(self.complementStrTable)[::-1]) for index, NTs in reversed(insertions)]
+            deletions = [(len(ref)-index-length, length) for index, length in reversed(deletions)]
+
+        seq = np.full(len(ref), self.gap, dtype=np.uint8)
+        seq[alignedPositions] = queryBases
+        matches = seq == ref
+
+        if self.fastq:
+            qScores = np.zeros(len(ref), dtype=np.uint8)
+            qScores[alignedPositions] = np.asarray(BAMentry.query_alignment_qualities, dtype=np.uint8)[queryPositions]
+        else:
+            qScores = None
 
-        insertionsOut = []
-        for ins in insertions:
-            insertionsOut.append( (len(self.refTrimmedStr) - ins[0], str(Seq(ins[1]).reverse_complement())) )
+        return [ref, matches, seq, qScores, insertions, deletions]
 
-        deletionsOut = []
-        for dels in deletions:
-            deletionsOut.append( (len(self.refTrimmedStr) - dels[0] - dels[1], dels[1]) )
+    def format_alignment(self, cleanAlignment):
+        """given the output from `clean_alignment`, returns
+        the reference, alignment, and query strings used for a human readable alignment, where in the alignment
+        string '|'=match, '.'=mismatch, and ' '=deletion"""
 
-        return [ref, alignStr, seq, qScores, insertionsOut, deletionsOut]
+        ref, matches, seq, _, _, _ = cleanAlignment
+        alignment = np.full(len(ref), ord('.'), dtype=np.uint8)
+        alignment[seq==self.gap] = ord(' ')
+        alignment[matches] = ord('|')
+        return [array.tobytes().decode('ascii') for array in [ref, alignment, seq]]
 
     def ID_muts(self, cleanAlignment):
         """ Identify mutations in an aligned sequence
@@ -175,125 +272,340 @@ class MutationAnalysis:
         is above globally set threshold.
 
         Outputs:
-            ntMutArray  - x by y array where x is the length of self.refTrimmed, representing each
-                            nucleotide position within this sequence, and y is four, representing the
-                            possible nucleotides that a base could be mutated to. values in the array
-                            will be set to 1 if a mutation at position x is mutated to nucleotide that
-                            corresponds to position y. If no mutations are found, an array of 0s is returned 
-            aaMutArray  - x by y array where x is the length of self.refORF, representing each
-                            amino acid position within this sequence, and y is the length of self.AAs,
-                            representing the number of
-                            possible nucleotides that a base could be mutated to. values in the array
-                            will be set to 1 if a mutation at position x is mutated to amino acid that
-                            corresponds to position y. If no mutations are found, an array of 0s is returned
-            genotype    - list of strings where each string is a list of different types of mutations separated by ', '.
-                            Includes AA mutations in list only if self.doAAanalysis is True
+            ntMuts      - 1D array of the flat indices of this sequence's NT mutations within an x by y array, where
+                            x is the length of self.refTrimmed, representing each nucleotide position within this
+                            sequence, and y is four, representing the possible nucleotides that a base could be
+                            mutated to. i.e. a mutation at position x to the nucleotide that corresponds to position y
+                            has index x*4+y. If no mutations are found, an empty array is returned
+            aaMuts      - same as ntMuts but for an x by y array where x is the length of self.refORF, representing each
+                            amino acid position within this sequence, and y is the length of self.AAs, representing
+                            the possible amino acids that a codon could be mutated to. None if self.doAAanalysis is False
+            genotype    - tuple of integer encoded mutations, see render_genotype()
+        """
+        ref, matches, seq, qScores, insertions, deletions = cleanAlignment
+
+        # indices of substitutions, ignoring those with quality scores below the threshold
+        mismatches = np.flatnonzero(~matches & (seq != self.gap))
+        if qScores is not None:
+            mismatches = mismatches[qScores[mismatches] >= self.QSminimum]
+
+        NTmuts = mismatches*len(self.NTs) + self.NTindex[seq[mismatches]]
+        NTsubstitutions = tuple((mismatches*256 + seq[mismatches]).tolist())
+        insertionIDs = tuple([int.from_bytes(NTs.encode('ascii'), 'big')*self.indelIDmultiplier + index+self.indelIDoffset for index, NTs in insertions])
+        deletionIDs = tuple([length*self.indelIDmultiplier + index+self.indelIDoffset for index, length in deletions])
+
+        genotype = (NTsubstitutions, insertionIDs, deletionIDs)
+
+        if not self.doAAanalysis:
+            return NTmuts, None, genotype
+
+        protLength = int(len(self.refProtein)/3)
+
+        indelCodons = np.zeros(protLength, dtype=bool)    # amino acid positions that are affected by indel (for insertion, insertion is within a codon; for deletion, at least one base of codon deleted)
+        for index, _ in insertions:
+            if self.refProteinStart <= index < self.refProteinEnd:
+                protIndex = index-self.refProteinStart
+                if protIndex%3 == 0: continue # ignore if insertion occurs between codons
+                else: indelCodons[int(protIndex/3)] = True
+
+        for index, length in deletions:
+            if (self.refProteinStart <= index < self.refProteinEnd) or (self.refProteinStart <= index+length < self.refProteinEnd):
+                protIndexStart = index-self.refProteinStart
+                protIndexEnd = (index+length)-self.refProteinStart
+                firstCodon = int(protIndexStart/3)
+                lastCodon = int(protIndexEnd/3)
+                indelCodons[max(firstCodon,0):lastCodon+1] = True
+
+        # codons that contain a substitution, excluding those containing bases influenced by an indel
+        #   or with a quality score below the threshold for either of the first two bases of the codon
+        protMismatches = mismatches[(self.refProteinStart <= mismatches) & (mismatches < self.refProteinEnd)]
+        codons = np.unique((protMismatches-self.refProteinStart) // 3) # 0-index amino acid positions
+        codons = codons[~indelCodons[codons]]
+        codonIndices = self.refProteinStart + 3*codons[:,None] + np.arange(3)
+        if qScores is not None:
+            codonsQSok = (qScores[codonIndices[:, :2]] >= self.QSminimum).all(axis=1)
+            codons, codonIndices = codons[codonsQSok], codonIndices[codonsQSok]
+
+        wtAAs = self.translate_codons(ref[codonIndices])
+        mutAAs = self.translate_codons(seq[codonIndices])
+        nonsynonymous = wtAAs != mutAAs
+        AAmuts = codons[nonsynonymous]*len(self.AAs) + self.AAindex[mutAAs[nonsynonymous]]
+
+        AAnonsynonymous = tuple((codons[nonsynonymous]*256 + mutAAs[nonsynonymous]).tolist())
+        AAsynonymous = tuple(codons[~nonsynonymous].tolist())
+        genotype += (AAnonsynonymous, AAsynonymous)
+
+        return NTmuts, AAmuts, genotype
+
+    def render_genotype(self, genotype):
+        """renders an integer encoded genotype, as output by ID_muts() with the barcode(s) of the sequence appended if
+        self.barcodeColumn is True, as a list of values for the columns in self.genotypesColumns[2:].
+        Mutations are encoded as follows, where all positions are 0-indexed:
+
+            NT substitutions            - position*256 + ASCII code of the mutant nucleotide. The wild type nucleotide is that of the
+                                            reference at this position
+            insertions                  - integer of the big endian ASCII bytes of the inserted sequence * self.indelIDmultiplier +
+                                            position+self.indelIDoffset
+            deletions                   - length * self.indelIDmultiplier + position+self.indelIDoffset
+            AA nonsynonymous mutations  - codon*256 + ASCII code of the mutant amino acid. The wild type amino acid is that of the
+                                            reference at this codon
+            AA synonymous mutations     - codon
         """
-        ref, alignStr, seq, qScores, insertions, deletions = cleanAlignment
+        NTsubstitutions, insertionIDs, deletionIDs = genotype[:3]
+        NTsubstitutions = [chr(self.alignmentRef[ID>>8])+str((ID>>8)+1)+chr(ID&255) for ID in NTsubstitutions] # genotype output 1-index
+        insertions = []
+        for ID in insertionIDs:
+            NTs = ID // self.indelIDmultiplier
+            insertions.append(str(ID%self.indelIDmultiplier - self.indelIDoffset)+'ins'+NTs.to_bytes((NTs.bit_length()+7)//8, 'big').decode('ascii'))
+        deletions = [str(ID%self.indelIDmultiplier - self.indelIDoffset)+'del'+str(ID//self.indelIDmultiplier) for ID in deletionIDs]
 
-        mismatches = [i for i,a in enumerate(alignStr) if a=='.']
+        row = [', '.join(NTsubstitutions), len(NTsubstitutions), ', '.join(insertions), ', '.join(deletions)]
 
         if self.doAAanalysis:
-            indelCodons = []    # list of amino acid positions that are affected by indel (for insertion, insertion is within a codon; for deletion, at least one base of codon deleted)
-            for index, _ in insertions:
-                if self.refProteinStart <= index < self.refProteinEnd:
-                    protIndex = index-self.refProteinStart
-                    if protIndex%3 == 0: continue # ignore if insertion occurs between codons
-                    else: indelCodons.append( int(protIndex/3) )
-
-            for index, length in deletions:
-                if (self.refProteinStart <= index < self.refProteinEnd) or (self.refProteinStart <= index+length < self.refProteinEnd):
-                    protIndexStart = index-self.refProteinStart
-                    protIndexEnd = (index+length)-self.refProteinStart
-                    firstCodon = int(protIndexStart/3)
-                    lastCodon = int(protIndexEnd/3)
-                    indelCodons.extend([i for i in range(firstCodon,lastCodon+1)])
-            self.indelCodons = indelCodons
-            AAmutArray = np.zeros((int(len(self.refProtein)/3), len(self.AAs)), dtype=int)
+            AAnonsynonymous, AAsynonymous = genotype[3:5]
+            AAnonsynonymous = [chr(self.refAAs[ID>>8])+str((ID>>8)+1)+chr(ID&255) for ID in AAnonsynonymous] # genotype output 1-index
+            AAsynonymous = [chr(self.refAAs[codon])+str(codon+1) for codon in AAsynonymous]
+            row.extend([', '.join(AAnonsynonymous), ', '.join(AAsynonymous), len(AAnonsynonymous)])
         else:
-            AAmutArray = None
+            AAnonsynonymous = []
 
-        insOutput = ', '.join([str(index)+'ins'+NTs for index,NTs in insertions])               # string of all insertions for genotype output
-        delOutput = ', '.join([str(index)+'del'+str(length) for index,length in deletions])     # string of all deletions for genotype output
+        if self.barcodeColumn:
+            row.append(genotype[-1])
 
-        NTmutArray = np.zeros((int(len(self.refTrimmedStr)), len(self.NTs)), dtype=int)
-        codonsChecked = []
-        NTsubstitutions = []
-        AAnonsynonymous = []
-        AAsynonymous = []
+        if self.config['runs'][tag].get('NT_muts_of_interest', False):
+            row.extend(self.muts_of_interest_columns(genotype, [0, 1, 2], self.NT_muts_of_interest, self.NTmutsOfInterestBits))
 
-        for i in mismatches:
+        if self.doAAanalysis and self.config['runs'][tag].get('AA_muts_of_interest', False):
+            row.extend(self.muts_of_interest_columns(genotype, [3], self.AA_muts_of_interest, self.AAmutsOfInterestBits))
+
+        return row
+
+    def compile_muts_of_interest(self, mutsOfInterest, AA=False):
+        """compiles a list of mutations of interest into a dictionary that maps the integer encoding of each mutation
+        (see render_genotype()) to a bitmask, where bit i is set if the mutation is mutsOfInterest[i]. Keys are tuples of
+        the index of the mutation type within the genotype tuple and the integer encoding. Mutations of interest that
+        can never be present in a genotype, e.g. if the wild type does not match the reference, are not included"""
+
+        mutsOfInterestBits = {}
+        for i, mut in enumerate(mutsOfInterest):
+            if AA:
+                match = re.fullmatch(r'(\S)(\d+)(\S)', mut)
+                if not match: continue
+                wt, codon, mutAA = match.group(1), int(match.group(2))-1, match.group(3)
+                if not (0 <= codon < len(self.refAAs)) or chr(self.refAAs[codon]) != wt: continue
+                key = (3, codon*256 + ord(mutAA))
+            elif re.fullmatch(r'-?\d+ins\S+', mut):
+                index, NTs = mut.split('ins', 1)
+                key = (1, int.from_bytes(NTs.encode('ascii'), 'big')*self.indelIDmultiplier + int(index)+self.indelIDoffset)
+            elif re.fullmatch(r'-?\d+del\d+', mut):
+                index, length = mut.split('del')
+                key = (2, int(length)*self.indelIDmultiplier + int(index)+self.indelIDoffset)
+            else:
+                match = re.fullmatch(r'(\S)(\d+)(\S)', mut)
+                if not match: continue
+                wt, posi, mutNT = match.group(1), int(match.group(2))-1, match.group(3)
+                if not (0 <= posi < len(self.alignmentRef)) or chr(self.alignmentRef[posi]) != wt: continue
+                key = (0, posi*256 + ord(mutNT))
+            mutsOfInterestBits[key] = mutsOfInterestBits.get(key, 0) | (1 << i)
+        return mutsOfInterestBits
+
+    def muts_of_interest_columns(self, genotype, mutTypes, mutsOfInterest, mutsOfInterestBits):
+        """returns the values of the mutations of interest columns for an integer encoded genotype, a string of all mutations
+        of interest that are present followed by a one-hot encoding of each mutation of interest. mutTypes is a list of the
+        indices of the mutation types within the genotype tuple to check, and mutsOfInterestBits is the output of
+        compile_muts_of_interest() for mutsOfInterest"""
+
+        bits = 0
+        for mutType in mutTypes:
+            for ID in genotype[mutType]:
+                bits |= mutsOfInterestBits.get((mutType, ID), 0)
+        mutOneHot = [(bits >> i) & 1 for i in range(len(mutsOfInterest))]
+        mutStr = ''.join([mut for mut, present in zip(mutsOfInterest, mutOneHot) if present])
+        return [mutStr] + mutOneHot
+
+    def add_muts_batch(self, mutArray, mutDist, mutsBatch, mutCountsBatch):
+        """adds a batch of sequences' mutations, as output by ID_muts(), to a mutation array and
+        mutation distribution in place, then empties the batch lists
+
+        args:
+            mutArray        - 2D array of mutation counts for each position and each possible mutation
+            mutDist         - 1D array distribution where position (x) is number of mutations and value is number of sequences with x mutations
+            mutsBatch       - list of 1D arrays of flat indices of mutations within mutArray, one per sequence
+            mutCountsBatch  - list of the number of mutations in each sequence
+        """
+        if mutsBatch:
+            np.add.at(mutArray.reshape(-1), np.concatenate(mutsBatch), 1)
+        np.add.at(mutDist, mutCountsBatch, 1)
+        mutsBatch.clear()
+        mutCountsBatch.clear()
+
+    def translate_codons(self, codons):
+        """translates an n by 3 uint8 array of codon ASCII codes into a length n uint8 array of amino acid ASCII codes.
+        Codons made up of A, C, G, and T are translated with self.codonTable, any others with Bio.Seq"""
+
+        codes = self.baseCodes[codons]
+        unambiguous = (codes < 4).all(axis=1)
+        AAs = self.codonTable[(16*codes[:,0] + 4*codes[:,1] + codes[:,2]) & 63]
+        for i in np.flatnonzero(~unambiguous).tolist():
+            codon = codons[i].tobytes()
+            if codon not in self.ambiguousCodons:
+                self.ambiguousCodons[codon] = ord(str(Seq(codon.decode('ascii')).translate()))
+            AAs[i] = self.ambiguousCodons[codon]
+        return AAs
+
+    def empty_results(self):
+        """returns zeroed accumulators for the data returned by analyze_BAM_entries(), other than the genotypes, as a list of
+        NTmutArray, NTmutDist, AAmutArray, AAmutDist, and failuresList"""
+        trimmedSeqLength = int(len(self.refTrimmedStr))
+        NTmutArray = np.zeros((trimmedSeqLength, len(self.NTs)), dtype=int)         # see ID_muts() docstring
+        NTmutDist = np.zeros(trimmedSeqLength, dtype=int)                           # 1D array distribution where position (x) is number of mutations and value is number of sequences with x mutations 
+        failuresList = []                                                           # list of data for failed sequences that will be used to generate DataFrame
+        AAmutArray, AAmutDist = None, None
 
-            if self.fastq:
-                if qScores[i] < self.QSminimum: continue
+        if self.doAAanalysis:
+            protLength = int( len(self.refProtein) / 3 )
+            AAmutArray = np.zeros((protLength, len(self.AAs)), dtype=int)
+            AAmutDist = np.zeros(protLength, dtype=int)
 
-            wtNT = ref[i]
-            mutNT = seq[i]
+        return [NTmutArray, NTmutDist, AAmutArray, AAmutDist, failuresList]
 
-            NTmutArray[i,self.NTs.find(mutNT)] += 1
-            NTsubstitutions.append(wtNT+str(i+1)+mutNT) # genotype output 1-index
+    def analyze_BAM_entries(self, bamFile, genotypes, count=None):
+        """identifies mutations in `count` BAM entries (or all remaining entries if count is None), starting at the current position
+        of the provided pysam.AlignmentFile, adds the genotype of each sequence, along with the virtual offset of the BAM entry,
+        to the provided GenotypeAggregator, and returns the accumulated data used to produce output files, as a list of the following:
+
+            NTmutArray      - sum of the NT mutation arrays of all sequences, see ID_muts() docstring
+            NTmutDist       - 1D array distribution where position (x) is number of NT mutations and value is number of sequences with x mutations
+            AAmutArray      - sum of the AA mutation arrays of all sequences, or None if AA analysis is not being done
+            AAmutDist       - same as NTmutDist but for AA mutations, or None if AA analysis is not being done
+            genotypes       - the GenotypeAggregator. genotypes are integer encoded tuples, see render_genotype()
+            failuresList    - list of data for failed sequences
+        """
 
-            if self.doAAanalysis and self.refProteinStart <= i < self.refProteinEnd:
+        NTmutArray, NTmutDist, AAmutArray, AAmutDist, failuresList = self.empty_results()
 
-                protIndex = i-self.refProteinStart
-                codon = int(protIndex/3) # 0-index amino acid position
-                if codon in codonsChecked: continue
-                codonsChecked.append(codon)
-                codonPosi = protIndex%3
-                codonIndices = list(range(i-codonPosi, i+(3-codonPosi)))
+        # mutations of each sequence are kept as sparse lists of indices and added to the mutation arrays in batches
+        NTmutsBatch, NTmutCountsBatch, AAmutsBatch, AAmutCountsBatch = [], [], [], []
 
-                # check that codon doesn't contain any bases influenced by an indel
-                if codon in indelCodons: continue
+        entriesAnalyzed = 0
+        while count is None or entriesAnalyzed < count:
+            offset = bamFile.tell()
+            bamEntry = next(bamFile, None)
+            if bamEntry is None:
+                break
+            entriesAnalyzed += 1
 
-                #check that all three quality scores in codon are above threshold
-                if qScores:
-                    QStooLow = False
-                    codonQS = qScores[codonIndices[0]:codonIndices[2]]
-                    for qs in codonQS:
-                        if qs < self.QSminimum:
-                            QStooLow = True
-                    if QStooLow: continue
+            cleanAln = self.clean_alignment(bamEntry)
+            if cleanAln:
+                seqNTmuts, seqAAmuts, seqGenotype = self.ID_muts(cleanAln)                    
+            else:
+                failuresList.append([bamEntry.query_name, self.alignmentFailureReason[0], self.alignmentFailureReason[1]])
+                continue
 
-                wtAA = str(Seq(ref[codonIndices[0]:codonIndices[2]+1]).translate())
-                mutAA = str(Seq(seq[codonIndices[0]:codonIndices[2]+1]).translate())
+            NTmutsBatch.append(seqNTmuts)
+            NTmutCountsBatch.append(len(seqNTmuts))
+            if self.doAAanalysis:
+                AAmutsBatch.append(seqAAmuts)
+                AAmutCountsBatch.append(len(seqAAmuts))
+            if len(NTmutCountsBatch) == self.mutsBatchSize:
+                self.add_muts_batch(NTmutArray, NTmutDist, NTmutsBatch, NTmutCountsBatch)
+                if self.doAAanalysis:
+                    self.add_muts_batch(AAmutArray, AAmutDist, AAmutsBatch, AAmutCountsBatch)
 
-                if wtAA!=mutAA:
-                    AAmutArray[codon, self.AAs.find(mutAA)] += 1
-                    AAnonsynonymous.append(wtAA+str(codon+1)+mutAA) # genotype output 1-index
-                else:
-                    AAsynonymous.append(wtAA+str(codon+1))
+            if not self.fastq:
+                avgQscore = -1
+            else:
+                avgQscore = np.average(np.array(cleanAln[3]))
 
-        genotype = [', '.join(NTsubstitutions)]
-        genotype.append(len(NTsubstitutions))
-        genotype.append(insOutput)
-        genotype.append(delOutput)
+            if self.barcodeColumn:
+                seqGenotype += (bamEntry.get_tag('BC'),)
 
+            genotypes.add(bamEntry.query_name, avgQscore, seqGenotype, offset)
+
+        self.add_muts_batch(NTmutArray, NTmutDist, NTmutsBatch, NTmutCountsBatch)
         if self.doAAanalysis:
-            for subType in [AAnonsynonymous, AAsynonymous]:
-                genotype.append(', '.join(subType))
-            genotype.append(len(AAnonsynonymous))
-            
-        return NTmutArray, AAmutArray, genotype
+            self.add_muts_batch(AAmutArray, AAmutDist, AAmutsBatch, AAmutCountsBatch)
+
+        return [NTmutArray, NTmutDist, AAmutArray, AAmutDist, genotypes, failuresList]
+
+    def analyze_BAM_chunk(self, offset, count):
+        """runs analyze_BAM_entries() on a chunk of `count` reads from the BAM file input,
+        beginning with the read at BGZF virtual offset `offset`"""
+        with pysam.AlignmentFile(self.BAMin, 'rb') as bamFile:
+            bamFile.seek(offset)
+            return self.analyze_BAM_entries(bamFile, GenotypeAggregator(), count)
+
+    def genotype_sort_key(self, record):
+        """sort key for unique genotype records output by GenotypeAggregator.sorted_genotypes(). Wild type genotype(s) first,
+        then by descending count, ascending number of NT substitutions, barcode(s) if present, descending representative average
+        quality score, and finally by first appearance"""
+        genotypeHash, count, avgQscore, seqID, seqOffset, firstSeq, genotype = record
+        wildtype = not (genotype[0] or genotype[1] or genotype[2])
+        key = (not wildtype, -count, len(genotype[0]))
+        if self.barcodeColumn:
+            key += (genotype[-1],)
+        return key + (-avgQscore, firstSeq)
+
+    def write_genotypes(self, genotypes, genotypesCSV, seqIDsCSV):
+        """assigns genotype IDs to all unique genotypes in a GenotypeAggregator in order of genotype_sort_key(), and writes
+        genotypes and the genotype ID of each sequence to csv files. Genotype IDs are 1-indexed, except for the wild type
+        genotype, which is given the ID 'wildtype' if there are no barcodes in the genotype, as this would result in many
+        different 'wildtype' rows
+
+        returns a list of (genotype ID, representative sequence ID, representative sequence BAM virtual offset) tuples for genotypes
+        that alignments will be written for
+        """
+
+        sortedGenotypes = genotypes.sorted_genotypes(self.genotype_sort_key)
+        genotypeHashes = np.zeros(genotypes.uniqueCount, dtype=np.uint64)
+        genotypeIDs = []
+        alignmentGenotypeIndices = set(range(0, self.highestAbundanceGenotypes+1))
+        desiredGenotypeIndices = []
+        if self.desiredGenotypeIDs:
+            desiredGenotypeIndices = [int(ID) for ID in str(self.desiredGenotypeIDs).split(', ') if int(ID) <= genotypes.uniqueCount]
+            alignmentGenotypeIndices.update(desiredGenotypeIndices)
+        alignmentGenotypes = {}
+
+        with open(genotypesCSV, 'w', newline='') as genotypesOut:
+            writer = csv.writer(genotypesOut, lineterminator='\n')
+            writer.writerow(['genotype_ID', 'count'] + self.genotypesColumns[2:])
+            IDoffset = 1
+            for i, (genotypeHash, count, avgQscore, seqID, seqOffset, firstSeq, genotype) in enumerate(sortedGenotypes):
+                wildtype = not (genotype[0] or genotype[1] or genotype[2])
+                if i == 0 and wildtype and not self.barcodeColumn:
+                    genotypeID = 'wildtype'
+                    IDoffset = 0
+                else:
+                    genotypeID = i + IDoffset
+                genotypeHashes[i] = genotypeHash
+                genotypeIDs.append(genotypeID)
+                if i in alignmentGenotypeIndices:
+                    alignmentGenotypes[i] = (genotypeID, seqID, seqOffset)
+                writer.writerow([genotypeID, count, *self.render_genotype(genotype)])
+
+        # link every sequence ID to a genotype ID by looking up the hash of its genotype
+        hashOrder = np.argsort(genotypeHashes)
+        sortedHashes = genotypeHashes[hashOrder]
+        with open(seqIDsCSV, 'w', newline='') as seqIDsOut:
+            writer = csv.writer(seqIDsOut, lineterminator='\n')
+            writer.writerow(['seq_ID', 'genotype_ID'])
+            for seqIDs, hashes in genotypes.seq_hashes():
+                indices = hashOrder[np.searchsorted(sortedHashes, hashes)]
+                writer.writerows(zip(seqIDs, [genotypeIDs[i] for i in indices.tolist()]))
+
+        return [alignmentGenotypes[i] for i in range(min(self.highestAbundanceGenotypes+1, genotypes.uniqueCount))] + [alignmentGenotypes[i] for i in desiredGenotypeIndices]
 
     def process_seqs(self):
         """loops through a BAM file and produces appropriate .csv files to describe mutation data.
         If config['do_AA_analysis']==False, will produce only files for NT mutation data, otherwise
         will also produce AA mutation data"""
 
-        trimmedSeqLength = int(len(self.refTrimmedStr))
-        NTmutArray = np.zeros((trimmedSeqLength, len(self.NTs)), dtype=int)         # see ID_muts() docstring
-        NTmutDist = np.zeros(trimmedSeqLength, dtype=int)                           # 1D array distribution where position (x) is number of mutations and value is number of sequences with x mutations 
-        failuresList = []                                                           # list of data for failed sequences that will be used to generate DataFrame
         failuresColumns = ['seq_ID', 'failure_reason', 'failure_index']             # columns for failures DataFrame
-        genotypesList = []                                                          # list of genotypes to be converted into a DataFrame
         genotypesColumns = ['seq_ID', 'avg_quality_score', 'NT_substitutions', 'NT_substitutions_count', 'NT_insertions', 'NT_deletions'] # columns for genotypes DataFrame
         wildTypeCount = 0
         wildTypeRow = [wildTypeCount, 0, '', 0, '', '']
 
         if self.doAAanalysis:
-            protLength = int( len(self.refProtein) / 3 )
-            AAmutArray = np.zeros((protLength, len(self.AAs)), dtype=int)
-            AAmutDist = np.zeros(protLength, dtype=int)
             genotypesColumns.extend(['AA_substitutions_nonsynonymous', 'AA_substitutions_synonymous', 'AA_substitutions_nonsynonymous_count'])
             wildTypeRow.extend(['', '', 0])
 
@@ -312,6 +624,7 @@ class MutationAnalysis:
             genotypesColumns.append('NT_muts_of_interest')
             wildTypeRow.append('')
             self.NT_muts_of_interest = self.config['runs'][tag]['NT_muts_of_interest'].split(', ')
+            self.NTmutsOfInterestBits = self.compile_muts_of_interest(self.NT_muts_of_interest)
             for mut in self.NT_muts_of_interest:
                 genotypesColumns.append(mut)
                 wildTypeRow.append(0)
@@ -319,9 +632,11 @@ class MutationAnalysis:
             genotypesColumns.append('AA_muts_of_interest')
             wildTypeRow.append('')
             self.AA_muts_of_interest = self.config['runs'][tag]['AA_muts_of_interest'].split(', ')
+            self.AAmutsOfInterestBits = self.compile_muts_of_interest(self.AA_muts_of_interest, AA=True)
             for mut in self.AA_muts_of_interest:
                 genotypesColumns.append(mut)
                 wildTypeRow.append(0)
+        self.genotypesColumns = genotypesColumns
 
         bamFile = pysam.AlignmentFile(self.BAMin, 'rb')
 
@@ -332,114 +647,42 @@ class MutationAnalysis:
                 self.fastq = True
             bamFile.reset()
             break
-        
-        for bamEntry in bamFile:
-            cleanAln = self.clean_alignment(bamEntry)
-            if cleanAln:
-                if self.useReverseComplement:
-                    cleanAln = self.clean_alignment_reverse_complement(cleanAln)
-                seqNTmutArray, seqAAmutArray, seqGenotype = self.ID_muts(cleanAln)                    
-            else:
-                failuresList.append([bamEntry.query_name, self.alignmentFailureReason[0], self.alignmentFailureReason[1]])
-                continue
-
-            seqTotalNTmuts = sum(sum(seqNTmutArray))
-            NTmutArray += seqNTmutArray
-            NTmutDist[seqTotalNTmuts] += 1
-            if self.doAAanalysis:
-                AAmutArray += seqAAmutArray
-                seqTotalAAmuts = sum(sum(seqAAmutArray))
-                AAmutDist[seqTotalAAmuts] += 1
 
-            if not self.fastq:
-                avgQscore = -1
+        # genotypes are aggregated into unique genotypes as sequences are analyzed, spilling to a temporary directory if there are too many to keep in memory
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(self.outputList[1]))) as tempDir:
+            genotypes = GenotypeAggregator(tempDir, self.maxGenotypesInMemory)
+
+            # analyze all reads in this process, or split the BAM file into chunks of reads that are analyzed by a pool of worker processes.
+            #   Results from each chunk are merged in the order of the chunks within the BAM file, so outputs are identical either way
+            if self.threads > 1:
+                chunks = chunk_BAM(self.BAMin, self.chunkSize)
+                NTmutArray, NTmutDist, AAmutArray, AAmutDist, failuresList = self.empty_results()
+                with mp.get_context('fork').Pool(self.threads, initializer=init_worker, initargs=(self,)) as pool:
+                    for chunkNTmutArray, chunkNTmutDist, chunkAAmutArray, chunkAAmutDist, chunkGenotypes, chunkFailuresList in pool.imap(analyze_chunk, chunks):
+                        NTmutArray += chunkNTmutArray
+                        NTmutDist += chunkNTmutDist
+                        if self.doAAanalysis:
+                            AAmutArray += chunkAAmutArray
+                            AAmutDist += chunkAAmutDist
+                        genotypes.update(chunkGenotypes)
+                        failuresList.extend(chunkFailuresList)
             else:
-                avgQscore = np.average(np.array(cleanAln[3]))
-            seqGenotype = [bamEntry.query_name, avgQscore] + seqGenotype
+                NTmutArray, NTmutDist, AAmutArray, AAmutDist, genotypes, failuresList = self.analyze_BAM_entries(bamFile, genotypes)
 
-            if self.barcodeColumn:
-                seqGenotype.append(bamEntry.get_tag('BC'))
-
-            if self.config['runs'][tag].get('NT_muts_of_interest', False):
-                mutStr = ''
-                mutOneHot = []
-                for mut in self.NT_muts_of_interest:
-                    if mut in seqGenotype[genotypesColumns.index('NT_substitutions')].split(', ') + seqGenotype[genotypesColumns.index('NT_insertions')].split(', ') + seqGenotype[genotypesColumns.index('NT_deletions')].split(', '):
-                        mutStr += mut
-                        mutOneHot.append(1)
-                    else:
-                        mutOneHot.append(0)
-                seqGenotype.append(mutStr)
-                seqGenotype.extend(mutOneHot)
-
-            if self.doAAanalysis and self.config['runs'][tag].get('AA_muts_of_interest', False):
-                mutStr = ''
-                mutOneHot = []
-                for mut in self.AA_muts_of_interest:
-                    if mut in seqGenotype[genotypesColumns.index('AA_substitutions_nonsynonymous')].split(', '):
-                        mutStr += mut
-                        mutOneHot.append(1)
-                    else:
-                        mutOneHot.append(0)
-                seqGenotype.append(mutStr)
-                seqGenotype.extend(mutOneHot)
-            
-
-            genotypesList.append(seqGenotype)
-
-        genotypesDF = pd.DataFrame(genotypesList, columns=genotypesColumns)
-        failuresDF = pd.DataFrame(failuresList, columns=failuresColumns)
-        
-        genotypesDF['genotype->seq'] = genotypesDF.groupby(by=genotypesColumns[2:]).ngroup()        # identify duplicate genotypes, assign a unique value. This value will not be the genotype_ID, which will be assigned after further manipulation, but will be used to correlate seq_IDs to genotype_IDs
-        genotypesDF['count'] = genotypesDF.groupby(by='genotype->seq')['seq_ID'].transform('count') # count duplicate genotypes, add to new column
-        genotypesDFcondensed = genotypesDF.sort_values('avg_quality_score', ascending=False).drop_duplicates('genotype->seq', keep='first')[ ['genotype->seq','count']+genotypesColumns ] # remove duplicate genotype rows, keep the seq_ID with the highest average quality score
-        sort = ['count','NT_substitutions_count']
-        ascendBool = [False,True]
-        if self.barcodeColumn:
-            sort.append('barcode(s)')
-            ascendBool.append(True)
-        genotypesDFcondensed = genotypesDFcondensed.sort_values(sort, ascending=ascendBool)
-
-        # move wildtype row(s) to the beginning, if they exist. rename as wild type only if there aren't any barcodes in the genotype, as this would result in many different 'wildtype' rows
-        wildtypeDF = genotypesDFcondensed.loc[(genotypesDFcondensed['NT_substitutions']=='')&(genotypesDFcondensed['NT_insertions']=='')&(genotypesDFcondensed['NT_deletions']=='')]
-        if len(wildtypeDF) > 0:
-            wildtype_in_df = True
-        else: wildtype_in_df = False
-        if wildtype_in_df:
-            genotypesDFcondensed = genotypesDFcondensed.drop(index=wildtypeDF.index)
-            genotypesDFcondensed = pd.concat([wildtypeDF, genotypesDFcondensed]).reset_index(drop=True)
-            if not self.barcodeColumn:
-                genotypesDFcondensed.rename(index={0:'wildtype'}, inplace=True)
-        else:
-            genotypesDFcondensed.reset_index(drop=True, inplace=True)
-        if genotypesDFcondensed.index[0] == 0: # make barcode IDs 1-indexed if necessary
-            genotypesDFcondensed.index += 1
-
-        # now that genotype IDs are established, add column that correlates every sequence ID with a genotype ID from the condensed genotypes DF
-        genotypesDFcondensed = genotypesDFcondensed.reset_index().rename(columns={'index':'genotype_ID'})
-        seq_to_genotype_dict = dict(zip(genotypesDFcondensed['genotype->seq'], genotypesDFcondensed['genotype_ID']))
-        genotypesDF['genotype_ID'] = genotypesDF['genotype->seq'].map(seq_to_genotype_dict)
+            failuresDF = pd.DataFrame(failuresList, columns=failuresColumns)
+            genotypeAlignmentsOut = self.write_genotypes(genotypes, self.outputList[1], self.outputList[2])
 
-        # iterate through x genotypes with highest counts and genotypes of specific ID # (both defined in config file) , get a representative sequence for each (that w highest avg_quality_score, or essentially random if there are no quality scores), and write alignments to file
-        genotypeAlignmentsOutDF = genotypesDFcondensed.iloc[0:self.highestAbundanceGenotypes+1,]
-        if self.desiredGenotypeIDs:
-            desiredGenotypeIDs = [int(ID) for ID in str(self.desiredGenotypeIDs).split(', ') if int(ID) <= len(genotypesDFcondensed)]
-            genotypeAlignmentsOutDF = pd.concat( [genotypeAlignmentsOutDF, genotypesDFcondensed.iloc[desiredGenotypeIDs,]] )
+        # write alignments for x genotypes with highest counts and genotypes of specific ID # (both defined in config file), using a representative sequence
+        #   for each (that w highest avg_quality_score, or the first if there are no quality scores)
         with open(self.outputList[0], 'w') as txtOut:
-            nameIndexedBAM = pysam.IndexedReads(bamFile)
-            nameIndexedBAM.build()
-            for row in genotypeAlignmentsOutDF.itertuples():
-                if row.genotype_ID=='wildtype':
+            for genotypeID, seqID, seqOffset in genotypeAlignmentsOut:
+                if genotypeID=='wildtype':
                     continue
-                seqID = row.seq_ID
-                iterator = nameIndexedBAM.find(seqID)
-                for BAMentry in iterator:
-                    break
+                bamFile.seek(seqOffset)
+                BAMentry = next(bamFile)
                 x = self.clean_alignment(BAMentry)
-                if self.useReverseComplement:
-                    x = self.clean_alignment_reverse_complement(x)
-                ref, alignString, seq, _, _, _ = x
-                txtOut.write(f'Genotype {row.genotype_ID} representative sequence. Sequence ID: {seqID}\n')
+                ref, alignString, seq = self.format_alignment(x)
+                txtOut.write(f'Genotype {genotypeID} representative sequence. Sequence ID: {seqID}\n')
                 for string in [ref, alignString, seq]:
                     txtOut.write(string+'\n')
                 txtOut.write('\n')
@@ -459,9 +702,6 @@ class MutationAnalysis:
         NTdistDF = pd.DataFrame(NTmutDist, columns=['seqs_with_n_NTsubstitutions'])
         NTdistDF.index.name = 'n'
 
-        genotypesDFcondensed.drop(columns=['genotype->seq', 'seq_ID', 'avg_quality_score']).to_csv(self.outputList[1], index=False)
-        genotypesDF.drop(columns=genotypesDF.columns.difference(['seq_ID', 'genotype_ID'])).to_csv(self.outputList[2], index=False)
-
         failuresDF.to_csv(self.outputList[3], index=False)
         NTmutDF.index.name = 'NT_mutation_count'
         if not self.config['mutations_frequencies_raw'] and totalSeqs>0:
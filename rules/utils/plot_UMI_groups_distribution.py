@@ -1,6 +1,6 @@
 """part of nanopype-MACE pipeline, written by Gordon Rix
 plot_UMI_groups_distribution.py
-plots the distribution of counts of UMIs identified in provided UMI_tools group log file"""
+plots the distribution of counts of UMIs identified in provided UMI group log file"""
 
 from bokeh.plotting import figure, output_file, show, save
 from bokeh.models import (BasicTicker, ColorBar, ColumnDataSource, FactorRange,
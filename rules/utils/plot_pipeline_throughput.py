@@ -62,7 +62,7 @@ if snakemake.config['do_UMI_analysis'][tag]:
     outList.append(['preconsensus alignment', count, time/60])
 
     # UMI extraction
-    extractCSV = pd.read_csv(snakemake.input.UMI_extract, dtype={'umi':str})
+    extractCSV = pd.read_csv(snakemake.input.UMI_extract)
     count = extractCSV['success'].sum()
     previousTimestamp = os.path.getmtime(snakemake.input.UMI_preconsensus_alignment)
     timestamp = os.path.getmtime(snakemake.input.UMI_extract)
@@ -85,11 +85,15 @@ if snakemake.config['do_UMI_analysis'][tag]:
             count += 1
     outList.append(['consensus', count, timestamp-previousTimestamp])
 
-# alignment
-BAMin = pysam.AlignmentFile(snakemake.input.alignment, 'rb')
-count = 0
-for BAMentry in BAMin.fetch(refID):
-    count += 1
+# alignment. If demultiplexing was performed directly from the alignment stream, the sorted alignment file is not generated,
+#   and the number of aligned sequences is instead the number of sequences that were demultiplexed
+if snakemake.config['do_demux_stream'][tag]:
+    count = pd.read_csv(snakemake.input.demux)['barcodes_count'].sum()
+else:
+    BAMin = pysam.AlignmentFile(snakemake.input.alignment, 'rb')
+    count = 0
+    for BAMentry in BAMin.fetch(refID):
+        count += 1
 time = get_runtime(snakemake.input.alignment_log)
 outList.append(['alignment', count, time/60])
 
@@ -102,7 +106,7 @@ if snakemake.config['do_demux'][tag]:
     demuxCSVfiltered = demuxCSV[demuxCSV.apply(lambda row:
         fail_check(row['output_file_barcodes']), axis=1)]
     count = demuxCSVfiltered['demuxed_count'].sum()
-    time = os.path.getmtime(snakemake.input.demux)-os.path.getmtime(snakemake.input.alignment)
+    time = os.path.getmtime(snakemake.input.demux)-os.path.getmtime(snakemake.input.alignment_log if snakemake.config['do_demux_stream'][tag] else snakemake.input.alignment)
     outList.append(['demux', count, time/60])    
                 
 
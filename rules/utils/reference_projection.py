@@ -0,0 +1,141 @@
+"""projection of barcode and UMI sequence contexts from reference coordinates onto the query coordinates
+    of individual aligned reads. Contexts are located within the reference sequence once, and the
+    location of the Ns within each context is then mapped onto the query sequence of each read using
+    a single walk through the read's CIGAR string, rather than building a gapped reference string for
+    every read and searching it for each context"""
+
+from bisect import bisect_right
+
+CONTEXT_NOT_ALIGNED = 'context_not_present_in_reference_sequence'
+LOW_CONFIDENCE = 'low_confidence_barcode_identification'
+
+MATCH_OPS = {0, 7, 8}       # M, =, X consume both query and reference
+INSERTION_OPS = {1}         # I consumes query only
+DELETION_OPS = {2, 3}       # D, N consume reference only
+
+def locate_context(referenceSequence, context):
+    """finds all locations of a context (e.g. ATCGNNNNCCGA) within a reference sequence
+
+    args:
+        referenceSequence   - uppercase reference sequence string
+        context             - uppercase context string containing Ns at the barcode or UMI positions
+
+    returns:
+        list of (contextStart, contextEnd, N_start, N_end) tuples in reference coordinates, in the order that
+            they appear in the reference, where N_start and N_end mark the first N and the position after the last N.
+            Empty if the context is not present
+    """
+    NstartOffset = context.find('N')
+    NendOffset = len(context) - context[::-1].find('N')
+    locations = []
+    location = referenceSequence.find(context)
+    while location != -1:
+        locations.append((location, location+len(context), location+NstartOffset, location+NendOffset))
+        location = referenceSequence.find(context, location+1)
+    return locations
+
+def match_blocks(BAMentry):
+    """walks through the CIGAR string of a pysam.AlignedSegment and returns the ungapped aligned blocks
+
+    returns:
+        blockStarts - list of the reference start of each block, for bisection
+        blocks      - list of [refStart, refEnd, queryStart, indelBefore, indelAfter] lists, where queryStart is
+                        relative to query_alignment_sequence and indelBefore/indelAfter are True if the block
+                        is immediately preceded/followed by an insertion or deletion
+    """
+    blockStarts = []
+    blocks = []
+    refIndex = BAMentry.reference_start
+    queryIndex = 0
+    lastOp = None
+    for op, length in BAMentry.cigartuples:
+        if op in MATCH_OPS:
+            if lastOp in MATCH_OPS:     # merge adjacent M/=/X operations into a single block
+                refStart, _, queryStart, indelBefore, _ = blocks[-1]
+                blocks[-1] = [refStart, refIndex+length, queryStart, indelBefore, False]
+            else:
+                blockStarts.append(refIndex)
+                blocks.append([refIndex, refIndex+length, queryIndex, lastOp in INSERTION_OPS or lastOp in DELETION_OPS, False])
+            refIndex += length
+            queryIndex += length
+        elif op in INSERTION_OPS:
+            queryIndex += length
+        elif op in DELETION_OPS:
+            refIndex += length
+        else:                           # soft and hard clips are not part of query_alignment_sequence
+            lastOp = None
+            continue
+        if op not in MATCH_OPS and blocks and lastOp in MATCH_OPS:
+            blocks[-1][4] = True
+        lastOp = op
+    return blockStarts, blocks
+
+class ReferenceProjection:
+
+    def __init__(self, referenceSequence, contexts, flagAdjacentIndels=True):
+        """
+        arguments:
+
+        referenceSequence   - reference sequence string that reads are aligned to
+        contexts            - dictionary of context names and context strings. Contexts must already be
+                                validated as present in the reference sequence by the caller
+        flagAdjacentIndels  - if True, Ns that are immediately adjacent to an insertion or deletion in
+                                a read are reported as a low confidence identification
+        """
+        referenceSequence = str(referenceSequence).upper()
+        self.contextLocations = {name: locate_context(referenceSequence, context.upper()) for name, context in contexts.items()}
+        self.flagAdjacentIndels = flagAdjacentIndels
+
+    def project(self, BAMentry, blocks=None):
+        """maps the N positions of each context onto the query of a single pysam.AlignedSegment. Blocks produced
+        by match_blocks() for this BAMentry may be provided if they have already been computed
+
+        returns:
+            dictionary of context names and either a (start, stop) tuple of the query_alignment_sequence
+                coordinates of the Ns, or a failure reason string if the context could not be identified.
+                A context is only identified if it lies entirely within a single ungapped aligned block.
+                If a context appears more than once in the reference, the first fully aligned location is used
+        """
+        blockStarts, blocks = blocks if blocks else match_blocks(BAMentry)
+        projections = {}
+        for name, locations in self.contextLocations.items():
+            projections[name] = CONTEXT_NOT_ALIGNED
+            for contextStart, contextEnd, N_start, N_end in locations:
+                i = bisect_right(blockStarts, contextStart) - 1
+                if i < 0:
+                    continue
+                refStart, refEnd, queryStart, indelBefore, indelAfter = blocks[i]
+                if contextEnd > refEnd:
+                    continue
+                if self.flagAdjacentIndels and ((N_start == refStart and indelBefore) or (N_end == refEnd and indelAfter)):
+                    projections[name] = LOW_CONFIDENCE
+                else:
+                    projections[name] = (queryStart + N_start - refStart, queryStart + N_end - refStart)
+                break
+        return projections
+
+    def map_N_region(self, blocks, name):
+        """maps the N positions of a context onto query coordinates regardless of any indels within or adjacent to the context,
+        for indel tolerant barcode identification. Reference positions within a deletion are mapped to the next aligned query position,
+        so the resulting query region includes any insertions within the Ns
+
+        args:
+            blocks  - (blockStarts, blocks) tuple produced by match_blocks() for a BAMentry
+            name    - context name
+
+        returns:
+            (start, stop) tuple of query_alignment_sequence coordinates for the first location of the context
+                that is spanned by the alignment, or None if no location is spanned
+        """
+        blockStarts, blocks = blocks
+        if not blocks:
+            return None
+        for contextStart, contextEnd, N_start, N_end in self.contextLocations[name]:
+            if contextStart < blocks[0][0] or contextEnd > blocks[-1][1]:
+                continue
+            queryPositions = []
+            for refPosition in (N_start, N_end):
+                refStart, refEnd, queryStart, _, _ = blocks[bisect_right(blockStarts, refPosition) - 1]
+                queryPositions.append(queryStart + min(refPosition, refEnd) - refStart)
+            return tuple(queryPositions)
+        return None